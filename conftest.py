@@ -0,0 +1,20 @@
+"""
+pytest setup for the root-level tests.
+
+video_codec_test.py is a command-line benchmark, not a test module, despite
+its name. When OpenCV isn't installed a bare cv2 module is registered so
+video_preprocessor imports; tests swap in their own captures either way.
+"""
+
+import sys
+import types
+
+collect_ignore = ['video_codec_test.py']
+
+try:
+    import cv2  # noqa: F401
+except ImportError:
+    cv2 = types.ModuleType('cv2')
+    cv2.CAP_ANY = 0
+    cv2.CAP_FFMPEG = 1900
+    sys.modules['cv2'] = cv2
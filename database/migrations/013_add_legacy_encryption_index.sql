@@ -0,0 +1,9 @@
+-- Optional: partial index over media_records still on legacy (Fernet)
+-- encryption. scripts/30_convert_fernet_to_aes_gcm.py pages through these
+-- rows by keyset on (created_at, uuid); with this index each page is an
+-- index range scan over the remaining legacy rows instead of a full table
+-- scan, and the index shrinks to nothing as records are converted.
+
+CREATE INDEX IF NOT EXISTS idx_media_records_legacy_encryption
+  ON media_records (created_at, uuid)
+  WHERE encryption_method IS NULL OR encryption_method != 'aes-gcm-unified';
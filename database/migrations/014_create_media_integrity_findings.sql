@@ -0,0 +1,26 @@
+-- Per-row results of scripts/scrub-media-integrity.py. Only rows that failed
+-- a check are recorded; a clean scrub run leaves no rows behind. Reruns of the
+-- same run (--resume) upsert on (scrub_run_id, media_uuid).
+--
+-- status: corrupt | truncated | metadata_mismatch | missing | error
+--   corrupt            one or more chunks fail their AES-GCM auth tag (bad_chunks)
+--   truncated          blob is shorter than encryption_metadata implies
+--   metadata_mismatch  chunkSize/totalChunks/fileSize disagree with each
+--                      other, the blob length, or file_size/original_size
+--   missing            no encrypted_data / Large Object to read
+--   error              the row couldn't be scrubbed (detail has the message)
+
+CREATE TABLE IF NOT EXISTS media_integrity_findings (
+  id BIGSERIAL PRIMARY KEY,
+  scrub_run_id UUID NOT NULL,
+  media_uuid UUID NOT NULL REFERENCES media_records(uuid) ON DELETE CASCADE,
+  storage_type VARCHAR(10),
+  status VARCHAR(20) NOT NULL,
+  bad_chunks INTEGER[],
+  detail TEXT,
+  checked_at TIMESTAMP NOT NULL DEFAULT NOW(),
+  UNIQUE (scrub_run_id, media_uuid)
+);
+
+CREATE INDEX IF NOT EXISTS idx_media_integrity_findings_media_uuid ON media_integrity_findings (media_uuid);
+CREATE INDEX IF NOT EXISTS idx_media_integrity_findings_status ON media_integrity_findings (status);
@@ -17,6 +17,9 @@ Usage:
 
     # Convert in batches
     python3 30_convert_fernet_to_aes_gcm.py --batch-size 10
+
+    # Convert all legacy records across 8 worker processes
+    python3 30_convert_fernet_to_aes_gcm.py --all --workers 8
 """
 
 import os
@@ -26,13 +29,12 @@ import psycopg2
 import hashlib
 import hmac
 import json
-import math
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 import base64
+from chunk_codec import ChunkCodec, ChunkEncryptor, derive_key, get_optimal_chunk_size, lob_writer
 
 # Database connection parameters
 DB_CONFIG = {
@@ -49,14 +51,16 @@ ENCRYPTION_KEY = os.getenv(
     "MEDIA_ENCRYPTION_KEY",
     "K8mF3vN9pQ2sT6wY0zC4eH7jL1nP5rU8xA3dG6iK9mO2qT5wZ8cF1hJ4lN7pS0vY",
 )
-SALT = b"comfy_media_salt_v1"
-ITERATIONS = 100000
 
-# Chunk sizes
-CHUNKING_THRESHOLD = 1024 * 1024  # 1MB
-SMALL_FILE_CHUNK_SIZE = 64 * 1024  # 64KB
-DEFAULT_CHUNK_SIZE = 1024 * 1024  # 1MB
-LOB_CHUNK_SIZE = 64 * 1024  # 64KB for LOB operations
+# Chunk sizes (the AES-GCM chunk policy itself lives in chunk_codec.py)
+LOB_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB per LOB read/write round trip
+STREAM_READ_SIZE = 8 * 1024 * 1024  # 8MB of Fernet ciphertext per loread when streaming a LOB
+
+# Content-hash collisions (same format as backfill-content-sha256.py's report)
+COLLISIONS_PATH = "/tmp/dop-dedup-convert-collisions.txt"
+
+# Rows still on Fernet; matches the partial index in database/migrations/013
+LEGACY_FILTER = "(encryption_method IS NULL OR encryption_method != 'aes-gcm-unified')"
 
 
 def log_info(msg):
@@ -67,25 +71,6 @@ def log_error(msg):
     print(f"[ERROR] {msg}", file=sys.stderr)
 
 
-def derive_encryption_key(password):
-    """Derive proper 32-byte AES-256 key from password using PBKDF2"""
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=SALT,
-        iterations=ITERATIONS,
-        backend=default_backend(),
-    )
-    return kdf.derive(password.encode())
-
-
-def get_optimal_chunk_size(file_size):
-    """Determine optimal chunk size based on file size"""
-    if file_size <= CHUNKING_THRESHOLD:
-        return SMALL_FILE_CHUNK_SIZE
-    return DEFAULT_CHUNK_SIZE
-
-
 def decrypt_fernet_data(encrypted_data, encryption_key):
     """Decrypt Fernet-encrypted data using custom implementation matching TypeScript"""
     try:
@@ -112,15 +97,8 @@ def decrypt_fernet_data(encrypted_data, encryption_key):
                 # If that fails, assume it's already a Fernet token
                 fernet_token = encrypted_data
 
-        # Use PBKDF2 to derive the key (same as TypeScript implementation)
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=SALT,
-            iterations=ITERATIONS,
-            backend=default_backend(),
-        )
-        derived_key = kdf.derive(encryption_key.encode())
+        # Same PBKDF2 key as the TypeScript implementation
+        derived_key = derive_key(encryption_key)
 
         # Split key like TypeScript: first 16 bytes for signing, last 16 bytes for encryption
         signing_key = derived_key[:16]
@@ -158,7 +136,9 @@ def decrypt_fernet_data(encrypted_data, encryption_key):
 
         decrypted = decryptor.update(ciphertext) + decryptor.finalize()
 
-        return decrypted
+        # Strip PKCS7 padding (TypeScript's decipher does this via setAutoPadding)
+        unpadder = padding.PKCS7(128).unpadder()
+        return unpadder.update(decrypted) + unpadder.finalize()
 
     except Exception as e:
         log_error(f"Failed to decrypt Fernet data: {e}")
@@ -168,233 +148,429 @@ def decrypt_fernet_data(encrypted_data, encryption_key):
 
 def encrypt_aes_gcm_chunked(data, encryption_key, chunk_size):
     """Encrypt data using unified AES-GCM approach - compatible with malris format"""
-    total_chunks = math.ceil(len(data) / chunk_size)
-    encrypted_chunks = []
-
-    # Derive proper 32-byte key for AES-256
-    derived_key = derive_encryption_key(encryption_key)
-
-    # Generate a file-specific salt from the encryption key
-    file_salt = hashlib.sha256((encryption_key + "file_salt").encode()).digest()
-
-    for i in range(total_chunks):
-        start = i * chunk_size
-        end = min(start + chunk_size, len(data))
-        chunk = data[start:end]
-
-        # Generate deterministic IV for this chunk (same as malris)
-        iv_hash = hashlib.sha256()
-        iv_hash.update(file_salt)
-        iv_hash.update(str(i).encode())
-        iv = iv_hash.digest()[:16]  # AES-GCM uses 16-byte IV
-
-        # Encrypt chunk using AES-256-GCM
-        cipher = Cipher(
-            algorithms.AES(derived_key), modes.GCM(iv), backend=default_backend()
-        )
-        encryptor = cipher.encryptor()
-
-        encrypted_chunk = encryptor.update(chunk) + encryptor.finalize()
-        auth_tag = encryptor.tag
-
-        # Store: IV (16 bytes) + AuthTag (16 bytes) + Encrypted Data (same as malris)
-        chunk_with_metadata = iv + auth_tag + encrypted_chunk
-        encrypted_chunks.append(chunk_with_metadata)
-
-    encrypted_data = b"".join(encrypted_chunks)
-
-    metadata = {
-        "chunkSize": chunk_size,
-        "totalChunks": total_chunks,
-        "encryptionMethod": "aes-gcm-unified",
-        "fileSize": len(data),
-    }
+    encryptor = ChunkEncryptor(ChunkCodec.for_password(encryption_key), chunk_size)
+    encrypted_data = encryptor.update(data) + encryptor.finalize()
+    metadata = encryptor.metadata()
 
     log_info(
-        f"Encrypted {len(data)} bytes into {total_chunks} chunks of {chunk_size} bytes each"
+        f"Encrypted {len(data)} bytes into {metadata['totalChunks']} chunks of {chunk_size} bytes each"
     )
 
-    return encrypted_data, metadata
+    return encrypted_data, metadata, encryptor.sha256.digest()
 
 
-def read_large_object(cursor, oid, file_size):
-    """Read Large Object data"""
-    cursor.execute("BEGIN")
-
-    try:
-        # Open for reading
-        cursor.execute("SELECT lo_open(%s, %s)", (oid, 262144))  # Read mode
-        fd = cursor.fetchone()[0]
-
-        chunks = []
-        total_read = 0
+def read_large_object(cursor, oid):
+    """Read Large Object data in LOB_CHUNK_SIZE lo_get pieces (caller's transaction)"""
+    chunks = []
+    offset = 0
+    while True:
+        cursor.execute("SELECT lo_get(%s, %s, %s)", (oid, offset, LOB_CHUNK_SIZE))
+        chunk = cursor.fetchone()[0]
+        chunks.append(chunk)
+        offset += len(chunk)
+        if len(chunk) < LOB_CHUNK_SIZE:
+            return b"".join(chunks)
 
-        while total_read < file_size:
-            cursor.execute("SELECT lo_read(%s, %s)", (fd, LOB_CHUNK_SIZE))
-            chunk = cursor.fetchone()[0]
 
-            if not chunk or len(chunk) == 0:
-                break
+def write_large_object(cursor, data):
+    """Write data to a new Large Object in LOB_CHUNK_SIZE pieces and return OID.
+
+    Runs in the caller's transaction: lo_from_bytea creates the object with
+    the first piece, lo_put appends the rest, so there is no descriptor to
+    open and one round trip per piece."""
+    view = memoryview(data)
+    cursor.execute("SELECT lo_from_bytea(0, %s)", (view[:LOB_CHUNK_SIZE],))
+    oid = cursor.fetchone()[0]
+    for offset in range(LOB_CHUNK_SIZE, len(view), LOB_CHUNK_SIZE):
+        cursor.execute(
+            "SELECT lo_put(%s, %s, %s)", (oid, offset, view[offset : offset + LOB_CHUNK_SIZE])
+        )
+    return oid
 
-            chunks.append(chunk)
-            total_read += len(chunk)
 
-        cursor.execute("SELECT lo_close(%s)", (fd,))
+def unlink_large_object(cursor, oid):
+    """Drop a replaced Large Object once the record pointing away from it has
+    committed. If this fails the object is merely orphaned, never referenced,
+    and cleanup_orphaned_large_objects() (migration 004) will collect it."""
+    try:
+        cursor.execute("SELECT lo_unlink(%s)", (oid,))
         cursor.execute("COMMIT")
-
-        return b"".join(chunks)
+        log_info(f"Deleted old large object {oid}")
     except Exception as e:
         cursor.execute("ROLLBACK")
-        raise e
-
-
-def write_large_object(cursor, data):
-    """Write data to a new Large Object and return OID"""
-    cursor.execute("BEGIN")
-
-    try:
-        # Create large object
-        cursor.execute("SELECT lo_create(0)")
-        oid = cursor.fetchone()[0]
+        log_error(f"Could not delete old large object {oid} (left orphaned): {e}")
+
+
+def stream_convert_large_object(cursor, oid):
+    """Convert a Fernet Large Object into a new AES-GCM Large Object without
+    buffering either: ciphertext is read STREAM_READ_SIZE at a time, HMAC'd,
+    CBC-decrypted and re-encrypted chunk by chunk into a lob_writer.
+
+    The HMAC can only be checked once the whole token has been read, so this
+    runs inside the caller's transaction; a bad token raises and the caller's
+    ROLLBACK discards the half-written object.
+
+    Returns (new_oid, metadata, encrypted_size, content_sha256, checksum), or None when the object can't
+    be streamed (not a raw Fernet token, or its plaintext size straddles the
+    chunk-size threshold so the chunk size isn't known up front).
+    """
+    derived_key = derive_key(ENCRYPTION_KEY)
+    signing_key, encryption_key_bytes = derived_key[:16], derived_key[16:32]
+
+    cursor.execute("SELECT lo_open(%s, %s)", (oid, 262144))  # Read mode
+    src = cursor.fetchone()[0]
+    cursor.execute("SELECT lo_lseek64(%s, 0, 2)", (src,))  # SEEK_END
+    token_size = cursor.fetchone()[0]
+    cursor.execute("SELECT lo_lseek64(%s, 0, 0)", (src,))  # SEEK_SET
+    cursor.execute("SELECT loread(%s, %s)", (src, 25))
+    header = bytes(cursor.fetchone()[0])
+
+    # PKCS7 always pads, so plaintext is 1..16 bytes shorter than the ciphertext
+    ciphertext_size = token_size - 57
+    if len(header) < 25 or header[0] != 0x80 or ciphertext_size <= 0:
+        cursor.execute("SELECT lo_close(%s)", (src,))
+        return None
+    chunk_size = get_optimal_chunk_size(ciphertext_size - 16)
+    if chunk_size != get_optimal_chunk_size(ciphertext_size - 1):
+        cursor.execute("SELECT lo_close(%s)", (src,))
+        return None
+
+    mac = hmac.new(signing_key, header, hashlib.sha256)
+    decryptor = Cipher(
+        algorithms.AES(encryption_key_bytes), modes.CBC(header[9:25]), backend=default_backend()
+    ).decryptor()
+    unpadder = padding.PKCS7(128).unpadder()
+    encryptor = ChunkEncryptor(ChunkCodec.for_password(ENCRYPTION_KEY), chunk_size)
+    encrypted_size = 0
+
+    with lob_writer(cursor) as (new_oid, write, checksum):
+        remaining = ciphertext_size
+        while remaining > 0:
+            cursor.execute("SELECT loread(%s, %s)", (src, min(STREAM_READ_SIZE, remaining)))
+            block = cursor.fetchone()[0]
+            if not block:
+                raise Exception(f"Large object {oid} ended {remaining} bytes early")
+            remaining -= len(block)
+            mac.update(block)
+            encrypted = encryptor.update(unpadder.update(decryptor.update(block)))
+            write(encrypted)
+            encrypted_size += len(encrypted)
+
+        cursor.execute("SELECT loread(%s, %s)", (src, 32))
+        if not hmac.compare_digest(mac.digest(), bytes(cursor.fetchone()[0])):
+            raise Exception("HMAC verification failed")
 
-        # Open for writing
-        cursor.execute("SELECT lo_open(%s, %s)", (oid, 131072))  # Write mode
-        fd = cursor.fetchone()[0]
+        encrypted = encryptor.update(unpadder.update(decryptor.finalize()) + unpadder.finalize())
+        encrypted += encryptor.finalize()
+        write(encrypted)
+        encrypted_size += len(encrypted)
 
-        # Write data in chunks
-        offset = 0
-        while offset < len(data):
-            chunk_end = min(offset + LOB_CHUNK_SIZE, len(data))
-            chunk = data[offset:chunk_end]
+    cursor.execute("SELECT lo_close(%s)", (src,))
+    return new_oid, encryptor.metadata(), encrypted_size, encryptor.sha256.digest(), checksum.hexdigest()
 
-            cursor.execute("SELECT lo_write(%s, %s)", (fd, chunk))
-            offset = chunk_end
 
-        cursor.execute("SELECT lo_close(%s)", (fd,))
-        cursor.execute("COMMIT")
+def resolve_content_sha256(cursor, uuid, digest):
+    """content_sha256 to write for a converted record, and the uuid it collides with.
 
-        return oid
-    except Exception as e:
-        cursor.execute("ROLLBACK")
-        raise e
+    Same rule as backfill-content-sha256.py: if another row already owns this
+    hash the record is left NULL and reported, rather than tripping the
+    partial unique index and losing the conversion."""
+    cursor.execute(
+        "SELECT uuid FROM media_records WHERE content_sha256 = %s AND uuid != %s LIMIT 1",
+        (digest, uuid),
+    )
+    existing = cursor.fetchone()
+    if existing:
+        return None, existing[0]
+    return digest, None
+
+
+def update_with_content_sha256(cursor, uuid, digest, update):
+    """Run update(content_sha256) with the resolved hash and return the uuid it
+    collided with, if any. A parallel worker converting the same content can
+    claim the hash between the check and our UPDATE; the unique index then
+    rejects it, so resolve again (the winner has committed by then) and retry."""
+    content_sha256, collision = resolve_content_sha256(cursor, uuid, digest)
+    cursor.execute("SAVEPOINT content_sha256")
+    try:
+        update(content_sha256)
+    except psycopg2.errors.UniqueViolation:
+        cursor.execute("ROLLBACK TO SAVEPOINT content_sha256")
+        content_sha256, collision = resolve_content_sha256(cursor, uuid, digest)
+        update(content_sha256)
+    if collision:
+        log_info(f"Content already stored as {collision}, leaving content_sha256 NULL")
+    return collision
+
+
+def update_large_object_record(cursor, uuid, new_oid, encrypted_size, checksum, metadata, content_sha256):
+    """Point a LOB record at its re-encrypted object; checksum is the sha256 hex of its ciphertext"""
+    cursor.execute(
+        """
+        UPDATE media_records
+        SET large_object_oid = %s,
+            file_size = %s,
+            original_size = %s,
+            checksum = %s,
+            encryption_method = 'aes-gcm-unified',
+            chunk_size = %s,
+            encryption_metadata = %s,
+            content_sha256 = %s,
+            updated_at = NOW()
+        WHERE uuid = %s
+    """,
+        (
+            new_oid,
+            encrypted_size,
+            metadata["fileSize"],
+            checksum,
+            metadata["chunkSize"],
+            json.dumps(metadata),
+            content_sha256,
+            uuid,
+        ),
+    )
 
 
 def convert_record(cursor, record):
-    """Convert a single record from Fernet to AES-GCM"""
+    """Convert a single record from Fernet to AES-GCM.
+
+    Reading, writing the new Large Object and the UPDATE all happen in one
+    transaction; a replaced Large Object is only unlinked after that commits,
+    so a crash at any point leaves the record pointing at a complete object."""
     uuid, encrypted_data, large_object_oid, storage_type, filename, file_size = record
 
     try:
         log_info(
             f"Converting record {uuid} ({filename}, {storage_type}, {file_size} bytes)"
         )
-
-        # Step 1: Read encrypted data
-        log_info(f"Step 1: Reading encrypted data from {storage_type} storage...")
-        if storage_type == "bytea":
-            encrypted_buffer = bytes(encrypted_data)
-            log_info(f"Read {len(encrypted_buffer)} bytes from bytea field")
-        else:
-            log_info(f"Reading from large object OID {large_object_oid}...")
-            encrypted_buffer = read_large_object(cursor, large_object_oid, file_size)
-            log_info(f"Read {len(encrypted_buffer)} bytes from large object")
-
-        # Step 2: Decrypt using legacy Fernet encryption
-        log_info(f"Step 2: Decrypting {len(encrypted_buffer)} bytes using Fernet...")
-        decrypted_data = decrypt_fernet_data(encrypted_buffer, ENCRYPTION_KEY)
-        log_info(f"Successfully decrypted {len(decrypted_data)} bytes")
-
-        # Step 3: Re-encrypt using unified AES-GCM
-        log_info(f"Step 3: Re-encrypting using AES-GCM...")
-        chunk_size = get_optimal_chunk_size(len(decrypted_data))
-        log_info(f"Using chunk size: {chunk_size} bytes")
-        new_encrypted_data, metadata = encrypt_aes_gcm_chunked(
-            decrypted_data, ENCRYPTION_KEY, chunk_size
-        )
-        log_info(
-            f"Re-encrypted to {len(new_encrypted_data)} bytes in {metadata['totalChunks']} chunks"
-        )
-
-        # Step 4: Update database record
-        log_info(f"Step 4: Updating database record...")
+        # LOB descriptors only live as long as the transaction, so make it explicit
         cursor.execute("BEGIN")
 
         try:
+            if storage_type == "lob":
+                log_info(f"Streaming large object OID {large_object_oid} through AES-GCM...")
+                streamed = stream_convert_large_object(cursor, large_object_oid)
+                if streamed is not None:
+                    new_oid, metadata, encrypted_size, digest, checksum = streamed
+                    collision = update_with_content_sha256(
+                        cursor,
+                        uuid,
+                        digest,
+                        lambda content_sha256: update_large_object_record(
+                            cursor, uuid, new_oid, encrypted_size, checksum, metadata, content_sha256
+                        ),
+                    )
+                    cursor.execute("COMMIT")
+                    unlink_large_object(cursor, large_object_oid)
+                    log_info(
+                        f"Successfully converted record {uuid}: {metadata['fileSize']} bytes "
+                        f"in {metadata['totalChunks']} chunks, new large object OID {new_oid}"
+                    )
+                    return {"success": True, "uuid": uuid, "sha256": digest.hex(), "collision": collision}
+                log_info("Large object can't be streamed, falling back to buffered conversion")
+
+            # Step 1: Read encrypted data
+            log_info(f"Step 1: Reading encrypted data from {storage_type} storage...")
+            if storage_type == "bytea":
+                encrypted_buffer = bytes(encrypted_data)
+                log_info(f"Read {len(encrypted_buffer)} bytes from bytea field")
+            else:
+                log_info(f"Reading from large object OID {large_object_oid}...")
+                encrypted_buffer = read_large_object(cursor, large_object_oid)
+                log_info(f"Read {len(encrypted_buffer)} bytes from large object")
+
+            # Step 2: Decrypt using legacy Fernet encryption
+            log_info(f"Step 2: Decrypting {len(encrypted_buffer)} bytes using Fernet...")
+            decrypted_data = decrypt_fernet_data(encrypted_buffer, ENCRYPTION_KEY)
+            log_info(f"Successfully decrypted {len(decrypted_data)} bytes")
+
+            # Step 3: Re-encrypt using unified AES-GCM
+            log_info(f"Step 3: Re-encrypting using AES-GCM...")
+            chunk_size = get_optimal_chunk_size(len(decrypted_data))
+            log_info(f"Using chunk size: {chunk_size} bytes")
+            new_encrypted_data, metadata, digest = encrypt_aes_gcm_chunked(
+                decrypted_data, ENCRYPTION_KEY, chunk_size
+            )
+            checksum = hashlib.sha256(new_encrypted_data).hexdigest()
+            log_info(
+                f"Re-encrypted to {len(new_encrypted_data)} bytes in {metadata['totalChunks']} chunks"
+            )
+
+            # Step 4: Update database record
+            log_info(f"Step 4: Updating database record...")
             if storage_type == "bytea":
                 log_info(f"Updating BYTEA record in database...")
-                # Update BYTEA record
-                cursor.execute(
-                    """
-                    UPDATE media_records
-                    SET encrypted_data = %s,
-                        file_size = %s,
-                        original_size = %s,
-                        encryption_method = 'aes-gcm-unified',
-                        chunk_size = %s,
-                        metadata = %s,
-                        updated_at = NOW()
-                    WHERE uuid = %s
-                """,
-                    (
-                        new_encrypted_data,
-                        len(new_encrypted_data),
-                        len(decrypted_data),
-                        metadata["chunkSize"],
-                        json.dumps(metadata),
-                        uuid,
-                    ),
-                )
+
+                def update(content_sha256):
+                    # Update BYTEA record
+                    cursor.execute(
+                        """
+                        UPDATE media_records
+                        SET encrypted_data = %s,
+                            file_size = %s,
+                            original_size = %s,
+                            checksum = %s,
+                            encryption_method = 'aes-gcm-unified',
+                            chunk_size = %s,
+                            encryption_metadata = %s,
+                            content_sha256 = %s,
+                            updated_at = NOW()
+                        WHERE uuid = %s
+                    """,
+                        (
+                            new_encrypted_data,
+                            len(new_encrypted_data),
+                            len(decrypted_data),
+                            checksum,
+                            metadata["chunkSize"],
+                            json.dumps(metadata),
+                            content_sha256,
+                            uuid,
+                        ),
+                    )
+
+                collision = update_with_content_sha256(cursor, uuid, digest, update)
                 log_info(f"BYTEA record updated successfully")
             else:
-                log_info(f"Updating Large Object record...")
-                # Update Large Object
-                # First, delete old large object
-                log_info(f"Deleting old large object {large_object_oid}...")
-                cursor.execute("SELECT lo_unlink(%s)", (large_object_oid,))
-
-                # Create new large object
+                # Write the new object alongside the old one; the old OID is
+                # only unlinked once the record points at the new one
                 log_info(f"Creating new large object...")
                 new_oid = write_large_object(cursor, new_encrypted_data)
                 log_info(f"Created new large object with OID {new_oid}")
 
-                # Update record
                 log_info(f"Updating record with new large object OID...")
-                cursor.execute(
-                    """
-                    UPDATE media_records
-                    SET large_object_oid = %s,
-                        file_size = %s,
-                        original_size = %s,
-                        encryption_method = 'aes-gcm-unified',
-                        chunk_size = %s,
-                        metadata = %s,
-                        updated_at = NOW()
-                    WHERE uuid = %s
-                """,
-                    (
-                        new_oid,
-                        len(new_encrypted_data),
-                        len(decrypted_data),
-                        metadata["chunkSize"],
-                        json.dumps(metadata),
-                        uuid,
+                collision = update_with_content_sha256(
+                    cursor,
+                    uuid,
+                    digest,
+                    lambda content_sha256: update_large_object_record(
+                        cursor, uuid, new_oid, len(new_encrypted_data), checksum, metadata, content_sha256
                     ),
                 )
                 log_info(f"Large Object record updated successfully")
 
             log_info(f"Committing transaction...")
             cursor.execute("COMMIT")
-            log_info(f"Successfully converted record {uuid}")
-            return {"success": True, "uuid": uuid}
 
         except Exception as e:
             cursor.execute("ROLLBACK")
             raise e
 
+        if storage_type == "lob":
+            unlink_large_object(cursor, large_object_oid)
+        log_info(f"Successfully converted record {uuid}")
+        return {"success": True, "uuid": uuid, "sha256": digest.hex(), "collision": collision}
+
     except Exception as e:
         log_error(f"Failed to convert record {uuid}: {e}")
         return {"success": False, "uuid": uuid, "error": str(e)}
 
 
+def report_collisions(results):
+    """Log converted records whose content already existed under another uuid
+    and write the full list to COLLISIONS_PATH"""
+    collisions = [r for r in results if r.get("collision")]
+    if not collisions:
+        return
+    log_info(f"Collisions (content_sha256 left NULL): {len(collisions)}")
+    log_info("first 20 (uuid_left_null, existing_uuid_with_hash, sha256):")
+    for r in collisions[:20]:
+        log_info(f"  {r['uuid']}  →  {r['collision']}  {r['sha256']}")
+    if len(collisions) > 20:
+        log_info(f"  ... and {len(collisions) - 20} more")
+    with open(COLLISIONS_PATH, "w") as f:
+        for r in collisions:
+            f.write(f"{r['uuid']}\t{r['collision']}\t{r['sha256']}\n")
+    log_info(f"  full list: {COLLISIONS_PATH}")
+
+
+_CONN = None  # one connection per worker process, see init_worker
+
+
+def init_worker():
+    """ProcessPoolExecutor initializer: derive (and cache) the key once per
+    process and open the connection this worker converts records on."""
+    global _CONN
+    derive_key(ENCRYPTION_KEY)
+    _CONN = psycopg2.connect(**DB_CONFIG)
+
+
+def fetch_legacy_page(cursor, batch_size, after=None):
+    """Next page of legacy records by keyset on (created_at, uuid). Only the
+    listing columns come back; payloads are fetched per record when converted."""
+    keyset = "AND (created_at, uuid) > (%s, %s)" if after else ""
+    cursor.execute(
+        f"""
+        SELECT uuid, storage_type, filename, file_size, created_at
+        FROM media_records
+        WHERE {LEGACY_FILTER} {keyset}
+        ORDER BY created_at ASC, uuid ASC
+        LIMIT %s
+    """,
+        (*(after or ()), batch_size),
+    )
+    return cursor.fetchall()
+
+
+def convert_uuid(cursor, uuid):
+    """Fetch one legacy record's payload and convert it"""
+    cursor.execute(
+        f"""
+        SELECT uuid, encrypted_data, large_object_oid, storage_type, filename, file_size
+        FROM media_records
+        WHERE uuid = %s AND {LEGACY_FILTER}
+    """,
+        (uuid,),
+    )
+    record = cursor.fetchone()
+    if record is None:
+        cursor.connection.rollback()
+        return {"success": False, "uuid": uuid, "error": "no longer a legacy record"}
+    return convert_record(cursor, record)
+
+
+def convert_worker(uuid):
+    """Convert one record on this worker process's own connection"""
+    global _CONN
+    if _CONN is None or _CONN.closed:
+        _CONN = psycopg2.connect(**DB_CONFIG)
+    with _CONN.cursor() as cursor:
+        return convert_uuid(cursor, uuid)
+
+
+def start_pool(workers):
+    # Derive before forking so fork-started workers inherit the cached key
+    derive_key(ENCRYPTION_KEY)
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+
+
+def convert_batch(cursor, records, pool=None):
+    """Convert a page of listed records one by one on this cursor, or fan them
+    out across the pool's worker processes when --workers > 1"""
+    outcomes = None
+    if pool is not None:
+        log_info(f"Converting {len(records)} records across worker processes...")
+        outcomes = pool.map(convert_worker, [record[0] for record in records])
+
+    results = []
+    for i, record in enumerate(records, 1):
+        if outcomes is None:
+            log_info(f"Processing record {i}/{len(records)}: {record[0]} ({record[2]})")
+            result = convert_uuid(cursor, record[0])
+        else:
+            result = next(outcomes)
+        results.append(result)
+
+        if result["success"]:
+            log_info(f"✅ Record {i}/{len(records)} converted successfully")
+        else:
+            log_error(
+                f"❌ Record {i}/{len(records)} failed: {result.get('error', 'Unknown error')}"
+            )
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Convert Fernet-encrypted media records to AES-GCM"
@@ -416,6 +592,12 @@ def main():
         default=50,
         help="Number of records to process in batch (default: 50)",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes converting records in parallel, each with its own connection (default: 1)",
+    )
 
     args = parser.parse_args()
 
@@ -424,6 +606,7 @@ def main():
         parser.print_help()
         return
 
+    pool = None
     try:
         # Connect to database
         log_info(f"Attempting to connect to database with config: {DB_CONFIG}")
@@ -434,21 +617,17 @@ def main():
 
         # First, check how many legacy records exist
         log_info("Checking for legacy records...")
-        count_query = """
-            SELECT COUNT(*) FROM media_records
-            WHERE encryption_method IS NULL OR encryption_method != 'aes-gcm-unified'
-        """
-        cursor.execute(count_query)
+        cursor.execute(f"SELECT COUNT(*) FROM media_records WHERE {LEGACY_FILTER}")
         total_legacy_count = cursor.fetchone()[0]
         log_info(f"Found {total_legacy_count} total legacy records in database")
 
         # Handle specific UUID conversion
         if args.uuid:
             log_info(f"Searching for specific UUID: {args.uuid}")
-            query = """
+            query = f"""
                 SELECT uuid, encrypted_data, large_object_oid, storage_type, filename, file_size
                 FROM media_records
-                WHERE uuid = %s AND (encryption_method IS NULL OR encryption_method != 'aes-gcm-unified')
+                WHERE uuid = %s AND {LEGACY_FILTER}
             """
             cursor.execute(query, (args.uuid,))
             records = cursor.fetchall()
@@ -467,6 +646,7 @@ def main():
             result = convert_record(cursor, records[0])
             if result["success"]:
                 log_info(f"✅ Successfully converted record {args.uuid}")
+                report_collisions([result])
             else:
                 log_error(
                     f"❌ Failed to convert record {args.uuid}: {result.get('error', 'Unknown error')}"
@@ -478,45 +658,36 @@ def main():
             log_info(
                 f"🚀 Starting batch conversion of ALL {total_legacy_count} records with batch size {args.batch_size}"
             )
+            if args.workers > 1 and not args.dry_run:
+                pool = start_pool(args.workers)
 
             total_processed = 0
             total_successful = 0
             total_failed = 0
+            collided = []
             batch_number = 1
+            last_key = None  # (created_at, uuid) of the last record seen
 
             while True:
                 log_info(f"\n=== BATCH {batch_number} ===")
 
-                # Check remaining records
-                cursor.execute(count_query)
-                remaining_count = cursor.fetchone()[0]
-                log_info(f"Remaining legacy records: {remaining_count}")
-
-                if remaining_count == 0:
-                    log_info("🎉 All legacy records have been converted!")
-                    break
-
-                # Fetch next batch
-                query = """
-                    SELECT uuid, encrypted_data, large_object_oid, storage_type, filename, file_size
-                    FROM media_records
-                    WHERE encryption_method IS NULL OR encryption_method != 'aes-gcm-unified'
-                    ORDER BY created_at ASC
-                    LIMIT %s
-                """
-                cursor.execute(query, (args.batch_size,))
-                records = cursor.fetchall()
+                # Keyset page after the last record seen; failed records stay
+                # legacy but are behind the cursor, so they aren't refetched
+                records = fetch_legacy_page(cursor, args.batch_size, last_key)
 
                 if not records:
-                    log_info("No more records to process")
+                    log_info("🎉 All legacy records have been processed!")
                     break
+                last_key = (records[-1][4], records[-1][0])
+                remaining = max(total_legacy_count - total_processed, 0)
+                log_info(f"Remaining legacy records (approx.): {remaining}")
 
                 log_info(f"Processing batch of {len(records)} records...")
 
                 if args.dry_run:
                     log_info("DRY RUN - Would convert the following records:")
                     for record in records:
-                        uuid, _, _, storage_type, filename, file_size = record
+                        uuid, storage_type, filename, file_size, _ = record
                         log_info(
                             f"  - {uuid}: {filename} ({storage_type}, {file_size} bytes)"
                         )
@@ -526,7 +697,7 @@ def main():
                         f"DRY RUN: Batch {batch_number} complete - would process {len(records)} records"
                     )
                     log_info(
-                        f"DRY RUN: Overall progress: {total_processed}/{total_legacy_count} records ({(total_processed/total_legacy_count)*100:.1f}%)"
+                        f"DRY RUN: Overall progress: {total_processed}/{total_legacy_count} records ({(total_processed/max(total_legacy_count, 1))*100:.1f}%)"
                     )
 
                     batch_number += 1
@@ -536,20 +707,8 @@ def main():
                     continue
 
                 # Convert records in this batch
-                batch_results = []
-                for i, record in enumerate(records, 1):
-                    log_info(
-                        f"Processing record {i}/{len(records)}: {record[0]} ({record[4]})"
-                    )
-                    result = convert_record(cursor, record)
-                    batch_results.append(result)
-
-                    if result["success"]:
-                        log_info(f"✅ Record {i}/{len(records)} converted successfully")
-                    else:
-                        log_error(
-                            f"❌ Record {i}/{len(records)} failed: {result.get('error', 'Unknown error')}"
-                        )
+                batch_results = convert_batch(cursor, records, pool)
+                collided.extend(r for r in batch_results if r.get("collision"))
 
                 # Batch summary
                 batch_successful = len([r for r in batch_results if r["success"]])
@@ -563,7 +722,7 @@ def main():
                     f"Batch {batch_number} complete: {batch_successful} successful, {batch_failed} failed"
                 )
                 log_info(
-                    f"Overall progress: {total_processed}/{total_legacy_count} records processed ({(total_processed/total_legacy_count)*100:.1f}%)"
+                    f"Overall progress: {total_processed}/{total_legacy_count} records processed ({(total_processed/max(total_legacy_count, 1))*100:.1f}%)"
                 )
 
                 if batch_failed > 0:
@@ -580,20 +739,13 @@ def main():
             log_info(f"Total records processed: {total_processed}")
             log_info(f"Total successful: {total_successful}")
             log_info(f"Total failed: {total_failed}")
+            report_collisions(collided)
 
         else:
             # Single batch processing
             log_info(f"Processing single batch of {args.batch_size} records")
 
-            query = """
-                SELECT uuid, encrypted_data, large_object_oid, storage_type, filename, file_size
-                FROM media_records
-                WHERE encryption_method IS NULL OR encryption_method != 'aes-gcm-unified'
-                ORDER BY created_at ASC
-                LIMIT %s
-            """
-            cursor.execute(query, (args.batch_size,))
-            records = cursor.fetchall()
+            records = fetch_legacy_page(cursor, args.batch_size)
 
             if not records:
                 log_info("No legacy records found to convert")
@@ -604,34 +756,24 @@ def main():
             if args.dry_run:
                 log_info("DRY RUN - Would convert the following records:")
                 for record in records:
-                    uuid, _, _, storage_type, filename, file_size = record
+                    uuid, storage_type, filename, file_size, _ = record
                     log_info(
                         f"  - {uuid}: {filename} ({storage_type}, {file_size} bytes)"
                     )
                 return
 
             # Convert records
-            results = []
             log_info(f"Starting conversion of {len(records)} records...")
-            for i, record in enumerate(records, 1):
-                log_info(
-                    f"Processing record {i}/{len(records)}: {record[0]} ({record[4]})"
-                )
-                result = convert_record(cursor, record)
-                results.append(result)
-
-                if result["success"]:
-                    log_info(f"✅ Record {i}/{len(records)} converted successfully")
-                else:
-                    log_error(
-                        f"❌ Record {i}/{len(records)} failed: {result.get('error', 'Unknown error')}"
-                    )
+            if args.workers > 1:
+                pool = start_pool(args.workers)
+            results = convert_batch(cursor, records, pool)
 
             # Summary
             successful = len([r for r in results if r["success"]])
             failed = len([r for r in results if not r["success"]])
 
             log_info(f"Conversion complete: {successful} successful, {failed} failed")
+            report_collisions(results)
 
             if failed > 0:
                 log_error("Failed conversions:")
@@ -643,6 +785,8 @@ def main():
         log_error(f"Conversion script failed: {e}")
         sys.exit(1)
     finally:
+        if pool is not None:
+            pool.shutdown()
         if "conn" in locals():
             conn.close()
 
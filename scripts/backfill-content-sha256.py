@@ -1,31 +1,48 @@
 """Backfill media_records.content_sha256 by decrypting each row's
-encrypted_data and hashing the plaintext.
+encrypted_data (or Large Object, for storage_type = 'lob') and hashing the
+plaintext.
 
 Idempotent: only rows where content_sha256 IS NULL are touched. Pre-existing
 duplicate content is left as NULL on the later rows (the UNIQUE index would
 reject the second UPDATE) and reported at the end so the user can pick a
 canonical row to keep.
 
+Work is paged by uuid (keyset, never the full id list) and progress is
+checkpointed after every applied round, together with per-row errors, so an
+interrupted run picks up where it left off with --resume.
+
 Usage:
-  MEDIA_ENCRYPTION_KEY=... python3 backfill-content-sha256.py [--workers N] [--dry-run]
+  MEDIA_ENCRYPTION_KEY=... python3 backfill-content-sha256.py [--workers N] [--dry-run] [--resume]
 """
 
 from __future__ import annotations
 
 import argparse
 import hashlib
+import hmac
+import io
+import json
 import os
 import sys
 import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from dataclasses import dataclass
-
-import base64
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
 
 import psycopg2
-from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
+from chunk_codec import (
+    ChunkCodec,
+    ChunkLayout,
+    buffer_reader,
+    bytea_range_reader,
+    chunk_meta,
+    derive_key,
+    file_salt,
+    lob_range_reader,
+)
+
 DB_CONFIG = {
     "host": os.environ.get("DB_HOST", "localhost"),
     "port": int(os.environ.get("DB_PORT", "3432")),
@@ -40,51 +57,87 @@ PASSWORD = os.environ.get(
 )
 
 
-# ---- crypto: must match malris/server/services/chunkEncryption.ts ----
+# ---- crypto: layout and key derivation live in chunk_codec.py ----
+
+# Set by set_key(): PBKDF2 runs once in the parent and the result is handed to
+# each pool process, rather than every process re-deriving it at import.
+_DERIVED_KEY: bytes | None = None
+_CODEC: ChunkCodec | None = None
 
 
-def derive_key(password: str) -> bytes:
-    return hashlib.pbkdf2_hmac("sha256", password.encode(), b"comfy_media_salt_v1", 100_000, 32)
+def set_key(derived_key: bytes):
+    global _DERIVED_KEY, _CODEC
+    _DERIVED_KEY = derived_key
+    _CODEC = ChunkCodec(derived_key, file_salt(PASSWORD))
 
 
-def file_salt(password: str) -> bytes:
-    return hashlib.sha256((password + "file_salt").encode()).digest()
+# ---- streaming hash: decrypt straight into sha256, ~one read of memory ----
 
+FERNET_BLOCK = 1024 * 1024  # CBC ciphertext fed per step (multiple of 16)
+RANGE_THRESHOLD = 64 * 1024 * 1024  # rows above this are never fetched as one value
+RANGE_READ_SIZE = 8 * 1024 * 1024  # target bytes per substring() round trip
 
-def chunk_iv(salt: bytes, index: int) -> bytes:
-    return hashlib.sha256(salt + str(index).encode()).digest()[:16]
 
+def sha256_chunked(read, chunk_size: int, total_chunks: int, file_size: int) -> str:
+    """Whole chunks are fetched through read(offset, length) in
+    ~RANGE_READ_SIZE groups and fed to an incremental sha256. Every chunk's tag
+    is still verified before the next one counts."""
+    digest = hashlib.sha256()
+    layout = ChunkLayout(chunk_size, total_chunks, file_size)
+    for _, plaintext in _CODEC.iter_chunks(read, layout, read_size=RANGE_READ_SIZE):
+        digest.update(plaintext)
+    return digest.hexdigest()
 
-_DERIVED_KEY = derive_key(PASSWORD)
-_FILE_SALT = file_salt(PASSWORD)
-# Fernet key is the same PBKDF2-derived 32 bytes, base64url-encoded — matches
-# the FernetEncryptor in malris/server/utils/encryption.ts.
-_FERNET = Fernet(base64.urlsafe_b64encode(_DERIVED_KEY))
 
+def sha256_fernet(read, total_len: int) -> str:
+    """sha256 of a legacy 'full-file' row's plaintext. Its bytea is a raw Fernet
+    token (base64url-decoded, starts with 0x80) under the same PBKDF2 key.
+    HMAC and AES-128-CBC run over the same FERNET_BLOCK reads in one pass; the
+    HMAC is checked before padding is stripped or a hash is returned, so a
+    tampered token never yields a digest."""
+    if total_len < 57:
+        raise ValueError("not a raw Fernet token")
+    header = bytes(read(0, 25))  # psycopg2's memoryview is format 'c'; index a real bytes
+    if header[0] != 0x80:
+        raise ValueError("not a raw Fernet token")
+    signing_key, encryption_key = _DERIVED_KEY[:16], _DERIVED_KEY[16:]
+    mac = hmac.new(signing_key, digestmod=hashlib.sha256)
+    mac.update(header)
 
-def decrypt_fernet(encrypted: bytes) -> bytes:
-    """Legacy 'full-file' rows: bytea is a *raw* Fernet token (starts with 0x80).
-    The standard cryptography.Fernet API expects a base64url-encoded token, so
-    we have to re-encode the raw bytes before handing them off."""
-    return _FERNET.decrypt(base64.urlsafe_b64encode(encrypted))
+    decryptor = Cipher(algorithms.AES(encryption_key), modes.CBC(header[9:25])).decryptor()
+    unpadder = padding.PKCS7(128).unpadder()
+    digest = hashlib.sha256()
+    ct_end = total_len - 32
+    for start in range(25, ct_end, FERNET_BLOCK):
+        block = read(start, min(FERNET_BLOCK, ct_end - start))
+        mac.update(block)
+        digest.update(unpadder.update(decryptor.update(block)))
+    if not hmac.compare_digest(mac.digest(), bytes(read(ct_end, 32))):
+        raise ValueError("Fernet HMAC verification failed")
+    digest.update(unpadder.update(decryptor.finalize()) + unpadder.finalize())
+    return digest.hexdigest()
 
 
-def decrypt_chunked(encrypted: bytes, chunk_size: int, total_chunks: int, file_size: int) -> bytes:
-    out = bytearray()
-    offset = 0
-    for i in range(total_chunks):
-        plaintext_len = chunk_size if i < total_chunks - 1 else file_size - (chunk_size * (total_chunks - 1))
-        iv = encrypted[offset : offset + 16]
-        tag = encrypted[offset + 16 : offset + 32]
-        ct = encrypted[offset + 32 : offset + 32 + plaintext_len]
-        offset += 32 + plaintext_len
-        cipher = Cipher(algorithms.AES(_DERIVED_KEY), modes.GCM(iv, tag)).decryptor()
-        out.extend(cipher.update(ct) + cipher.finalize())
-    return bytes(out)
+def sha256_row(method: str, meta: dict, read, length: int) -> str:
+    if method == "aes-gcm-unified":
+        return sha256_chunked(read, meta["chunkSize"], meta["totalChunks"], meta["fileSize"])
+    if method == "full-file":
+        return sha256_fernet(read, length)
+    raise ValueError(f"unknown encryption_method={method}")
 
 
 # ---- worker ----
 
+_CONN = None  # one long-lived connection per pool process, see init_worker
+
+
+def init_worker(derived_key: bytes):
+    """ProcessPoolExecutor initializer: adopt the parent's key and open the
+    connection every worker() call in this process reuses."""
+    global _CONN
+    set_key(derived_key)
+    _CONN = psycopg2.connect(**DB_CONFIG)
+
 
 @dataclass
 class Result:
@@ -94,41 +147,154 @@ class Result:
 
 
 def worker(uuid_batch: list[str]) -> list[Result]:
-    """Each worker opens its own connection. Returns a Result per uuid.
+    """Runs in a pool process on its persistent connection. Returns a Result per uuid.
+
+    Rows are walked with a server-side cursor one at a time, so a batch never
+    materialises more than one value client-side. bytea values up to
+    RANGE_THRESHOLD come back inline; larger ones are left out of the cursor
+    and read in chunk-aligned substring() ranges instead. Large Objects are
+    streamed with lo_open/loread the same way.
 
     Does NOT do the UPDATE — the parent process does that serially so it can
     detect UNIQUE conflicts deterministically and report collisions.
     """
+    global _CONN
     results: list[Result] = []
-    conn = psycopg2.connect(**DB_CONFIG)
+    if _CONN is None or _CONN.closed:
+        _CONN = psycopg2.connect(**DB_CONFIG)
+    conn = _CONN
     try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT uuid::text, encryption_method, encryption_metadata, encrypted_data "
+        with conn.cursor(name="backfill_rows") as rows, conn.cursor() as ranges:
+            rows.itersize = 1
+            rows.execute(
+                "SELECT uuid::text, encryption_method, encryption_metadata, chunk_size, original_size, file_size, "
+                "storage_type, large_object_oid, octet_length(encrypted_data), "
+                "CASE WHEN octet_length(encrypted_data) <= %s THEN encrypted_data END "
                 "FROM media_records WHERE uuid = ANY(%s::uuid[])",
-                (uuid_batch,),
+                (RANGE_THRESHOLD, uuid_batch),
             )
-            for uuid, method, meta, enc in cur.fetchall():
+            for uuid, method, meta, chunk_size, original_size, file_size, storage, oid, length, enc in rows:
+                # A failed loread/substring aborts the transaction the named
+                # cursor lives in; the savepoint keeps the rest of the batch going.
+                ranges.execute("SAVEPOINT backfill_row")
                 try:
-                    if enc is None:
-                        results.append(Result(uuid, error="encrypted_data is NULL (LOB?)"))
-                        continue
-                    enc_bytes = bytes(enc)
                     if method == "aes-gcm-unified":
-                        plain = decrypt_chunked(enc_bytes, meta["chunkSize"], meta["totalChunks"], meta["fileSize"])
-                    elif method == "full-file":
-                        plain = decrypt_fernet(enc_bytes)
+                        meta = chunk_meta(meta, chunk_size, original_size, file_size)
+                    if storage == "lob" and oid is not None:
+                        with lob_range_reader(ranges, oid) as (read, lob_length):
+                            sha = sha256_row(method, meta, read, lob_length)
+                    elif length is not None:
+                        # psycopg2 hands inline bytea back as a memoryview; hash it in place
+                        read = buffer_reader(enc) if enc is not None else bytea_range_reader(ranges, uuid)
+                        sha = sha256_row(method, meta, read, length)
                     else:
-                        results.append(Result(uuid, error=f"unknown encryption_method={method}"))
+                        results.append(Result(uuid, error=f"no encrypted data for storage_type={storage}"))
                         continue
-                    results.append(Result(uuid, sha256_hex=hashlib.sha256(plain).hexdigest()))
+                    results.append(Result(uuid, sha256_hex=sha))
+                except psycopg2.Error as e:
+                    ranges.execute("ROLLBACK TO SAVEPOINT backfill_row")
+                    results.append(Result(uuid, error=f"{type(e).__name__}: {e}"))
                 except Exception as e:
                     results.append(Result(uuid, error=f"{type(e).__name__}: {e}"))
     finally:
-        conn.close()
+        if not conn.closed:
+            conn.rollback()  # read-only; just ends the transaction the named cursor needed
     return results
 
 
+# ---- bulk apply ----
+
+APPLY_RETRIES = 3  # a concurrent upload can claim a hash between resolve and apply
+
+
+def create_results_table(conn):
+    with conn, conn.cursor() as cur:
+        cur.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS backfill_results "
+            "(uuid uuid PRIMARY KEY, sha bytea NOT NULL, collides_with uuid)"
+        )
+
+
+def apply_results(conn, pending: list[Result]) -> tuple[int, list[tuple[str, str, str]]]:
+    """Write a batch of hashes in one transaction: COPY them into a temp table,
+    mark every row whose hash is already taken (by an existing row, or by a
+    lower uuid in the same batch) with one query against the partial unique
+    index, then UPDATE ... FROM the rest. Returns (applied, collisions)."""
+    # COPY text format unescapes \\ to \, leaving bytea's \x<hex> input form
+    buf = io.StringIO("".join(f"{r.uuid}\t\\\\x{r.sha256_hex}\n" for r in pending))
+    for attempt in range(APPLY_RETRIES):
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute("TRUNCATE backfill_results")
+                buf.seek(0)
+                cur.copy_expert("COPY backfill_results (uuid, sha) FROM STDIN WITH (FORMAT text)", buf)
+                cur.execute(
+                    "UPDATE backfill_results r SET collides_with = coalesce(m.uuid, w.winner) "
+                    "FROM (SELECT DISTINCT ON (sha) sha, uuid AS winner FROM backfill_results ORDER BY sha, uuid) w "
+                    "LEFT JOIN media_records m ON m.content_sha256 = w.sha "
+                    "WHERE r.sha = w.sha AND (m.uuid IS NOT NULL OR r.uuid <> w.winner)"
+                )
+                cur.execute(
+                    "UPDATE media_records m SET content_sha256 = r.sha FROM backfill_results r "
+                    "WHERE m.uuid = r.uuid AND r.collides_with IS NULL AND m.content_sha256 IS NULL"
+                )
+                applied = cur.rowcount
+                cur.execute(
+                    "SELECT uuid::text, collides_with::text, encode(sha, 'hex') "
+                    "FROM backfill_results WHERE collides_with IS NOT NULL ORDER BY uuid"
+                )
+                return applied, cur.fetchall()
+        except psycopg2.errors.UniqueViolation:
+            if attempt == APPLY_RETRIES - 1:
+                raise
+
+
+# ---- checkpoint ----
+
+CHECKPOINT_PATH = "/tmp/dop-dedup-backfill-checkpoint.json"
+PENDING_SQL = "content_sha256 IS NULL AND storage_type IN ('bytea', 'lob')"
+
+
+@dataclass
+class Checkpoint:
+    last_seen: str | None = None  # every uuid <= this has been hashed and applied
+    errors: dict[str, str] = field(default_factory=dict)  # uuid -> message, across runs
+
+    @classmethod
+    def load(cls, path: str) -> Checkpoint:
+        try:
+            with open(path) as f:
+                return cls(**json.load(f))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, path: str):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"last_seen": self.last_seen, "errors": self.errors}, f)
+        os.replace(tmp, path)
+
+
+def iter_batches(conn, batch_size: int, after: str | None, limit: int | None):
+    """Keyset pages of pending uuids in uuid order, one worker batch per query."""
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        with conn, conn.cursor() as cur:
+            cur.execute(
+                f"SELECT uuid::text FROM media_records WHERE {PENDING_SQL} "
+                "AND (%s::uuid IS NULL OR uuid > %s::uuid) ORDER BY uuid LIMIT %s",
+                (after, after, size),
+            )
+            batch = [r[0] for r in cur.fetchall()]
+        if not batch:
+            return
+        yield batch
+        after = batch[-1]
+        if remaining is not None:
+            remaining -= len(batch)
+
+
 # ---- driver ----
 
 
@@ -136,67 +302,104 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--workers", type=int, default=8)
     parser.add_argument("--batch-size", type=int, default=50, help="uuids per worker invocation")
+    parser.add_argument("--apply-batch", type=int, default=1000, help="hashes written per COPY + UPDATE round")
     parser.add_argument("--dry-run", action="store_true", help="compute hashes but don't UPDATE")
     parser.add_argument("--limit", type=int, default=None, help="process at most N rows (testing)")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="progress + per-row error file")
+    parser.add_argument("--resume", action="store_true", help="continue after the checkpoint's last uuid")
     args = parser.parse_args()
 
+    checkpoint = Checkpoint.load(args.checkpoint) if args.resume else Checkpoint()
     conn = psycopg2.connect(**DB_CONFIG)
-    conn.autocommit = True  # UPDATE per row so a conflict on one doesn't poison the rest
-    with conn.cursor() as cur:
-        sql = "SELECT uuid::text FROM media_records WHERE content_sha256 IS NULL AND storage_type = 'bytea'"
-        if args.limit:
-            sql += f" LIMIT {args.limit}"
-        cur.execute(sql)
-        all_uuids = [r[0] for r in cur.fetchall()]
-
-    total = len(all_uuids)
-    print(f"to backfill: {total} rows  |  workers={args.workers}  |  batch={args.batch_size}  |  dry_run={args.dry_run}")
+    with conn, conn.cursor() as cur:
+        cur.execute(
+            f"SELECT count(*) FROM media_records WHERE {PENDING_SQL} AND (%s::uuid IS NULL OR uuid > %s::uuid)",
+            (checkpoint.last_seen, checkpoint.last_seen),
+        )
+        total = cur.fetchone()[0]
+    if args.limit:
+        total = min(total, args.limit)
+
+    resumed = f"  |  resuming after {checkpoint.last_seen}" if checkpoint.last_seen else ""
+    print(f"to backfill: {total} rows  |  workers={args.workers}  |  batch={args.batch_size}  |  dry_run={args.dry_run}{resumed}")
     if total == 0:
         return
 
-    batches = [all_uuids[i : i + args.batch_size] for i in range(0, total, args.batch_size)]
-
     backfilled = 0
     collisions: list[tuple[str, str, str]] = []  # (new_uuid, existing_uuid, sha)
     errors: list[tuple[str, str]] = []
+    pending: list[Result] = []
     started = time.monotonic()
-
-    with ProcessPoolExecutor(max_workers=args.workers) as pool, conn.cursor() as cur:
-        futures = [pool.submit(worker, batch) for batch in batches]
+    if not args.dry_run:
+        create_results_table(conn)
+
+    # Batches finish out of order; the checkpoint only advances over the
+    # contiguous prefix of finished ones, and only once they're applied.
+    batch_ends: list[str] = []
+    finished: set[int] = set()
+    watermark = 0
+
+    def flush():
+        nonlocal backfilled, watermark
+        if args.dry_run:
+            backfilled += len(pending)
+            pending.clear()
+            return
+        if pending:
+            applied, batch_collisions = apply_results(conn, pending)
+            backfilled += applied
+            collisions.extend(batch_collisions)
+            pending.clear()
+        while watermark in finished:
+            watermark += 1
+        if watermark:
+            checkpoint.last_seen = batch_ends[watermark - 1]
+        checkpoint.save(args.checkpoint)
+
+    batches = iter_batches(conn, args.batch_size, checkpoint.last_seen, args.limit)
+    derived_key = derive_key(PASSWORD)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(derived_key,)) as pool:
+        inflight = {}  # future -> index into batch_ends
+
+        def submit_next():
+            batch = next(batches, None)
+            if batch is not None:
+                inflight[pool.submit(worker, batch)] = len(batch_ends)
+                batch_ends.append(batch[-1])
+
+        for _ in range(args.workers * 2):
+            submit_next()
         last_report = started
-        for fut in as_completed(futures):
-            for r in fut.result():
-                if r.error:
-                    errors.append((r.uuid, r.error))
-                    continue
-                sha_bytes = bytes.fromhex(r.sha256_hex)
-                if args.dry_run:
-                    backfilled += 1
-                    continue
-                try:
-                    cur.execute(
-                        "UPDATE media_records SET content_sha256 = %s "
-                        "WHERE uuid = %s AND content_sha256 IS NULL",
-                        (sha_bytes, r.uuid),
-                    )
-                    backfilled += 1
-                except psycopg2.errors.UniqueViolation:
-                    # Another row already has this hash. Look up the canonical
-                    # uuid so the user can decide what to do with this dup.
-                    cur.execute(
-                        "SELECT uuid::text FROM media_records WHERE content_sha256 = %s LIMIT 1",
-                        (sha_bytes,),
-                    )
-                    existing = cur.fetchone()
-                    collisions.append((r.uuid, existing[0] if existing else "?", r.sha256_hex))
-            now = time.monotonic()
-            if now - last_report >= 5.0:
-                elapsed = now - started
-                rate = (backfilled + len(collisions) + len(errors)) / max(elapsed, 0.001)
-                done = backfilled + len(collisions) + len(errors)
-                eta = (total - done) / max(rate, 0.001)
-                print(f"  progress: {done}/{total}  rate={rate:.0f}/s  eta={eta:.0f}s  collisions={len(collisions)}  errors={len(errors)}")
-                last_report = now
+        try:
+            while inflight:
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    finished.add(inflight.pop(fut))
+                    for r in fut.result():
+                        if r.error:
+                            errors.append((r.uuid, r.error))
+                            checkpoint.errors[r.uuid] = r.error
+                        else:
+                            checkpoint.errors.pop(r.uuid, None)
+                            pending.append(r)
+                    submit_next()
+                if len(pending) >= args.apply_batch:
+                    flush()
+                now = time.monotonic()
+                if now - last_report >= 5.0:
+                    elapsed = now - started
+                    done_rows = backfilled + len(collisions) + len(errors) + len(pending)
+                    rate = done_rows / max(elapsed, 0.001)
+                    eta = (total - done_rows) / max(rate, 0.001)
+                    print(f"  progress: {done_rows}/{total}  rate={rate:.0f}/s  eta={eta:.0f}s  collisions={len(collisions)}  errors={len(errors)}")
+                    last_report = now
+        except KeyboardInterrupt:
+            for fut in inflight:
+                fut.cancel()
+            flush()
+            print(f"\ninterrupted — checkpoint at {checkpoint.last_seen}, rerun with --resume")
+            sys.exit(130)
+        flush()
 
     elapsed = time.monotonic() - started
     print()
@@ -224,6 +427,8 @@ def main():
         print("errors — first 10:")
         for uu, msg in errors[:10]:
             print(f"  {uu}: {msg}")
+    if checkpoint.errors and not args.dry_run:
+        print(f"  all {len(checkpoint.errors)} errored rows (this and resumed runs): {args.checkpoint}")
 
     if errors:
         sys.exit(2)
@@ -0,0 +1,430 @@
+"""AES-GCM chunk codec shared by the offline tools in this directory.
+
+Python twin of malris/server/services/chunkEncryption.ts. Each chunk is stored
+as IV (16) + AuthTag (16) + ciphertext, IVs are derived from the chunk index,
+so every chunk sits at a fixed offset and can be located and decrypted on its
+own. ChunkLayout is that offset index; ChunkCodec decrypts arbitrary byte
+ranges (decrypt_range, the counterpart of decryptChunkRange) or streams whole
+chunks (iter_chunks) without materialising the file.
+
+Cross-language vectors live in chunk_codec_vectors.json and are checked by
+both implementations:
+  python3 chunk_codec.py --check-vectors
+  npx tsx scripts/test_chunk_codec_vectors.ts
+"""
+
+from __future__ import annotations
+
+import argparse
+import functools
+import hashlib
+import json
+import os
+import sys
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator
+
+import psycopg2
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+KEY_SALT = b"comfy_media_salt_v1"
+KDF_ITERATIONS = 100_000
+CHUNK_OVERHEAD = 32  # IV (16) + AuthTag (16)
+
+CHUNKING_THRESHOLD = 1024 * 1024  # 1MB
+SMALL_FILE_CHUNK_SIZE = 64 * 1024  # 64KB
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # 1MB
+READ_SIZE = 8 * 1024 * 1024  # target bytes per read() call in iter_chunks
+LOB_WRITE_SIZE = 8 * 1024 * 1024  # bytes coalesced per lowrite in lob_writer
+
+VECTORS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chunk_codec_vectors.json")
+
+Reader = Callable[[int, int], "bytes | memoryview"]
+
+
+# ---- key material: must match chunkEncryption.ts ----
+
+
+@functools.lru_cache(maxsize=None)
+def derive_key(password: str) -> bytes:
+    """PBKDF2-SHA256 AES-256 key (cached per process)."""
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), KEY_SALT, KDF_ITERATIONS, 32)
+
+
+@functools.lru_cache(maxsize=None)
+def file_salt(password: str) -> bytes:
+    return hashlib.sha256((password + "file_salt").encode()).digest()
+
+
+def chunk_iv(salt: bytes, index: int) -> bytes:
+    return hashlib.sha256(salt + str(index).encode()).digest()[:16]
+
+
+def key_id(key: bytes) -> str:
+    """Public fingerprint of a derived key, stored as encryption_metadata.keyId
+    so tools can tell which key a row is encrypted under."""
+    return hashlib.sha256(b"comfy_media_key_id" + key).hexdigest()[:16]
+
+
+def get_optimal_chunk_size(file_size: int) -> int:
+    if file_size <= CHUNKING_THRESHOLD:
+        return SMALL_FILE_CHUNK_SIZE
+    return DEFAULT_CHUNK_SIZE
+
+
+# ---- storage readers: read(offset, length) over where media_records keeps a blob ----
+
+
+def buffer_reader(encrypted) -> Reader:
+    """read(offset, length) over bytes, a memoryview (psycopg2's bytea) or an mmap."""
+    view = memoryview(encrypted)
+    return lambda offset, length: view[offset : offset + length]
+
+
+def bytea_range_reader(cur, uuid: str):
+    """read(offset, length) that pulls one slice of encrypted_data per query.
+    Encrypted bytes don't compress, so the value is stored uncompressed in
+    TOAST and Postgres only detoasts the requested slice."""
+
+    def read(offset: int, length: int):
+        cur.execute(
+            "SELECT substring(encrypted_data from %s for %s) FROM media_records WHERE uuid = %s",
+            (offset + 1, length, uuid),  # substring() is 1-based
+        )
+        return memoryview(cur.fetchone()[0])
+
+    return read
+
+
+@contextmanager
+def lob_range_reader(cur, oid: int):
+    """Yields (read, length) over a Large Object opened with lo_open. Reads are
+    sequential and chunk-aligned, so lo_lseek64 only runs when a caller jumps.
+    The descriptor lives in the caller's transaction and is closed on exit."""
+    cur.execute("SELECT lo_open(%s, %s)", (oid, 262144))  # Read mode
+    fd = cur.fetchone()[0]
+    try:
+        cur.execute("SELECT lo_lseek64(%s, 0, 2)", (fd,))  # SEEK_END
+        length = cur.fetchone()[0]
+        position = length
+
+        def read(offset: int, n: int):
+            nonlocal position
+            if offset != position:
+                cur.execute("SELECT lo_lseek64(%s, %s, 0)", (fd, offset))  # SEEK_SET
+            cur.execute("SELECT loread(%s, %s)", (fd, n))
+            data = memoryview(cur.fetchone()[0])
+            position = offset + len(data)
+            return data
+
+        yield read, length
+    finally:
+        # an aborted transaction already dropped the descriptor; closing would mask the real error
+        if cur.connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            cur.execute("SELECT lo_close(%s)", (fd,))
+
+
+@contextmanager
+def row_reader(cur, uuid: str, storage: str, oid: int | None, length: int | None):
+    """(read, length) over a row's ciphertext, wherever it is stored."""
+    if storage == "lob":
+        with lob_range_reader(cur, oid) as reader:
+            yield reader
+    else:
+        yield bytea_range_reader(cur, uuid), length
+
+
+@contextmanager
+def lob_writer(cur):
+    """Yields (oid, write, checksum) for a new Large Object created in the
+    caller's transaction. write(data) takes pieces of any size and coalesces
+    them into ~LOB_WRITE_SIZE lowrite calls; the rest is flushed and the
+    descriptor closed on exit. checksum is a sha256 of everything written, the
+    media_records.checksum of the new ciphertext. If the transaction rolls
+    back the object goes with it."""
+    cur.execute("SELECT lo_create(0)")
+    oid = cur.fetchone()[0]
+    cur.execute("SELECT lo_open(%s, %s)", (oid, 131072))  # Write mode
+    fd = cur.fetchone()[0]
+    pending = bytearray()
+    checksum = hashlib.sha256()
+
+    def write(data):
+        checksum.update(data)
+        pending.extend(data)
+        if len(pending) >= LOB_WRITE_SIZE:
+            cur.execute("SELECT lowrite(%s, %s)", (fd, pending))
+            pending.clear()
+
+    yield oid, write, checksum
+    if pending:
+        cur.execute("SELECT lowrite(%s, %s)", (fd, pending))
+    cur.execute("SELECT lo_close(%s)", (fd,))
+
+
+# ---- offset index ----
+
+
+def chunk_meta(meta, chunk_size, original_size, file_size) -> dict:
+    """encryption_metadata, or the same fallback hybridMediaStorage.ts builds
+    from the table columns for rows written before that column existed."""
+    if meta:
+        return meta
+    size = int(original_size or file_size)
+    chunk_size = chunk_size or 1048576
+    return {"chunkSize": chunk_size, "totalChunks": -(-size // chunk_size), "fileSize": size}
+
+
+@dataclass(frozen=True)
+class ChunkLayout:
+    """Where every chunk of an aes-gcm-unified blob lives. All chunks but the
+    last hold chunk_size plaintext bytes, so offsets are pure arithmetic."""
+
+    chunk_size: int
+    total_chunks: int
+    file_size: int
+
+    @classmethod
+    def from_metadata(cls, meta: dict) -> ChunkLayout:
+        return cls(int(meta["chunkSize"]), int(meta["totalChunks"]), int(meta["fileSize"]))
+
+    @classmethod
+    def for_size(cls, file_size: int, chunk_size: int | None = None) -> ChunkLayout:
+        chunk_size = chunk_size or get_optimal_chunk_size(file_size)
+        return cls(chunk_size, -(-file_size // chunk_size), file_size)
+
+    def metadata(self) -> dict:
+        return {
+            "chunkSize": self.chunk_size,
+            "totalChunks": self.total_chunks,
+            "encryptionMethod": "aes-gcm-unified",
+            "fileSize": self.file_size,
+        }
+
+    @property
+    def encrypted_size(self) -> int:
+        return self.file_size + CHUNK_OVERHEAD * self.total_chunks
+
+    def plaintext_size(self, index: int) -> int:
+        if index < self.total_chunks - 1:
+            return self.chunk_size
+        return self.file_size - self.chunk_size * (self.total_chunks - 1)
+
+    def encrypted_offset(self, index: int) -> int:
+        return index * (self.chunk_size + CHUNK_OVERHEAD)
+
+    def chunk_of(self, byte: int) -> int:
+        return byte // self.chunk_size
+
+    def encrypted_span(self, first: int, last: int) -> tuple[int, int]:
+        """(offset, length) of chunks first..last inclusive in the encrypted blob."""
+        start = self.encrypted_offset(first)
+        end = self.encrypted_offset(last) + self.plaintext_size(last) + CHUNK_OVERHEAD
+        return start, end - start
+
+
+# ---- codec ----
+
+
+class ChunkCodec:
+    """Encrypts and decrypts chunks with one derived key and file salt."""
+
+    def __init__(self, key: bytes, salt: bytes):
+        self.key = key
+        self.salt = salt
+        self.key_id = key_id(key)
+
+    @classmethod
+    def for_password(cls, password: str) -> ChunkCodec:
+        return cls(derive_key(password), file_salt(password))
+
+    def encrypt_chunk(self, index: int, plaintext) -> bytes:
+        iv = chunk_iv(self.salt, index)
+        encryptor = Cipher(algorithms.AES(self.key), modes.GCM(iv)).encryptor()
+        ct = encryptor.update(plaintext) + encryptor.finalize()
+        return iv + encryptor.tag + ct
+
+    def encrypt(self, data, chunk_size: int | None = None) -> tuple[bytes, ChunkLayout]:
+        layout = ChunkLayout.for_size(len(data), chunk_size)
+        view = memoryview(data)
+        out = b"".join(
+            self.encrypt_chunk(i, view[i * layout.chunk_size : (i + 1) * layout.chunk_size])
+            for i in range(layout.total_chunks)
+        )
+        return out, layout
+
+    def decrypt_chunk_into(self, chunk, out) -> int:
+        """Decrypt one IV + tag + ciphertext chunk into out, which needs 15
+        spare bytes past the plaintext (update_into's block_size - 1). The tag
+        is verified (InvalidTag) before the byte count is returned."""
+        chunk = memoryview(chunk)
+        decryptor = Cipher(
+            algorithms.AES(self.key), modes.GCM(bytes(chunk[:16]), bytes(chunk[16:32]))
+        ).decryptor()
+        n = decryptor.update_into(chunk[CHUNK_OVERHEAD:], out)
+        decryptor.finalize()
+        return n
+
+    def iter_chunks(
+        self, read: Reader, layout: ChunkLayout, first: int = 0, last: int | None = None, read_size: int = READ_SIZE
+    ) -> Iterator[tuple[int, memoryview]]:
+        """Yield (index, plaintext) for chunks first..last inclusive. Whole
+        chunks are fetched through read(offset, length) in ~read_size groups
+        and decrypted into one reused buffer: each plaintext view is only valid
+        until the next iteration."""
+        last = layout.total_chunks - 1 if last is None else last
+        buf = bytearray(layout.chunk_size + 15)
+        per_read = max(1, read_size // (layout.chunk_size + CHUNK_OVERHEAD))
+        for group in range(first, last + 1, per_read):
+            group_last = min(group + per_read - 1, last)
+            offset, wanted = layout.encrypted_span(group, group_last)
+            view = memoryview(read(offset, wanted))
+            if len(view) != wanted:
+                raise ValueError(f"chunks {group}-{group_last} truncated: {len(view)} of {wanted} bytes")
+            pos = 0
+            for i in range(group, group_last + 1):
+                size = layout.plaintext_size(i) + CHUNK_OVERHEAD
+                n = self.decrypt_chunk_into(view[pos : pos + size], buf)
+                pos += size
+                yield i, memoryview(buf)[:n]
+
+    def verify_chunks(self, read: Reader, layout: ChunkLayout, count: int | None = None, read_size: int = READ_SIZE) -> list[int]:
+        """Check the auth tag of the first count chunks (default: all) and
+        return the indexes that fail. Unlike iter_chunks a bad chunk doesn't
+        stop the walk, so one pass finds every damaged chunk."""
+        count = layout.total_chunks if count is None else count
+        buf = bytearray(layout.chunk_size + 15)
+        per_read = max(1, read_size // (layout.chunk_size + CHUNK_OVERHEAD))
+        bad = []
+        for group in range(0, count, per_read):
+            group_last = min(group + per_read, count) - 1
+            offset, wanted = layout.encrypted_span(group, group_last)
+            view = memoryview(read(offset, wanted))
+            pos = 0
+            for i in range(group, group_last + 1):
+                size = layout.plaintext_size(i) + CHUNK_OVERHEAD
+                try:
+                    self.decrypt_chunk_into(view[pos : pos + size], buf)
+                except InvalidTag:
+                    bad.append(i)
+                pos += size
+        return bad
+
+    def decrypt_range(self, encrypted, layout: ChunkLayout, start: int, end: int) -> memoryview:
+        """Plaintext bytes start..end inclusive, like decryptChunkRange, except
+        encrypted is the whole blob (bytes, memoryview or mmap) and located via
+        the layout. Only the covering chunks are touched; they decrypt straight
+        into one buffer and a view of the requested slice is returned."""
+        if start < 0 or start >= layout.file_size:
+            raise ValueError(f"start {start} outside 0..{layout.file_size - 1}")
+        end = min(end, layout.file_size - 1)
+        if end < start:
+            raise ValueError(f"end {end} before start {start}")
+        first, last = layout.chunk_of(start), layout.chunk_of(end)
+        offset, length = layout.encrypted_span(first, last)
+        view = memoryview(encrypted)[offset : offset + length]
+        if len(view) != length:
+            raise ValueError(f"chunks {first}-{last} truncated: {len(view)} of {length} bytes")
+        out = bytearray(length - CHUNK_OVERHEAD * (last - first + 1) + 15)
+        target = memoryview(out)
+        pos = written = 0
+        for i in range(first, last + 1):
+            size = layout.plaintext_size(i) + CHUNK_OVERHEAD
+            written += self.decrypt_chunk_into(view[pos : pos + size], target[written:])
+            pos += size
+        base = first * layout.chunk_size
+        return target[start - base : end - base + 1]
+
+
+class ChunkEncryptor:
+    """Incremental encryption: feed plaintext in any sized pieces, get back
+    whole IV + AuthTag + ciphertext chunks as they fill up. The plaintext
+    SHA256 (content_sha256) is accumulated on the way through."""
+
+    def __init__(self, codec: ChunkCodec, chunk_size: int):
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.total_chunks = 0
+        self.file_size = 0
+        self.sha256 = hashlib.sha256()
+        self._pending = bytearray()
+
+    def _encrypt_chunk(self, chunk) -> bytes:
+        out = self.codec.encrypt_chunk(self.total_chunks, chunk)
+        self.total_chunks += 1
+        self.file_size += len(chunk)
+        self.sha256.update(chunk)
+        return out
+
+    def update(self, data) -> bytes:
+        self._pending += data
+        out = []
+        while len(self._pending) >= self.chunk_size:
+            out.append(self._encrypt_chunk(bytes(self._pending[: self.chunk_size])))
+            del self._pending[: self.chunk_size]
+        return b"".join(out)
+
+    def finalize(self) -> bytes:
+        out = self._encrypt_chunk(bytes(self._pending)) if self._pending else b""
+        self._pending.clear()
+        return out
+
+    def metadata(self) -> dict:
+        return ChunkLayout(self.chunk_size, self.total_chunks, self.file_size).metadata()
+
+
+# ---- cross-language vectors ----
+
+
+def vector_plaintext(length: int) -> bytes:
+    """Deterministic plaintext shared with test_chunk_codec_vectors.ts."""
+    return bytes((i * 31 + 7) & 0xFF for i in range(length))
+
+
+def check_vectors(path: str = VECTORS_PATH) -> int:
+    with open(path) as f:
+        vectors = json.load(f)
+    failures = 0
+
+    def expect(name, what, got, want):
+        nonlocal failures
+        if got != want:
+            failures += 1
+            print(f"FAIL {name}: {what} {got} != {want}")
+
+    for case in vectors["cases"]:
+        name = case["name"]
+        before = failures
+        codec = ChunkCodec.for_password(case["password"])
+        expect(name, "derived key", codec.key.hex(), case["derivedKey"])
+        plaintext = vector_plaintext(case["fileSize"])
+        encrypted, layout = codec.encrypt(plaintext, case.get("chunkSize"))
+        expect(name, "metadata", layout.metadata(), case["metadata"])
+        expect(name, "encrypted sha256", hashlib.sha256(encrypted).hexdigest(), case["encryptedSha256"])
+        expect(name, "encrypted head", encrypted[:64].hex(), case["encryptedHead"])
+        streamed = hashlib.sha256()
+        for _, chunk in codec.iter_chunks(buffer_reader(encrypted), layout, read_size=3 * layout.chunk_size):
+            streamed.update(chunk)
+        expect(name, "plaintext sha256", streamed.hexdigest(), case["plaintextSha256"])
+        for r in case["ranges"]:
+            got = codec.decrypt_range(encrypted, layout, r["start"], r["end"])
+            expect(name, f"range {r['start']}-{r['end']}", hashlib.sha256(got).hexdigest(), r["sha256"])
+        print(f"{'ok  ' if failures == before else 'FAIL'} {name}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AES-GCM chunk codec self-check")
+    parser.add_argument("--check-vectors", nargs="?", const=VECTORS_PATH, metavar="PATH", required=True)
+    args = parser.parse_args()
+    failures = check_vectors(args.check_vectors)
+    if failures:
+        print(f"{failures} mismatches")
+        sys.exit(1)
+    print("all vectors match")
+
+
+if __name__ == "__main__":
+    main()
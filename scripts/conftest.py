@@ -0,0 +1,35 @@
+"""
+Shared pytest setup for the checks in scripts/.
+
+The maintenance scripts are run as files: their names are hyphenated and
+they import siblings such as chunk_codec from their own directory. Tests
+load them by path through the load_script fixture instead of importing them.
+"""
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPTS_DIR)  # what `python3 scripts/<name>.py` puts on sys.path
+
+
+@pytest.fixture(scope="session")
+def load_script():
+    """load_script("backfill-content-sha256.py") -> that script as a module,
+    executed once per session."""
+    loaded = {}
+
+    def load(filename: str):
+        if filename not in loaded:
+            name = os.path.splitext(filename)[0].replace("-", "_")
+            spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPTS_DIR, filename))
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[name] = module  # dataclasses resolve annotations through sys.modules
+            spec.loader.exec_module(module)
+            loaded[filename] = module
+        return loaded[filename]
+
+    return load
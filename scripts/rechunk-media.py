@@ -0,0 +1,331 @@
+"""Rewrite aes-gcm-unified media to one chunk size, chunk by chunk.
+
+Rows carry whatever chunk size wrote them: 64KB from getOptimalChunkSize for
+files up to 1MB, converter-era choices, or the 1MB fallback rebuilt from the
+chunk_size column when encryption_metadata is missing. /api/stream serves
+ranges of at most 4MB. streamMedia decrypts every chunk a range touches, so
+small chunks cost one GCM setup each, and chunks that straddle a range
+boundary are read and decrypted for bytes the response doesn't contain.
+
+This tool re-encrypts multi-chunk rows whose chunkSize differs from
+--chunk-size. The default is 1MB, a divisor of the 4MB range, so sequential
+ranges never straddle a chunk. Rows without encryption_metadata are rewritten
+too, so they get explicit metadata. Plaintext is streamed through
+ChunkEncryptor into a new Large Object; bytea rows copy it back server-side
+with lo_get. Each row is rewritten in its own transaction. Rows already at the
+target size drop out of the query, so a rerun resumes.
+
+For every row the report lists the streaming overhead before and after, for
+a player walking the file in sequential --range-size requests:
+  chunks/request  GCM chunk decryptions per request
+  read amp        encrypted bytes read per plaintext byte served
+
+Usage:
+  MEDIA_ENCRYPTION_KEY=... python3 rechunk-media.py [--chunk-size 1048576] [--workers N] [--dry-run]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+
+import psycopg2
+from cryptography.exceptions import InvalidTag
+
+from chunk_codec import (
+    DEFAULT_CHUNK_SIZE,
+    ChunkCodec,
+    ChunkEncryptor,
+    ChunkLayout,
+    chunk_meta,
+    derive_key,
+    file_salt,
+    lob_writer,
+    row_reader,
+)
+
+DB_CONFIG = {
+    "host": os.environ.get("DB_HOST", "localhost"),
+    "port": int(os.environ.get("DB_PORT", "3432")),
+    "dbname": os.environ.get("DB_NAME", "comfy_media"),
+    "user": os.environ.get("DB_USER", "comfy_user"),
+    "password": os.environ.get("DB_PASSWORD", "comfy_secure_password_2024"),
+}
+
+PASSWORD = os.environ.get(
+    "MEDIA_ENCRYPTION_KEY",
+    "K8mF3vN9pQ2sT6wY0zC4eH7jL1nP5rU8xA3dG6iK9mO2qT5wZ8cF1hJ4lN7pS0vY",
+)
+
+STREAM_RANGE_SIZE = 4 * 1024 * 1024  # MAX_CHUNK_SIZE in server/api/stream/[uuid].get.ts
+REPORT_PATH = "/tmp/media-rechunk-report.tsv"
+# %s is the target chunk size; single-chunk rows gain nothing from a rewrite
+PENDING_SQL = (
+    "encryption_method = 'aes-gcm-unified' AND storage_type IN ('bytea', 'lob') "
+    "AND (encryption_metadata IS NULL OR (encryption_metadata->>'chunkSize' IS DISTINCT FROM %s "
+    "AND encryption_metadata->>'totalChunks' NOT IN ('0', '1')))"
+)
+
+
+def streaming_overhead(layout: ChunkLayout, range_size: int) -> tuple[float, float]:
+    """(chunks decrypted per request, encrypted bytes read per byte served)
+    for sequential range_size requests from byte 0, the way a <video> element
+    walks a file through /api/stream."""
+    if layout.file_size == 0:
+        return 0.0, 0.0
+    requests = chunks = read = 0
+    for start in range(0, layout.file_size, range_size):
+        first = layout.chunk_of(start)
+        last = layout.chunk_of(min(start + range_size, layout.file_size) - 1)
+        chunks += last - first + 1
+        read += layout.encrypted_span(first, last)[1]
+        requests += 1
+    return chunks / requests, read / layout.file_size
+
+
+@dataclass
+class Result:
+    uuid: str
+    status: str  # rechunked | planned | skipped | error
+    detail: str | None = None
+    storage_type: str | None = None
+    file_size: int = 0
+    before: tuple[int, float, float] | None = None  # (chunkSize, chunks/request, read amp)
+    after: tuple[int, float, float] | None = None
+
+
+# ---- per row ----
+
+_CONN = None  # one long-lived connection per pool process, see init_worker
+_CODEC: ChunkCodec | None = None
+
+
+def init_worker(derived_key: bytes):
+    """ProcessPoolExecutor initializer: adopt the parent's key and open the
+    connection every worker() call in this process reuses."""
+    global _CONN, _CODEC
+    _CODEC = ChunkCodec(derived_key, file_salt(PASSWORD))
+    _CONN = psycopg2.connect(**DB_CONFIG)
+
+
+def rechunk_row(conn, uuid: str, chunk_size: int, range_size: int, dry_run: bool) -> Result:
+    """Rewrite one row at chunk_size in its own transaction. The row is locked
+    for the duration; a replaced Large Object is unlinked only after the commit."""
+    with conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT storage_type, large_object_oid, encryption_metadata, chunk_size, original_size, file_size, "
+            "content_sha256, octet_length(encrypted_data) FROM media_records "
+            "WHERE uuid = %s AND encryption_method = 'aes-gcm-unified' FOR UPDATE",
+            (uuid,),
+        )
+        row = cur.fetchone()
+        if row is None:
+            return Result(uuid, "skipped", "no longer an aes-gcm-unified row")
+        storage, oid, meta, column_chunk_size, original_size, file_size, content_sha256, length = row
+        had_metadata = bool(meta)
+        meta = chunk_meta(meta, column_chunk_size, original_size, file_size)
+        layout = ChunkLayout.from_metadata(meta)
+        target = ChunkLayout.for_size(layout.file_size, chunk_size)
+        result = Result(
+            uuid,
+            "planned" if dry_run else "rechunked",
+            storage_type=storage,
+            file_size=layout.file_size,
+            before=(layout.chunk_size, *streaming_overhead(layout, range_size)),
+            after=(target.chunk_size, *streaming_overhead(target, range_size)),
+        )
+        if had_metadata and (layout.chunk_size == chunk_size or layout.total_chunks <= 1):
+            result.status = "skipped"
+            return result
+        if dry_run:
+            return result
+
+        encryptor = ChunkEncryptor(_CODEC, chunk_size)
+        with row_reader(cur, uuid, storage, oid, length) as (read, length):
+            if length != layout.encrypted_size:
+                raise ValueError(f"blob is {length} bytes, encryption_metadata implies {layout.encrypted_size}")
+            with lob_writer(cur) as (new_oid, write, checksum):
+                for _, plaintext in _CODEC.iter_chunks(read, layout):
+                    write(encryptor.update(plaintext))
+                write(encryptor.finalize())
+
+        if content_sha256 is not None and encryptor.sha256.digest() != bytes(content_sha256):
+            raise ValueError("decrypted content doesn't match content_sha256")
+        # keep anything else in the metadata (keyId) and replace the layout
+        new_meta = {**meta, **encryptor.metadata()}
+        # hybridMediaStorage.ts writes the encrypted length to original_size as well; keep that in step
+        if original_size == layout.encrypted_size:
+            original_size = target.encrypted_size
+        if storage == "lob":
+            cur.execute(
+                "UPDATE media_records SET large_object_oid = %s, file_size = %s, original_size = %s, checksum = %s, "
+                "chunk_size = %s, encryption_metadata = %s, updated_at = NOW() WHERE uuid = %s",
+                (new_oid, target.encrypted_size, original_size, checksum.hexdigest(), chunk_size,
+                 json.dumps(new_meta), uuid),
+            )
+        else:
+            cur.execute(
+                "UPDATE media_records SET encrypted_data = lo_get(%s), file_size = %s, original_size = %s, "
+                "checksum = %s, chunk_size = %s, encryption_metadata = %s, updated_at = NOW() WHERE uuid = %s",
+                (new_oid, target.encrypted_size, original_size, checksum.hexdigest(), chunk_size,
+                 json.dumps(new_meta), uuid),
+            )
+            cur.execute("SELECT lo_unlink(%s)", (new_oid,))
+
+    if storage == "lob":
+        # If this fails the old object is only orphaned; cleanup_orphaned_large_objects() (migration 004) collects it
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute("SELECT lo_unlink(%s)", (oid,))
+        except psycopg2.Error as e:
+            result.detail = f"old large object {oid} left orphaned: {e}".strip()
+    return result
+
+
+def worker(uuid_batch: list[str], chunk_size: int, range_size: int, dry_run: bool) -> list[Result]:
+    global _CONN
+    if _CONN is None or _CONN.closed:
+        _CONN = psycopg2.connect(**DB_CONFIG)
+    results = []
+    for uuid in uuid_batch:
+        try:
+            results.append(rechunk_row(_CONN, uuid, chunk_size, range_size, dry_run))
+        except InvalidTag:
+            results.append(Result(uuid, "error", "a chunk fails authentication; see scrub-media-integrity.py"))
+        except Exception as e:
+            results.append(Result(uuid, "error", f"{type(e).__name__}: {e}".strip()))
+    return results
+
+
+def iter_batches(conn, chunk_size: int, batch_size: int, limit: int | None):
+    """Keyset pages of rows not yet at chunk_size, in uuid order. Rows that
+    error are passed over for this run and retried by the next one."""
+    after = None
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        with conn, conn.cursor() as cur:
+            cur.execute(
+                f"SELECT uuid::text FROM media_records WHERE {PENDING_SQL} "
+                "AND (%s::uuid IS NULL OR uuid > %s::uuid) ORDER BY uuid LIMIT %s",
+                (str(chunk_size), after, after, size),
+            )
+            batch = [r[0] for r in cur.fetchall()]
+        if not batch:
+            return
+        yield batch
+        after = batch[-1]
+        if remaining is not None:
+            remaining -= len(batch)
+
+
+# ---- driver ----
+
+
+def format_overhead(o: tuple[int, float, float]) -> str:
+    return f"{o[0] // 1024}KB {o[1]:.1f} chunks/req {o[2]:.3f}x"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="target plaintext bytes per chunk")
+    parser.add_argument("--range-size", type=int, default=STREAM_RANGE_SIZE, help="request size the overhead report models")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=20, help="uuids per worker invocation")
+    parser.add_argument("--dry-run", action="store_true", help="report before/after overhead, rewrite nothing")
+    parser.add_argument("--limit", type=int, default=None, help="rewrite at most N rows (testing)")
+    args = parser.parse_args()
+
+    if args.chunk_size <= 0:
+        sys.exit("--chunk-size must be positive")
+    if args.range_size % args.chunk_size:
+        print(f"  warning: {args.chunk_size} doesn't divide the {args.range_size} range size; sequential ranges will straddle chunks")
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    with conn, conn.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM media_records WHERE {PENDING_SQL}", (str(args.chunk_size),))
+        total = cur.fetchone()[0]
+    if args.limit:
+        total = min(total, args.limit)
+
+    print(f"to rechunk: {total} rows  |  chunk_size={args.chunk_size}  |  workers={args.workers}  |  dry_run={args.dry_run}")
+    if total == 0:
+        return
+
+    counts: dict[str, int] = {}
+    results: list[Result] = []
+    started = time.monotonic()
+    batches = iter_batches(conn, args.chunk_size, args.batch_size, args.limit)
+    derived_key = derive_key(PASSWORD)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(derived_key,)) as pool:
+        inflight = set()
+
+        def submit_next():
+            batch = next(batches, None)
+            if batch is not None:
+                inflight.add(pool.submit(worker, batch, args.chunk_size, args.range_size, args.dry_run))
+
+        for _ in range(args.workers * 2):
+            submit_next()
+        last_report = started
+        try:
+            while inflight:
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    inflight.discard(fut)
+                    for r in fut.result():
+                        counts[r.status] = counts.get(r.status, 0) + 1
+                        results.append(r)
+                    submit_next()
+                now = time.monotonic()
+                if now - last_report >= 5.0:
+                    elapsed = now - started
+                    rate = len(results) / max(elapsed, 0.001)
+                    eta = (total - len(results)) / max(rate, 0.001)
+                    print(f"  progress: {len(results)}/{total}  rate={rate:.1f}/s  eta={eta:.0f}s  errors={counts.get('error', 0)}")
+                    last_report = now
+        except KeyboardInterrupt:
+            for fut in inflight:
+                fut.cancel()
+            print("\ninterrupted — finished rows are at the target chunk size; rerun to continue")
+            sys.exit(130)
+
+    elapsed = time.monotonic() - started
+    print()
+    print(f"done in {elapsed:.1f}s")
+    for status, count in sorted(counts.items()):
+        print(f"  {status}: {count}")
+
+    measured = [r for r in results if r.before and r.status != "skipped"]
+    if measured:
+        print()
+        print(f"streaming overhead per {args.range_size // 1024}KB request — first 20 (before → after):")
+        for r in measured[:20]:
+            print(f"  {r.uuid}  {r.storage_type}  {r.file_size}B  {format_overhead(r.before)}  →  {format_overhead(r.after)}")
+        if len(measured) > 20:
+            print(f"  ... and {len(measured) - 20} more")
+        with open(REPORT_PATH, "w") as f:
+            f.write("uuid\tstatus\tstorage_type\tfile_size\tchunk_size_before\tchunks_per_request_before\t"
+                    "read_amp_before\tchunk_size_after\tchunks_per_request_after\tread_amp_after\n")
+            for r in measured:
+                f.write(f"{r.uuid}\t{r.status}\t{r.storage_type}\t{r.file_size}\t"
+                        f"{r.before[0]}\t{r.before[1]:.2f}\t{r.before[2]:.4f}\t{r.after[0]}\t{r.after[1]:.2f}\t{r.after[2]:.4f}\n")
+        print(f"  full report: {REPORT_PATH}")
+
+    errors = [r for r in results if r.status == "error" or (r.status == "rechunked" and r.detail)]
+    if errors:
+        print()
+        print("errors — first 10:")
+        for r in errors[:10]:
+            print(f"  {r.uuid}: {r.detail}")
+    if counts.get("error"):
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
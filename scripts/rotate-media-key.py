@@ -0,0 +1,298 @@
+"""Re-encrypt aes-gcm-unified media from the current MEDIA_ENCRYPTION_KEY to
+NEW_MEDIA_ENCRYPTION_KEY, chunk by chunk.
+
+Each chunk is authenticated under the old key and re-encrypted under the new
+one, with the same chunk index and layout, into a fresh Large Object. For
+bytea rows the new ciphertext is copied back server-side with lo_get. Client
+memory stays at ~one read plus one write buffer whatever the file size. Every
+row is its own transaction, and the new key's fingerprint is written to
+encryption_metadata.keyId. A rerun skips rows that already carry the new keyId,
+so an interrupted rotation resumes where it stopped. Rows that already
+authenticate under the new key (uploaded after the app switched keys) are
+only stamped.
+
+Run this in a maintenance window. Stop the app, rotate, then restart it with
+MEDIA_ENCRYPTION_KEY set to the new key. Legacy Fernet rows are not touched:
+convert them with 30_convert_fernet_to_aes_gcm.py first.
+
+Usage:
+  MEDIA_ENCRYPTION_KEY=old NEW_MEDIA_ENCRYPTION_KEY=new python3 rotate-media-key.py [--workers N] [--dry-run]
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+
+import psycopg2
+from cryptography.exceptions import InvalidTag
+
+from chunk_codec import (
+    ChunkCodec,
+    ChunkLayout,
+    chunk_meta,
+    derive_key,
+    file_salt,
+    key_id,
+    lob_writer,
+    row_reader,
+)
+
+DB_CONFIG = {
+    "host": os.environ.get("DB_HOST", "localhost"),
+    "port": int(os.environ.get("DB_PORT", "3432")),
+    "dbname": os.environ.get("DB_NAME", "comfy_media"),
+    "user": os.environ.get("DB_USER", "comfy_user"),
+    "password": os.environ.get("DB_PASSWORD", "comfy_secure_password_2024"),
+}
+
+OLD_PASSWORD = os.environ.get(
+    "MEDIA_ENCRYPTION_KEY",
+    "K8mF3vN9pQ2sT6wY0zC4eH7jL1nP5rU8xA3dG6iK9mO2qT5wZ8cF1hJ4lN7pS0vY",
+)
+NEW_PASSWORD = os.environ.get("NEW_MEDIA_ENCRYPTION_KEY")
+
+ERRORS_PATH = "/tmp/media-key-rotation-errors.txt"
+# %s is the new key's keyId
+PENDING_SQL = (
+    "encryption_method = 'aes-gcm-unified' AND storage_type IN ('bytea', 'lob') "
+    "AND encryption_metadata->>'keyId' IS DISTINCT FROM %s"
+)
+
+
+@dataclass
+class Result:
+    uuid: str
+    status: str  # rotated | stamped | verified | skipped | error
+    detail: str | None = None
+
+
+# ---- per row ----
+
+_CONN = None  # one long-lived connection per pool process, see init_worker
+_OLD: ChunkCodec | None = None
+_NEW: ChunkCodec | None = None
+
+
+def init_worker(old_key: bytes, new_key: bytes):
+    """ProcessPoolExecutor initializer: adopt the parent's derived keys and
+    open the connection every worker() call in this process reuses."""
+    global _CONN, _OLD, _NEW
+    _OLD = ChunkCodec(old_key, file_salt(OLD_PASSWORD))
+    _NEW = ChunkCodec(new_key, file_salt(NEW_PASSWORD))
+    _CONN = psycopg2.connect(**DB_CONFIG)
+
+
+def authenticates(codec: ChunkCodec, read, layout: ChunkLayout) -> bool:
+    return codec.verify_chunks(read, layout, min(1, layout.total_chunks)) == []
+
+
+def rotate_row(conn, uuid: str, dry_run: bool) -> Result:
+    """Rotate one row in its own transaction. The row is locked for the
+    duration; a replaced Large Object is unlinked only after the commit."""
+    with conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT storage_type, large_object_oid, encryption_metadata, chunk_size, original_size, file_size, "
+            "content_sha256, octet_length(encrypted_data) FROM media_records "
+            "WHERE uuid = %s AND encryption_method = 'aes-gcm-unified' FOR UPDATE",
+            (uuid,),
+        )
+        row = cur.fetchone()
+        if row is None:
+            return Result(uuid, "skipped", "no longer an aes-gcm-unified row")
+        storage, oid, meta, chunk_size, original_size, file_size, content_sha256, length = row
+        if meta and meta.get("keyId") == _NEW.key_id:
+            return Result(uuid, "skipped", "already on the new key")
+        meta = chunk_meta(meta, chunk_size, original_size, file_size)
+        layout = ChunkLayout.from_metadata(meta)
+        new_meta = {**meta, "keyId": _NEW.key_id}
+
+        with row_reader(cur, uuid, storage, oid, length) as (read, length):
+            if length != layout.encrypted_size:
+                raise ValueError(f"blob is {length} bytes, encryption_metadata implies {layout.encrypted_size}")
+            if not authenticates(_OLD, read, layout):
+                if not authenticates(_NEW, read, layout):
+                    raise ValueError("chunk 0 authenticates under neither key")
+                if not dry_run:
+                    cur.execute(
+                        "UPDATE media_records SET encryption_metadata = %s, updated_at = NOW() WHERE uuid = %s",
+                        (json.dumps(new_meta), uuid),
+                    )
+                return Result(uuid, "stamped")
+
+            digest = hashlib.sha256()
+            if dry_run:
+                for _, plaintext in _OLD.iter_chunks(read, layout):
+                    digest.update(plaintext)
+            else:
+                with lob_writer(cur) as (new_oid, write, checksum):
+                    for i, plaintext in _OLD.iter_chunks(read, layout):
+                        digest.update(plaintext)
+                        write(_NEW.encrypt_chunk(i, plaintext))
+
+        if content_sha256 is not None and digest.digest() != bytes(content_sha256):
+            raise ValueError("decrypted content doesn't match content_sha256")
+        if dry_run:
+            return Result(uuid, "verified")
+
+        if storage == "lob":
+            cur.execute(
+                "UPDATE media_records SET large_object_oid = %s, checksum = %s, encryption_metadata = %s, "
+                "updated_at = NOW() WHERE uuid = %s",
+                (new_oid, checksum.hexdigest(), json.dumps(new_meta), uuid),
+            )
+        else:
+            cur.execute(
+                "UPDATE media_records SET encrypted_data = lo_get(%s), checksum = %s, encryption_metadata = %s, "
+                "updated_at = NOW() WHERE uuid = %s",
+                (new_oid, checksum.hexdigest(), json.dumps(new_meta), uuid),
+            )
+            cur.execute("SELECT lo_unlink(%s)", (new_oid,))
+
+    if storage == "lob":
+        # If this fails the old object is only orphaned; cleanup_orphaned_large_objects() (migration 004) collects it
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute("SELECT lo_unlink(%s)", (oid,))
+        except psycopg2.Error as e:
+            return Result(uuid, "rotated", f"old large object {oid} left orphaned: {e}".strip())
+    return Result(uuid, "rotated")
+
+
+def worker(uuid_batch: list[str], dry_run: bool) -> list[Result]:
+    global _CONN
+    if _CONN is None or _CONN.closed:
+        _CONN = psycopg2.connect(**DB_CONFIG)
+    results = []
+    for uuid in uuid_batch:
+        try:
+            results.append(rotate_row(_CONN, uuid, dry_run))
+        except InvalidTag:
+            results.append(Result(uuid, "error", "a chunk fails authentication under the old key; see scrub-media-integrity.py"))
+        except Exception as e:
+            results.append(Result(uuid, "error", f"{type(e).__name__}: {e}".strip()))
+    return results
+
+
+def iter_batches(conn, new_key_id: str, batch_size: int, limit: int | None):
+    """Keyset pages of rows not yet on the new key, in uuid order. Rows that
+    error are passed over for this run and retried by the next one."""
+    after = None
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        with conn, conn.cursor() as cur:
+            cur.execute(
+                f"SELECT uuid::text FROM media_records WHERE {PENDING_SQL} "
+                "AND (%s::uuid IS NULL OR uuid > %s::uuid) ORDER BY uuid LIMIT %s",
+                (new_key_id, after, after, size),
+            )
+            batch = [r[0] for r in cur.fetchall()]
+        if not batch:
+            return
+        yield batch
+        after = batch[-1]
+        if remaining is not None:
+            remaining -= len(batch)
+
+
+# ---- driver ----
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=20, help="uuids per worker invocation")
+    parser.add_argument("--dry-run", action="store_true", help="authenticate every chunk under the old key, write nothing")
+    parser.add_argument("--limit", type=int, default=None, help="rotate at most N rows (testing)")
+    args = parser.parse_args()
+
+    if not NEW_PASSWORD:
+        sys.exit("NEW_MEDIA_ENCRYPTION_KEY is not set")
+    old_key, new_key = derive_key(OLD_PASSWORD), derive_key(NEW_PASSWORD)
+    if old_key == new_key:
+        sys.exit("NEW_MEDIA_ENCRYPTION_KEY is the current key")
+    new_key_id = key_id(new_key)
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    with conn, conn.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM media_records WHERE {PENDING_SQL}", (new_key_id,))
+        total = cur.fetchone()[0]
+        cur.execute("SELECT count(*) FROM media_records WHERE encryption_method IS DISTINCT FROM 'aes-gcm-unified'")
+        legacy = cur.fetchone()[0]
+    if args.limit:
+        total = min(total, args.limit)
+
+    print(f"to rotate: {total} rows  |  new keyId={new_key_id}  |  workers={args.workers}  |  dry_run={args.dry_run}")
+    if legacy:
+        print(f"  warning: {legacy} legacy (non aes-gcm-unified) rows stay on the old key; convert them first")
+    if total == 0:
+        return
+
+    counts: dict[str, int] = {}
+    errors: list[Result] = []
+    done_rows = 0
+    started = time.monotonic()
+    batches = iter_batches(conn, new_key_id, args.batch_size, args.limit)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(old_key, new_key)) as pool:
+        inflight = set()
+
+        def submit_next():
+            batch = next(batches, None)
+            if batch is not None:
+                inflight.add(pool.submit(worker, batch, args.dry_run))
+
+        for _ in range(args.workers * 2):
+            submit_next()
+        last_report = started
+        try:
+            while inflight:
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    inflight.discard(fut)
+                    for r in fut.result():
+                        counts[r.status] = counts.get(r.status, 0) + 1
+                        if r.status == "error" or (r.status == "rotated" and r.detail):
+                            errors.append(r)
+                        done_rows += 1
+                    submit_next()
+                now = time.monotonic()
+                if now - last_report >= 5.0:
+                    elapsed = now - started
+                    rate = done_rows / max(elapsed, 0.001)
+                    eta = (total - done_rows) / max(rate, 0.001)
+                    print(f"  progress: {done_rows}/{total}  rate={rate:.1f}/s  eta={eta:.0f}s  errors={counts.get('error', 0)}")
+                    last_report = now
+        except KeyboardInterrupt:
+            for fut in inflight:
+                fut.cancel()
+            print("\ninterrupted — finished rows carry the new keyId; rerun to continue")
+            sys.exit(130)
+
+    elapsed = time.monotonic() - started
+    print()
+    print(f"done in {elapsed:.1f}s")
+    for status, count in sorted(counts.items()):
+        print(f"  {status}: {count}")
+
+    if errors:
+        print()
+        print("errors — first 10:")
+        for r in errors[:10]:
+            print(f"  {r.uuid}: {r.detail}")
+        with open(ERRORS_PATH, "w") as f:
+            for r in errors:
+                f.write(f"{r.uuid}\t{r.status}\t{r.detail}\n")
+        print(f"  full list: {ERRORS_PATH}")
+    if counts.get("error"):
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
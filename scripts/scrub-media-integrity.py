@@ -0,0 +1,423 @@
+"""Scrub aes-gcm-unified media for silent corruption: every chunk's auth tag is
+verified, and encryption_metadata (chunkSize/totalChunks/fileSize) is checked
+against the real blob length and the file_size/original_size columns. Covers
+bytea and Large Object rows; legacy Fernet rows are left to
+30_convert_fernet_to_aes_gcm.py, which verifies their HMAC as it converts.
+
+Reads are throttled to --max-mbps across all workers so a scrub can run beside
+production traffic. Rows that fail a check are written to
+media_integrity_findings (database/migrations/014) under one scrub run id.
+Work is paged by uuid and checkpointed after every batch, so an interrupted
+run continues the same run id with --resume.
+
+Usage:
+  MEDIA_ENCRYPTION_KEY=... python3 scrub-media-integrity.py [--workers N] [--max-mbps 50] [--resume]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid as uuidlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+
+import psycopg2
+
+from chunk_codec import (
+    CHUNK_OVERHEAD,
+    ChunkCodec,
+    ChunkLayout,
+    buffer_reader,
+    bytea_range_reader,
+    chunk_meta,
+    derive_key,
+    file_salt,
+    lob_range_reader,
+)
+
+DB_CONFIG = {
+    "host": os.environ.get("DB_HOST", "localhost"),
+    "port": int(os.environ.get("DB_PORT", "3432")),
+    "dbname": os.environ.get("DB_NAME", "comfy_media"),
+    "user": os.environ.get("DB_USER", "comfy_user"),
+    "password": os.environ.get("DB_PASSWORD", "comfy_secure_password_2024"),
+}
+
+PASSWORD = os.environ.get(
+    "MEDIA_ENCRYPTION_KEY",
+    "K8mF3vN9pQ2sT6wY0zC4eH7jL1nP5rU8xA3dG6iK9mO2qT5wZ8cF1hJ4lN7pS0vY",
+)
+
+INLINE_THRESHOLD = 64 * 1024 * 1024  # bytea above this is read in substring() ranges
+READ_SIZE = 8 * 1024 * 1024  # target bytes per read round trip
+SCRUB_SQL = "encryption_method = 'aes-gcm-unified' AND storage_type IN ('bytea', 'lob')"
+
+
+# ---- throttle ----
+
+
+class Throttle:
+    """Keeps one process's reads at or under bytes_per_sec (0 = unlimited).
+    Credit from idle time is capped at a second, so a worker coming back from
+    a gap doesn't burst."""
+
+    def __init__(self, bytes_per_sec: float):
+        self.rate = bytes_per_sec
+        self.started = time.monotonic()
+        self.consumed = 0
+
+    def consume(self, n: int):
+        self.consumed += n
+        ahead = self.consumed / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+        elif ahead < -1.0:
+            self.started, self.consumed = time.monotonic(), 0
+
+    def reader(self, read):
+        if not self.rate:
+            return read
+
+        def throttled(offset: int, length: int):
+            data = read(offset, length)
+            self.consume(len(data))
+            return data
+
+        return throttled
+
+
+# ---- checks ----
+
+
+@dataclass
+class Finding:
+    uuid: str
+    storage_type: str | None
+    status: str  # ok | corrupt | truncated | metadata_mismatch | missing | error
+    bad_chunks: list[int] = field(default_factory=list)
+    detail: str | None = None
+    bytes_read: int = 0
+
+
+def check_metadata(meta: dict, length: int, file_size, original_size) -> tuple[ChunkLayout | None, list[str]]:
+    """Layout streamMedia would use for this row, plus every way it disagrees
+    with the stored blob and columns. None when it can't be used at all."""
+    try:
+        layout = ChunkLayout.from_metadata(meta)
+    except (KeyError, TypeError, ValueError) as e:
+        return None, [f"unreadable encryption_metadata: {type(e).__name__}: {e}"]
+    if layout.chunk_size <= 0 or layout.file_size < 0 or layout.total_chunks < 0:
+        return None, [f"invalid chunkSize={layout.chunk_size} totalChunks={layout.total_chunks} fileSize={layout.file_size}"]
+
+    problems = []
+    needed = -(-layout.file_size // layout.chunk_size)
+    if layout.total_chunks != needed:
+        problems.append(f"totalChunks={layout.total_chunks} but fileSize/chunkSize needs {needed}")
+        # check the chunks that are actually there rather than calling them all truncated
+        layout = ChunkLayout(layout.chunk_size, needed, layout.file_size)
+    if length > layout.encrypted_size:
+        problems.append(f"blob has {length - layout.encrypted_size} bytes past the last chunk")
+    if file_size is not None and file_size != length:
+        problems.append(f"file_size={file_size} but blob is {length} bytes")
+    # hybridMediaStorage.ts stores the encrypted length in original_size too; either is consistent
+    if original_size is not None and original_size not in (layout.file_size, length):
+        problems.append(f"original_size={original_size} is neither fileSize={layout.file_size} nor the blob length")
+    return layout, problems
+
+
+def scrub_row(codec: ChunkCodec, read, length: int, meta: dict, file_size, original_size) -> tuple[str, list[int], list[str]]:
+    """(status, bad chunk indexes, problems) for one blob."""
+    layout, problems = check_metadata(meta, length, file_size, original_size)
+    if layout is None:
+        return "metadata_mismatch", [], problems
+
+    # Only chunks wholly inside the blob can be authenticated
+    complete = layout.total_chunks
+    if length < layout.encrypted_size:
+        complete = min(length // (layout.chunk_size + CHUNK_OVERHEAD), layout.total_chunks - 1)
+        problems.insert(0, f"blob is {length} bytes, metadata implies {layout.encrypted_size}; "
+                           f"chunks {complete}-{layout.total_chunks - 1} incomplete")
+    bad = codec.verify_chunks(read, layout, complete, read_size=READ_SIZE)
+    if bad:
+        problems.insert(0, f"{len(bad)} of {complete} chunks fail authentication")
+        return "corrupt", bad, problems
+    if complete < layout.total_chunks:
+        return "truncated", [], problems
+    return ("metadata_mismatch" if problems else "ok"), [], problems
+
+
+# ---- worker ----
+
+_CONN = None  # one long-lived connection per pool process, see init_worker
+_CODEC: ChunkCodec | None = None
+_THROTTLE: Throttle | None = None
+
+
+def init_worker(derived_key: bytes, bytes_per_sec: float):
+    """ProcessPoolExecutor initializer: adopt the parent's key and this
+    process's share of the read budget, and open its connection."""
+    global _CONN, _CODEC, _THROTTLE
+    _CODEC = ChunkCodec(derived_key, file_salt(PASSWORD))
+    _THROTTLE = Throttle(bytes_per_sec)
+    _CONN = psycopg2.connect(**DB_CONFIG)
+
+
+def worker(uuid_batch: list[str]) -> list[Finding]:
+    """Scrub one batch on this process's connection; a Finding per uuid.
+    Same row walk as backfill-content-sha256.py: a one-row server-side
+    cursor, large bytea and Large Objects read in chunk-aligned ranges, and a
+    savepoint per row so one unreadable row doesn't end the batch."""
+    global _CONN
+    findings: list[Finding] = []
+    if _CONN is None or _CONN.closed:
+        _CONN = psycopg2.connect(**DB_CONFIG)
+    conn = _CONN
+    try:
+        with conn.cursor(name="scrub_rows") as rows, conn.cursor() as ranges:
+            rows.itersize = 1
+            rows.execute(
+                "SELECT uuid::text, storage_type, large_object_oid, encryption_metadata, chunk_size, "
+                "original_size, file_size, octet_length(encrypted_data), "
+                "CASE WHEN octet_length(encrypted_data) <= %s THEN encrypted_data END "
+                "FROM media_records WHERE uuid = ANY(%s::uuid[])",
+                (INLINE_THRESHOLD, uuid_batch),
+            )
+            for uuid, storage, oid, meta, chunk_size, original_size, file_size, length, enc in rows:
+                ranges.execute("SAVEPOINT scrub_row")
+                bytes_read = 0
+
+                def counted(read):
+                    def read_counted(offset: int, n: int):
+                        nonlocal bytes_read
+                        data = read(offset, n)
+                        bytes_read += len(data)
+                        return data
+
+                    return _THROTTLE.reader(read_counted)
+
+                try:
+                    meta = chunk_meta(meta, chunk_size, original_size, file_size)
+                    if storage == "lob" and oid is not None:
+                        with lob_range_reader(ranges, oid) as (read, lob_length):
+                            status, bad, problems = scrub_row(_CODEC, counted(read), lob_length, meta, file_size, original_size)
+                    elif length is not None:
+                        read = buffer_reader(enc) if enc is not None else bytea_range_reader(ranges, uuid)
+                        status, bad, problems = scrub_row(_CODEC, counted(read), length, meta, file_size, original_size)
+                    else:
+                        findings.append(Finding(uuid, storage, "missing", detail=f"no encrypted data for storage_type={storage}"))
+                        continue
+                    findings.append(Finding(uuid, storage, status, bad, "; ".join(problems) or None, bytes_read))
+                except psycopg2.errors.UndefinedObject as e:
+                    ranges.execute("ROLLBACK TO SAVEPOINT scrub_row")
+                    findings.append(Finding(uuid, storage, "missing", detail=str(e).strip(), bytes_read=bytes_read))
+                except psycopg2.Error as e:
+                    ranges.execute("ROLLBACK TO SAVEPOINT scrub_row")
+                    findings.append(Finding(uuid, storage, "error", detail=f"{type(e).__name__}: {e}".strip(), bytes_read=bytes_read))
+                except Exception as e:
+                    findings.append(Finding(uuid, storage, "error", detail=f"{type(e).__name__}: {e}", bytes_read=bytes_read))
+    finally:
+        if not conn.closed:
+            conn.rollback()  # read-only; just ends the transaction the named cursor needed
+    return findings
+
+
+# ---- report ----
+
+
+def record_findings(conn, run_id: str, findings: list[Finding]):
+    """Upsert this batch's problems into media_integrity_findings and drop
+    stale ones for rows that now scrub clean (a resumed run re-checks the
+    batches after its checkpoint)."""
+    problems = [f for f in findings if f.status != "ok"]
+    clean = [f.uuid for f in findings if f.status == "ok"]
+    with conn, conn.cursor() as cur:
+        if problems:
+            cur.executemany(
+                "INSERT INTO media_integrity_findings (scrub_run_id, media_uuid, storage_type, status, bad_chunks, detail) "
+                "VALUES (%s, %s, %s, %s, %s, %s) "
+                "ON CONFLICT (scrub_run_id, media_uuid) DO UPDATE SET storage_type = EXCLUDED.storage_type, "
+                "status = EXCLUDED.status, bad_chunks = EXCLUDED.bad_chunks, detail = EXCLUDED.detail, checked_at = NOW()",
+                [(run_id, f.uuid, f.storage_type, f.status, f.bad_chunks or None, f.detail) for f in problems],
+            )
+        if clean:
+            cur.execute(
+                "DELETE FROM media_integrity_findings WHERE scrub_run_id = %s AND media_uuid = ANY(%s::uuid[])",
+                (run_id, clean),
+            )
+
+
+# ---- checkpoint ----
+
+CHECKPOINT_PATH = "/tmp/media-scrub-checkpoint.json"
+
+
+@dataclass
+class Checkpoint:
+    run_id: str = field(default_factory=lambda: str(uuidlib.uuid4()))
+    last_seen: str | None = None  # every uuid <= this has been scrubbed and recorded
+    counts: dict[str, int] = field(default_factory=dict)  # status -> rows; batches re-checked on --resume count again
+    bytes_read: int = 0
+
+    @classmethod
+    def load(cls, path: str) -> Checkpoint:
+        try:
+            with open(path) as f:
+                return cls(**json.load(f))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, path: str):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                {"run_id": self.run_id, "last_seen": self.last_seen, "counts": self.counts, "bytes_read": self.bytes_read},
+                f,
+            )
+        os.replace(tmp, path)
+
+
+def iter_batches(conn, batch_size: int, after: str | None, limit: int | None):
+    """Keyset pages of aes-gcm-unified uuids in uuid order, one worker batch per query."""
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        with conn, conn.cursor() as cur:
+            cur.execute(
+                f"SELECT uuid::text FROM media_records WHERE {SCRUB_SQL} "
+                "AND (%s::uuid IS NULL OR uuid > %s::uuid) ORDER BY uuid LIMIT %s",
+                (after, after, size),
+            )
+            batch = [r[0] for r in cur.fetchall()]
+        if not batch:
+            return
+        yield batch
+        after = batch[-1]
+        if remaining is not None:
+            remaining -= len(batch)
+
+
+# ---- driver ----
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=20, help="uuids per worker invocation")
+    parser.add_argument("--max-mbps", type=float, default=50.0, help="total read budget in MB/s across workers (0 = unlimited)")
+    parser.add_argument("--dry-run", action="store_true", help="print findings but don't write media_integrity_findings")
+    parser.add_argument("--limit", type=int, default=None, help="scrub at most N rows (testing)")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="progress file")
+    parser.add_argument("--resume", action="store_true", help="continue the checkpoint's run after its last uuid")
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint.load(args.checkpoint) if args.resume else Checkpoint()
+    conn = psycopg2.connect(**DB_CONFIG)
+    with conn, conn.cursor() as cur:
+        cur.execute(
+            f"SELECT count(*) FROM media_records WHERE {SCRUB_SQL} AND (%s::uuid IS NULL OR uuid > %s::uuid)",
+            (checkpoint.last_seen, checkpoint.last_seen),
+        )
+        total = cur.fetchone()[0]
+    if args.limit:
+        total = min(total, args.limit)
+
+    resumed = f"  |  resuming after {checkpoint.last_seen}" if checkpoint.last_seen else ""
+    print(
+        f"to scrub: {total} rows  |  run={checkpoint.run_id}  |  workers={args.workers}  |  "
+        f"max={args.max_mbps or 'unlimited'} MB/s  |  dry_run={args.dry_run}{resumed}"
+    )
+    if total == 0:
+        return
+
+    scrubbed = 0
+    problems: list[Finding] = []
+    started = time.monotonic()
+    bytes_at_start = checkpoint.bytes_read
+
+    # Batches finish out of order; the checkpoint only advances over the
+    # contiguous prefix of finished ones, each recorded before it counts.
+    batch_ends: list[str] = []
+    finished: set[int] = set()
+    watermark = 0
+
+    def record(findings: list[Finding]):
+        nonlocal scrubbed
+        if not args.dry_run:
+            record_findings(conn, checkpoint.run_id, findings)
+        for f in findings:
+            checkpoint.counts[f.status] = checkpoint.counts.get(f.status, 0) + 1
+            checkpoint.bytes_read += f.bytes_read
+            if f.status != "ok":
+                problems.append(f)
+        scrubbed += len(findings)
+
+    def advance():
+        nonlocal watermark
+        while watermark in finished:
+            watermark += 1
+        if watermark:
+            checkpoint.last_seen = batch_ends[watermark - 1]
+        checkpoint.save(args.checkpoint)
+
+    batches = iter_batches(conn, args.batch_size, checkpoint.last_seen, args.limit)
+    derived_key = derive_key(PASSWORD)
+    per_worker = args.max_mbps * 1024 * 1024 / args.workers
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(derived_key, per_worker)) as pool:
+        inflight = {}  # future -> index into batch_ends
+
+        def submit_next():
+            batch = next(batches, None)
+            if batch is not None:
+                inflight[pool.submit(worker, batch)] = len(batch_ends)
+                batch_ends.append(batch[-1])
+
+        for _ in range(args.workers * 2):
+            submit_next()
+        last_report = started
+        try:
+            while inflight:
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    record(fut.result())
+                    finished.add(inflight.pop(fut))
+                    submit_next()
+                advance()
+                now = time.monotonic()
+                if now - last_report >= 5.0:
+                    elapsed = now - started
+                    mbps = (checkpoint.bytes_read - bytes_at_start) / max(elapsed, 0.001) / (1024 * 1024)
+                    eta = (total - scrubbed) / max(scrubbed / max(elapsed, 0.001), 0.001)
+                    print(f"  progress: {scrubbed}/{total}  {mbps:.1f} MB/s  eta={eta:.0f}s  problems={len(problems)}")
+                    last_report = now
+        except KeyboardInterrupt:
+            for fut in inflight:
+                fut.cancel()
+            advance()
+            print(f"\ninterrupted — checkpoint at {checkpoint.last_seen}, rerun with --resume")
+            sys.exit(130)
+        advance()
+
+    elapsed = time.monotonic() - started
+    print()
+    print(f"done in {elapsed:.1f}s  ({(checkpoint.bytes_read - bytes_at_start) / (1024 * 1024):.1f} MB read)")
+    for status, count in sorted(checkpoint.counts.items()):
+        print(f"  {status}: {count}")
+
+    if problems:
+        print()
+        print("problems — first 20:")
+        for f in problems[:20]:
+            print(f"  {f.uuid}  {f.storage_type}  {f.status}: {f.detail}")
+        if len(problems) > 20:
+            print(f"  ... and {len(problems) - 20} more")
+        if not args.dry_run:
+            print(f"  all findings: SELECT * FROM media_integrity_findings WHERE scrub_run_id = '{checkpoint.run_id}'")
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Checks for backfill-content-sha256.py's streaming Fernet hash.
+
+psycopg2 returns bytea as a memoryview of format 'c', whose items are
+1-byte bytes rather than ints, so these feed sha256_fernet views in that
+format as well as plain bytes. No database is needed.
+
+Usage:
+  python3 -m pytest scripts/test_backfill_content_sha256.py
+"""
+
+import base64
+import hashlib
+import os
+
+import pytest
+from cryptography.fernet import Fernet
+
+FERNET_BLOCK = 1024 * 1024  # backfill-content-sha256.py's CBC step
+
+
+@pytest.fixture(scope="module")
+def backfill(load_script):
+    module = load_script("backfill-content-sha256.py")
+    module.set_key(module.derive_key(module.PASSWORD))
+    return module
+
+
+def bytea_view(data: bytes) -> memoryview:
+    """bytea the way psycopg2 hands it back"""
+    return memoryview(data).cast("c")
+
+
+def reader(buffer):
+    view = memoryview(buffer)
+    return lambda offset, length: view[offset : offset + length]
+
+
+def raw_fernet_token(backfill, plaintext: bytes) -> bytes:
+    """What legacy full-file rows store: the Fernet token, base64url-decoded."""
+    fernet = Fernet(base64.urlsafe_b64encode(backfill._DERIVED_KEY))
+    return base64.urlsafe_b64decode(fernet.encrypt(plaintext))
+
+
+@pytest.mark.parametrize("size", [0, 1, 15, 16, FERNET_BLOCK + 7])
+def test_sha256_fernet_accepts_psycopg2_bytea_view(backfill, size):
+    plaintext = os.urandom(size)
+    token = raw_fernet_token(backfill, plaintext)
+    view = bytea_view(token)
+    assert view[0] == b"\x80"
+
+    assert backfill.sha256_fernet(reader(view), len(view)) == hashlib.sha256(plaintext).hexdigest()
+    assert backfill.sha256_fernet(reader(token), len(token)) == hashlib.sha256(plaintext).hexdigest()
+
+
+def test_sha256_fernet_rejects_non_fernet_header(backfill):
+    token = bytearray(raw_fernet_token(backfill, b"hello"))
+    token[0] = 0x81
+    with pytest.raises(ValueError, match="not a raw Fernet token"):
+        backfill.sha256_fernet(reader(bytea_view(bytes(token))), len(token))
+
+
+def test_sha256_fernet_rejects_tampered_token(backfill):
+    token = bytearray(raw_fernet_token(backfill, os.urandom(1000)))
+    token[40] ^= 1
+    with pytest.raises(ValueError, match="HMAC"):
+        backfill.sha256_fernet(reader(bytea_view(bytes(token))), len(token))
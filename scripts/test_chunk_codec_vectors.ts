@@ -0,0 +1,126 @@
+/**
+ * Cross-language vectors for the AES-GCM chunk format.
+ *
+ * chunkEncryption.ts is the reference: --write regenerates
+ * scripts/chunk_codec_vectors.json from it, the default mode checks it
+ * against the file. scripts/chunk_codec.py checks the same file with
+ * `python3 scripts/chunk_codec.py --check-vectors`.
+ *
+ * Usage (after `nuxt prepare`, for the ~ alias):
+ *   npx tsx scripts/test_chunk_codec_vectors.ts [--write]
+ */
+import { createHash, pbkdf2Sync } from 'crypto'
+import { readFileSync, writeFileSync } from 'fs'
+import { dirname, join } from 'path'
+import { fileURLToPath } from 'url'
+import { encryptChunked, decryptChunkRange, type ChunkMetadata } from '../server/services/chunkEncryption'
+
+const VECTORS_PATH = join(dirname(fileURLToPath(import.meta.url)), 'chunk_codec_vectors.json')
+const DEFAULT_KEY = 'K8mF3vN9pQ2sT6wY0zC4eH7jL1nP5rU8xA3dG6iK9mO2qT5wZ8cF1hJ4lN7pS0vY'
+
+interface CaseSpec {
+  name: string
+  password: string
+  fileSize: number
+  chunkSize?: number
+}
+
+// chunkSize omitted = encryptChunked's default, i.e. getOptimalChunkSize()
+const CASES: CaseSpec[] = [
+  { name: 'single-byte', password: DEFAULT_KEY, fileSize: 1 },
+  { name: 'small-two-chunks', password: DEFAULT_KEY, fileSize: 100_000 },
+  { name: 'exact-multiple', password: DEFAULT_KEY, fileSize: 131_072 },
+  { name: 'large-three-chunks', password: DEFAULT_KEY, fileSize: 2_500_000 },
+  { name: 'custom-chunk-size', password: 'chunk-codec-test-vector', fileSize: 10_000, chunkSize: 1000 },
+]
+
+// Same bytes as vector_plaintext() in chunk_codec.py
+function vectorPlaintext(length: number): Buffer {
+  const data = Buffer.alloc(length)
+  for (let i = 0; i < length; i++) data[i] = (i * 31 + 7) & 0xff
+  return data
+}
+
+function sha256(data: Buffer): string {
+  return createHash('sha256').update(data).digest('hex')
+}
+
+function rangesFor(metadata: ChunkMetadata): Array<{ start: number; end: number }> {
+  const { chunkSize, fileSize } = metadata
+  const ranges = [
+    { start: 0, end: 0 },
+    { start: 0, end: fileSize - 1 },
+    { start: fileSize - 1, end: fileSize - 1 },
+    { start: Math.max(0, fileSize - 5), end: fileSize + 100 }, // clamped to the last byte
+  ]
+  if (fileSize > chunkSize) {
+    ranges.push({ start: chunkSize - 1, end: chunkSize }) // straddles a chunk boundary
+    ranges.push({ start: chunkSize, end: Math.min(2 * chunkSize, fileSize) - 1 }) // exactly chunk 1
+    ranges.push({ start: Math.floor(chunkSize / 3), end: fileSize - Math.floor(chunkSize / 2) })
+  }
+  // tiny files collapse several of these onto the same range
+  return ranges.filter((r, i) => ranges.findIndex((o) => o.start === r.start && o.end === r.end) === i)
+}
+
+// decryptChunkRange expects the encrypted bytes starting at the range's first chunk
+async function decryptRange(encrypted: Buffer, metadata: ChunkMetadata, password: string, start: number, end: number) {
+  const startChunk = Math.floor(start / metadata.chunkSize)
+  const offset = startChunk * (metadata.chunkSize + 32)
+  return decryptChunkRange(encrypted.subarray(offset), metadata, password, start, end)
+}
+
+async function buildCase(spec: CaseSpec) {
+  const plaintext = vectorPlaintext(spec.fileSize)
+  const { encryptedData, metadata } = spec.chunkSize
+    ? await encryptChunked(plaintext, spec.password, spec.chunkSize)
+    : await encryptChunked(plaintext, spec.password)
+  const ranges = []
+  for (const { start, end } of rangesFor(metadata)) {
+    const range = await decryptRange(encryptedData, metadata, spec.password, start, end)
+    ranges.push({ start, end, sha256: sha256(range) })
+  }
+  return {
+    ...spec,
+    derivedKey: deriveKeyHex(spec.password),
+    metadata,
+    encryptedSha256: sha256(encryptedData),
+    encryptedHead: encryptedData.subarray(0, 64).toString('hex'),
+    plaintextSha256: sha256(plaintext),
+    ranges,
+  }
+}
+
+function deriveKeyHex(password: string): string {
+  // chunkEncryption.ts keeps deriveEncryptionKey private; same parameters
+  return pbkdf2Sync(password, 'comfy_media_salt_v1', 100000, 32, 'sha256').toString('hex')
+}
+
+async function main() {
+  const cases = []
+  for (const spec of CASES) cases.push(await buildCase(spec))
+
+  if (process.argv.includes('--write')) {
+    writeFileSync(VECTORS_PATH, JSON.stringify({ cases }, null, 2) + '\n')
+    console.log(`Wrote ${cases.length} cases to ${VECTORS_PATH}`)
+    return
+  }
+
+  const expected = JSON.parse(readFileSync(VECTORS_PATH, 'utf8'))
+  let failures = 0
+  for (const built of cases) {
+    const want = expected.cases.find((c: { name: string }) => c.name === built.name)
+    const ok = want && JSON.stringify(want) === JSON.stringify(built)
+    if (!ok) failures++
+    console.log(`${ok ? 'ok  ' : 'FAIL'} ${built.name}`)
+  }
+  if (failures) {
+    console.error(`${failures} cases differ from ${VECTORS_PATH}`)
+    process.exit(1)
+  }
+  console.log('all vectors match')
+}
+
+main().catch((error) => {
+  console.error(error)
+  process.exit(1)
+})
@@ -11,6 +11,7 @@ import {
   customType,
   boolean,
   serial,
+  bigserial,
   bigint,
 } from "drizzle-orm/pg-core";
 
@@ -223,6 +224,21 @@ export const mediaDuplicatePairs = pgTable("media_duplicate_pairs", {
   resolvedAt: timestamp("resolved_at", { withTimezone: true }),
 });
 
+// Failed checks from scripts/scrub-media-integrity.py (migration 014). A clean
+// scrub run leaves no rows; --resume upserts on UNIQUE (scrub_run_id, media_uuid).
+export const mediaIntegrityFindings = pgTable("media_integrity_findings", {
+  id: bigserial("id", { mode: "number" }).primaryKey(),
+  scrubRunId: uuid("scrub_run_id").notNull(),
+  mediaUuid: uuid("media_uuid")
+    .notNull()
+    .references(() => mediaRecords.uuid, { onDelete: "cascade" }),
+  storageType: varchar("storage_type", { length: 10 }), // 'bytea' or 'lob'
+  status: varchar("status", { length: 20 }).notNull(), // 'corrupt' | 'truncated' | 'metadata_mismatch' | 'missing' | 'error'
+  badChunks: integer("bad_chunks").array(), // indexes of chunks failing their AES-GCM tag
+  detail: text("detail"),
+  checkedAt: timestamp("checked_at").defaultNow().notNull(),
+});
+
 // Categories Table
 export const categories = pgTable("categories", {
   id: serial("id").primaryKey(),
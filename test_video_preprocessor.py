@@ -0,0 +1,359 @@
+"""
+Checks for video_preprocessor.py's caches, compatibility rules, conversion
+ladder and ffmpeg runner.
+
+cv2 is replaced by a stub that records every capture it opens, and ffprobe /
+ffmpeg by small Python scripts written into the test's temp dir, so neither
+OpenCV nor ffmpeg needs to be installed.
+
+Usage:
+  python3 -m pytest test_video_preprocessor.py
+"""
+
+import itertools
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import types
+
+import pytest
+
+import video_preprocessor as vp
+
+MP4 = 'mov,mp4,m4a,3gp,3g2,mj2'
+H264_INFO = {'codec': 'h264', 'profile': 'High', 'pix_fmt': 'yuv420p', 'bit_depth': 8, 'container': MP4}
+
+FAKE_FFPROBE = """
+import os, sys
+video = sys.argv[-1]
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ffprobe.log'), 'a') as log:
+    log.write(video + '\\n')
+with open(video + '.probe.json') as f:
+    sys.stdout.write(f.read())
+"""
+
+# Three -progress blocks, then whatever FAKE_FFMPEG asks for
+FAKE_FFMPEG = """
+import os, sys, time
+mode = os.environ.get('FAKE_FFMPEG', 'ok')
+for frame in (1, 2, 3):
+    print(f'frame={frame}\\nout_time_us={frame * 1000000}\\nspeed=2.0x\\nprogress=continue', flush=True)
+if mode == 'hang':
+    time.sleep(60)
+if mode == 'fail':
+    sys.stderr.write('Invalid data found when processing input\\n')
+    sys.exit(1)
+print('frame=4\\nout_time_us=4000000\\nspeed=2.0x\\nprogress=end', flush=True)
+"""
+
+
+@pytest.fixture
+def cv2_stub(monkeypatch):
+    """cv2 whose captures decode only the paths in cv2_stub.readable"""
+    stub = types.ModuleType('cv2')
+    stub.CAP_ANY, stub.CAP_FFMPEG = 0, 1900
+    stub.readable = set()
+    stub.opens = []
+
+    class VideoCapture:
+        def __init__(self, path, backend=None):
+            self.ok = path in stub.readable
+            stub.opens.append((path, backend))
+
+        def isOpened(self):
+            return self.ok
+
+        def read(self):
+            return self.ok, None
+
+        def release(self):
+            pass
+
+    stub.VideoCapture = VideoCapture
+    monkeypatch.setattr(vp, 'cv2', stub)
+    monkeypatch.setattr(vp, 'CV2_BACKENDS', [('ANY', 0), ('FFMPEG', 1900)])
+    return stub
+
+
+def write_tool(directory, name, source):
+    path = directory / name
+    path.write_text(f"#!{sys.executable}\n{textwrap.dedent(source)}")
+    path.chmod(0o755)
+    return str(path)
+
+
+@pytest.fixture
+def fake_bin(tmp_path, monkeypatch):
+    """Directory holding the fake ffprobe and ffmpeg, put first on PATH"""
+    directory = tmp_path / 'bin'
+    directory.mkdir()
+    write_tool(directory, 'ffprobe', FAKE_FFPROBE)
+    write_tool(directory, 'ffmpeg', FAKE_FFMPEG)
+    monkeypatch.setenv('PATH', f"{directory}{os.pathsep}{os.environ['PATH']}")
+    return directory
+
+
+def ffprobe_calls(fake_bin):
+    log = fake_bin / 'ffprobe.log'
+    return log.read_text().splitlines() if log.exists() else []
+
+
+def make_video(directory, name, stream, format_name=MP4, size=1000):
+    """A dummy video file plus the JSON the fake ffprobe reports for it"""
+    path = directory / name
+    path.write_bytes(b'\0' * size)
+    (directory / f"{name}.probe.json").write_text(
+        json.dumps({'streams': [stream], 'format': {'format_name': format_name, 'duration': '10.0'}})
+    )
+    return str(path)
+
+
+def preprocessor(tmp_path, **kwargs):
+    kwargs.setdefault('probe_cache', False)
+    kwargs.setdefault('backend_matrix', False)
+    kwargs.setdefault('converted_store', vp.ConvertedStore(root=str(tmp_path / 'store')))
+    return vp.VideoPreprocessor(**kwargs)
+
+
+# ---- ProbeCache ----
+
+
+def test_probe_cache_hit(tmp_path):
+    video = tmp_path / 'a.mp4'
+    video.write_bytes(b'x' * 10)
+    cache = vp.ProbeCache(db_path=str(tmp_path / 'probe.sqlite3'))
+    assert cache.get(str(video)) is None
+    cache.put(str(video), {'codec': 'h264', 'opencv_ok': True})
+    assert cache.get(str(video)) == {'codec': 'h264', 'opencv_ok': True}
+    cache.close()
+
+
+def test_probe_cache_invalidated_by_size_or_mtime(tmp_path):
+    video = tmp_path / 'a.mp4'
+    video.write_bytes(b'x' * 10)
+    cache = vp.ProbeCache(db_path=str(tmp_path / 'probe.sqlite3'))
+
+    cache.put(str(video), {'codec': 'h264'})
+    video.write_bytes(b'x' * 11)
+    assert cache.get(str(video)) is None
+
+    cache.put(str(video), {'codec': 'h264'})
+    st = os.stat(video)
+    os.utime(video, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert cache.get(str(video)) is None
+    cache.close()
+
+
+def test_probe_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = itertools.count(1000)
+    monkeypatch.setattr(vp.time, 'time', lambda: next(clock))
+    paths = []
+    for name in ('a', 'b', 'c'):
+        path = tmp_path / f"{name}.mp4"
+        path.write_bytes(name.encode())
+        paths.append(str(path))
+    a, b, c = paths
+    cache = vp.ProbeCache(db_path=str(tmp_path / 'probe.sqlite3'), max_entries=2)
+
+    cache.put(a, {'name': 'a'})
+    cache.put(b, {'name': 'b'})
+    assert cache.get(a) == {'name': 'a'}  # a is now more recent than b
+    cache.put(c, {'name': 'c'})
+
+    assert cache.get(b) is None
+    assert cache.get(a) == {'name': 'a'}
+    assert cache.get(c) == {'name': 'c'}
+    cache.close()
+
+
+def test_probe_video_is_served_from_cache(tmp_path, fake_bin, cv2_stub):
+    video = make_video(tmp_path, 'a.mp4', {'codec_name': 'h264', 'profile': 'High', 'pix_fmt': 'yuv420p'})
+    pp = preprocessor(tmp_path, probe_cache=vp.ProbeCache(db_path=str(tmp_path / 'probe.sqlite3')))
+
+    first = pp.probe_video(video)
+    assert (first['verdict'], first['opencv_ok'], first['backend']) == (vp.COMPAT_OK, True, 'ANY')
+    assert pp.probe_video(video) == first
+    assert ffprobe_calls(fake_bin) == [video]
+    assert cv2_stub.opens == []
+
+
+def test_backend_matrix_skips_trial_opens_for_a_known_signature(tmp_path, fake_bin, cv2_stub):
+    stream = {'codec_name': 'h264', 'profile': 'High', 'pix_fmt': 'yuv420p'}
+    first = make_video(tmp_path, 'a.flv', stream, format_name='flv')
+    second = make_video(tmp_path, 'b.flv', stream, format_name='flv')
+    cv2_stub.readable.add(first)
+    pp = preprocessor(tmp_path, backend_matrix=vp.BackendMatrix(db_path=str(tmp_path / 'matrix.sqlite3')))
+
+    probe = pp.probe_video(first)
+    assert (probe['verdict'], probe['backend'], probe['opencv_ok']) == (vp.COMPAT_AMBIGUOUS, 'ANY', True)
+    assert cv2_stub.opens == [(first, None)]
+
+    probe = pp.probe_video(second)
+    assert (probe['backend'], probe['opencv_ok']) == ('ANY', True)
+    assert cv2_stub.opens == [(first, None)]
+
+
+# ---- ConvertedStore ----
+
+
+def publish(store, key, size):
+    temp = store.temp_path(key)
+    with open(temp, 'wb') as f:
+        f.write(b'\0' * size)
+    return store.publish(key, temp)
+
+
+def test_converted_store_publish(tmp_path):
+    store = vp.ConvertedStore(root=str(tmp_path / 'store'))
+    key = store.make_key('0' * 64, 'params')
+    temp = store.temp_path(key)
+    assert os.path.dirname(temp) == os.path.join(store.root, 'tmp')
+
+    with open(temp, 'wb') as f:
+        f.write(b'video')
+    path = store.publish(key, temp)
+
+    assert path == store.path_for(key) == os.path.join(store.root, key[:2], f"{key}.mp4")
+    assert not os.path.exists(temp)
+    assert store.get(key) == path
+    assert store.get(store.make_key('0' * 64, 'other params')) is None
+
+
+def test_converted_store_evicts_least_recently_used(tmp_path):
+    store = vp.ConvertedStore(root=str(tmp_path / 'store'), max_bytes=250)
+    a = publish(store, 'a' * 64, 100)
+    b = publish(store, 'b' * 64, 100)
+    os.utime(a, (1000, 1000))
+    os.utime(b, (2000, 2000))
+    assert store.get('a' * 64) == a  # the hit makes a the most recently used
+
+    c = publish(store, 'c' * 64, 100)
+
+    assert not os.path.exists(b)
+    assert os.path.exists(a) and os.path.exists(c)
+
+
+def test_converted_store_eviction_leaves_tmp_alone(tmp_path):
+    store = vp.ConvertedStore(root=str(tmp_path / 'store'), max_bytes=150)
+    in_flight = store.temp_path('d' * 64)
+    with open(in_flight, 'wb') as f:
+        f.write(b'\0' * 1000)
+    segment = os.path.join(store.root, 'tmp', 'segments.x', 'seg_00000.mp4')
+    os.makedirs(os.path.dirname(segment))
+    with open(segment, 'wb') as f:
+        f.write(b'\0' * 1000)
+
+    a = publish(store, 'a' * 64, 100)
+
+    assert os.path.exists(a)
+    assert os.path.exists(in_flight) and os.path.exists(segment)
+
+
+# ---- compatibility rules ----
+
+
+@pytest.mark.parametrize('overrides, verdict, reason', [
+    ({}, vp.COMPAT_OK, 'supported codec'),
+    ({'codec': None}, vp.COMPAT_AMBIGUOUS, 'no video stream found'),
+    ({'codec': 'av1'}, vp.COMPAT_CONVERT, 'problematic codec'),
+    ({'codec': 'hevc', 'bit_depth': 10}, vp.COMPAT_CONVERT, 'problematic codec'),
+    ({'pix_fmt': 'yuv420p10le', 'bit_depth': 10}, vp.COMPAT_CONVERT, 'high bit depth'),
+    ({'profile': 'High 4:4:4 Predictive'}, vp.COMPAT_CONVERT, '10-bit or 4:4:4 profile'),
+    ({'profile': 'High 10'}, vp.COMPAT_CONVERT, '10-bit or 4:4:4 profile'),
+    ({'codec': 'prores'}, vp.COMPAT_AMBIGUOUS, 'unknown codec'),
+    ({'container': 'flv'}, vp.COMPAT_AMBIGUOUS, 'unusual container'),
+    ({'pix_fmt': 'yuv444p'}, vp.COMPAT_AMBIGUOUS, 'unusual pixel format'),
+    ({'pix_fmt': 'yuvj420p', 'container': 'matroska,webm'}, vp.COMPAT_OK, 'supported codec'),
+])
+def test_classify_compatibility(tmp_path, overrides, verdict, reason):
+    pp = preprocessor(tmp_path)
+    assert pp.classify_compatibility({**H264_INFO, **overrides}) == (verdict, reason)
+
+
+def test_classify_compatibility_without_ffprobe_info(tmp_path):
+    assert preprocessor(tmp_path).classify_compatibility(None) == (vp.COMPAT_AMBIGUOUS, 'ffprobe failed')
+
+
+def test_parse_video_info_derives_bit_depth_from_pix_fmt():
+    info = vp.VideoPreprocessor.parse_video_info(json.dumps({
+        'streams': [{'codec_name': 'hevc', 'pix_fmt': 'yuv420p10le', 'width': 3840, 'height': 2160,
+                     'r_frame_rate': '30000/1001'}],
+        'format': {'format_name': MP4, 'duration': '12.5'},
+    }))
+    assert info['bit_depth'] == 10
+    assert (info['width'], info['height'], info['fps'], info['duration']) == (3840, 2160, '30000/1001', 12.5)
+
+
+# ---- conversion ladder and filters ----
+
+
+def probe(verdict=vp.COMPAT_OK, **fields):
+    return {**H264_INFO, 'verdict': verdict, 'width': 1280, 'height': 720, 'fps': '30/1', **fields}
+
+
+def test_conversion_ladder(tmp_path):
+    pp = preprocessor(tmp_path, profile='balanced')
+    assert pp.conversion_ladder(probe()) == vp.CONVERSION_STRATEGIES
+    assert pp.conversion_ladder(probe(), force_convert=True) == [vp.STRATEGY_TRANSCODE]
+    assert pp.conversion_ladder(probe(vp.COMPAT_CONVERT)) == [vp.STRATEGY_VIDEO_ONLY, vp.STRATEGY_TRANSCODE]
+    # Remuxing can't downscale
+    assert pp.conversion_ladder(probe(width=3840, height=2160)) == [vp.STRATEGY_VIDEO_ONLY, vp.STRATEGY_TRANSCODE]
+
+
+def test_video_filters_only_cap_values_over_the_profile(tmp_path):
+    pp = preprocessor(tmp_path, profile='throughput')
+    assert pp.video_filters(probe()) == []
+    assert pp.video_filters(probe(fps='60000/1001')) == ['fps=30']
+    assert pp.video_filters(probe(width=1920, height=1080)) == [
+        "scale='min(iw,1280)':'min(ih,1280)':force_original_aspect_ratio=decrease:force_divisible_by=2"
+    ]
+
+
+def test_video_filters_leave_unknown_size_and_rate_alone(tmp_path):
+    pp = preprocessor(tmp_path, profile='throughput')
+    assert pp.video_filters(probe(width=None, height=None, fps=None)) == []
+    assert pp.video_filters(None) == []
+    assert preprocessor(tmp_path, profile='archival').video_filters(probe(width=7680, height=4320, fps='120/1')) == []
+
+
+def test_target_resolution_tightens_the_profile_cap(tmp_path):
+    pp = preprocessor(tmp_path, profile='balanced', target_resolution=720)
+    assert pp.max_resolution() == 720
+    assert pp.video_filters(probe())[0].startswith("scale='min(iw,720)'")
+    assert 'res720' in pp.conversion_params(vp.CONVERSION_STRATEGIES)
+
+
+# ---- run_ffmpeg ----
+
+
+def test_run_ffmpeg_yields_progress(fake_bin):
+    updates = list(vp.run_ffmpeg([str(fake_bin / 'ffmpeg')], duration=4.0))
+    assert [u['frame'] for u in updates] == [1, 2, 3, 4]
+    assert [u['percent'] for u in updates] == [25.0, 50.0, 75.0, 100.0]
+    assert updates[0]['eta'] == 1.5
+    assert updates[-1]['done'] and not updates[0]['done']
+
+
+def test_run_ffmpeg_cancel(fake_bin, monkeypatch):
+    monkeypatch.setenv('FAKE_FFMPEG', 'hang')
+    cancel = threading.Event()
+    with pytest.raises(vp.ConversionCancelled):
+        for _ in vp.run_ffmpeg([str(fake_bin / 'ffmpeg')], cancel_event=cancel):
+            cancel.set()
+
+
+def test_run_ffmpeg_timeout(fake_bin, monkeypatch):
+    monkeypatch.setenv('FAKE_FFMPEG', 'hang')
+    with pytest.raises(subprocess.TimeoutExpired):
+        list(vp.run_ffmpeg([str(fake_bin / 'ffmpeg')], timeout=0.5))
+
+
+def test_run_ffmpeg_failure_carries_stderr(fake_bin, monkeypatch):
+    monkeypatch.setenv('FAKE_FFMPEG', 'fail')
+    with pytest.raises(vp.FFmpegError) as excinfo:
+        list(vp.run_ffmpeg([str(fake_bin / 'ffmpeg')]))
+    assert excinfo.value.returncode == 1
+    assert excinfo.value.stderr_tail == 'Invalid data found when processing input'
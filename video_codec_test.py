@@ -2,6 +2,14 @@
 """
 Video Codec Test Script - Let's make this AV1 video submit to our will! 🔥
 Tests multiple approaches to handle problematic AV1 videos
+
+Usage:
+    python video_codec_test.py <video_file>
+    python video_codec_test.py --benchmark [--out-dir DIR] [--resolutions 360,720,1080] [--repeat N]
+
+Benchmark mode generates synthetic testsrc clips (AV1/HEVC/VP9/H.264 at several
+resolutions and bit depths), times each VideoPreprocessor stage on them and
+writes the results to JSON and CSV for regression tracking.
 """
 
 import cv2
@@ -10,6 +18,12 @@ import os
 import sys
 from pathlib import Path
 import tempfile
+import csv
+import json
+import platform
+import shutil
+import statistics
+import time
 
 def test_system_ffmpeg(video_path):
     """Test if system ffmpeg can handle the video"""
@@ -133,9 +147,243 @@ def test_video_info(video_path):
         print(f"❌ Video info failed: {e}")
         return None
 
+# ---- benchmark ----
+
+# codec name -> (encoder, container extension, extra encoder args)
+BENCHMARK_CODECS = {
+    'h264': ('libx264', 'mp4', ['-preset', 'veryfast']),
+    'hevc': ('libx265', 'mp4', ['-preset', 'veryfast', '-tag:v', 'hvc1']),
+    'vp9': ('libvpx-vp9', 'webm', ['-deadline', 'realtime', '-cpu-used', '8']),
+    'av1': ('libsvtav1', 'mp4', ['-preset', '12']),
+}
+AV1_FALLBACK_ENCODERS = [('libaom-av1', ['-cpu-used', '8', '-row-mt', '1'])]
+BENCHMARK_RESOLUTIONS = [360, 720, 1080]
+BENCHMARK_BIT_DEPTHS = [8, 10]
+BENCHMARK_DURATION = 5  # seconds
+BENCHMARK_FPS = 30
+BENCHMARK_CSV_FIELDS = [
+    'clip', 'codec', 'height', 'bit_depth', 'stage', 'ok',
+    'seconds_median', 'seconds_min', 'frames', 'input_mb', 'frames_per_s', 'mb_per_s',
+]
+
+
+def available_encoders():
+    """Names of the encoders this ffmpeg build has"""
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True)
+    encoders = set()
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and len(parts[0]) == 6:
+            encoders.add(parts[1])
+    return encoders
+
+
+def generate_test_clip(out_dir, codec, height, bit_depth, encoders,
+                       duration=BENCHMARK_DURATION, fps=BENCHMARK_FPS):
+    """
+    Encode a deterministic testsrc clip, reusing it if it already exists.
+    Returns the clip path, or None if this ffmpeg can't produce it.
+    """
+    encoder, ext, extra = BENCHMARK_CODECS[codec]
+    if encoder not in encoders and codec == 'av1':
+        for fallback, fallback_extra in AV1_FALLBACK_ENCODERS:
+            if fallback in encoders:
+                encoder, extra = fallback, fallback_extra
+                break
+    if encoder not in encoders:
+        print(f"⚠️ Skipping {codec}: encoder {encoder} not available")
+        return None
+
+    width = height * 16 // 9
+    clip_path = os.path.join(out_dir, f"testsrc_{codec}_{height}p_{bit_depth}bit.{ext}")
+    if os.path.exists(clip_path):
+        return clip_path
+
+    pix_fmt = 'yuv420p' if bit_depth == 8 else 'yuv420p10le'
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f"testsrc=size={width}x{height}:rate={fps}:duration={duration}",
+        '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+        '-c:v', encoder, *extra, '-pix_fmt', pix_fmt,
+        '-c:a', 'libopus' if ext == 'webm' else 'aac',
+        '-shortest', clip_path
+    ]
+    print(f"🔥 Generating {os.path.basename(clip_path)}...")
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0 or not os.path.exists(clip_path):
+        print(f"⚠️ Couldn't generate {os.path.basename(clip_path)}: {result.stderr.strip()[-200:]}")
+        if os.path.exists(clip_path):
+            os.remove(clip_path)
+        return None
+    return clip_path
+
+
+def time_stage(fn, repeat):
+    """Run fn `repeat` times; returns (ok, [seconds...]). ok is fn's last truthy-ness"""
+    timings = []
+    ok = False
+    for _ in range(repeat):
+        started = time.perf_counter()
+        ok = bool(fn())
+        timings.append(time.perf_counter() - started)
+    return ok, timings
+
+
+def cv2_open(video_path):
+    cap = cv2.VideoCapture(video_path)
+    opened = cap.isOpened()
+    cap.release()
+    return opened
+
+
+def cv2_first_frame(video_path):
+    cap = cv2.VideoCapture(video_path)
+    try:
+        ret, _ = cap.read()
+        return ret
+    finally:
+        cap.release()
+
+
+def benchmark_clip(clip_path, repeat, profiles):
+    """Time every pipeline stage on one clip; returns a list of result rows"""
+    from video_preprocessor import VideoPreprocessor, STRATEGY_REMUX, STRATEGY_TRANSCODE
+
+    preprocessor = VideoPreprocessor(probe_cache=False, converted_store=False, segment_workers=1)
+    info = preprocessor.get_video_info(clip_path) or {}
+    input_mb = os.path.getsize(clip_path) / (1024 * 1024)
+    fps = BENCHMARK_FPS
+    frames = int(round((info.get('duration') or BENCHMARK_DURATION) * fps))
+    work_dir = tempfile.mkdtemp(prefix='codec_bench.')
+
+    stages = [
+        ('ffprobe', lambda: preprocessor.get_video_info(clip_path), 0),
+        ('cv2_open', lambda: cv2_open(clip_path), 0),
+        ('cv2_first_frame', lambda: cv2_first_frame(clip_path), 1),
+        ('remux', lambda: preprocessor.convert_video(
+            clip_path, os.path.join(work_dir, 'remux.mp4'), strategy=STRATEGY_REMUX, probe=info), frames),
+    ]
+    for profile in profiles:
+        profiled = VideoPreprocessor(probe_cache=False, converted_store=False, segment_workers=1, profile=profile)
+        stages.append((
+            f"transcode_{profile}",
+            lambda p=profiled, name=profile: p.convert_video(
+                clip_path, os.path.join(work_dir, f"{name}.mp4"), strategy=STRATEGY_TRANSCODE, probe=info),
+            frames,
+        ))
+
+    rows = []
+    try:
+        for stage, fn, stage_frames in stages:
+            ok, timings = time_stage(fn, repeat)
+            median = statistics.median(timings)
+            rows.append({
+                'stage': stage,
+                'ok': ok,
+                'seconds_median': round(median, 4),
+                'seconds_min': round(min(timings), 4),
+                'frames': stage_frames,
+                'input_mb': round(input_mb, 3),
+                'frames_per_s': round(stage_frames / median, 1) if stage_frames and median else None,
+                'mb_per_s': round(input_mb / median, 2) if median else None,
+            })
+            print(f"   {stage:<22} {'✅' if ok else '❌'} {median * 1000:8.1f} ms")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return rows
+
+
+def ffmpeg_version():
+    result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
+    return result.stdout.splitlines()[0] if result.returncode == 0 and result.stdout else None
+
+
+def run_benchmark(out_dir, resolutions=BENCHMARK_RESOLUTIONS, bit_depths=BENCHMARK_BIT_DEPTHS,
+                  codecs=None, repeat=3, profiles=None):
+    """Generate clips, benchmark them and write results.json / results.csv to out_dir"""
+    from video_preprocessor import CONVERSION_PROFILES
+
+    codecs = codecs or list(BENCHMARK_CODECS)
+    profiles = profiles or list(CONVERSION_PROFILES)
+    clips_dir = os.path.join(out_dir, 'clips')
+    os.makedirs(clips_dir, exist_ok=True)
+    encoders = available_encoders()
+
+    rows = []
+    for codec in codecs:
+        for height in resolutions:
+            for bit_depth in bit_depths:
+                clip_path = generate_test_clip(clips_dir, codec, height, bit_depth, encoders)
+                if not clip_path:
+                    continue
+                print(f"🎬 Benchmarking {os.path.basename(clip_path)}")
+                for row in benchmark_clip(clip_path, repeat, profiles):
+                    rows.append({
+                        'clip': os.path.basename(clip_path), 'codec': codec,
+                        'height': height, 'bit_depth': bit_depth, **row,
+                    })
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {
+            'ffmpeg': ffmpeg_version(),
+            'opencv': cv2.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+        },
+        'settings': {
+            'duration': BENCHMARK_DURATION, 'fps': BENCHMARK_FPS, 'repeat': repeat,
+            'resolutions': resolutions, 'bit_depths': bit_depths, 'profiles': profiles,
+        },
+        'results': rows,
+    }
+    json_path = os.path.join(out_dir, 'results.json')
+    with open(json_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    csv_path = os.path.join(out_dir, 'results.csv')
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=BENCHMARK_CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print("=" * 60)
+    print(f"🏁 {len(rows)} measurements written to {json_path} and {csv_path}")
+    return report
+
+
+def benchmark_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the codec detection and conversion pipeline")
+    parser.add_argument('--benchmark', action='store_true')
+    parser.add_argument('--out-dir', default='codec_benchmark', help="where clips and results go")
+    parser.add_argument('--resolutions', default=','.join(map(str, BENCHMARK_RESOLUTIONS)),
+                        help="comma-separated clip heights")
+    parser.add_argument('--bit-depths', default=','.join(map(str, BENCHMARK_BIT_DEPTHS)))
+    parser.add_argument('--codecs', default=','.join(BENCHMARK_CODECS))
+    parser.add_argument('--profiles', default=None, help="comma-separated conversion profiles (default: all)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per stage; the median is reported")
+    args = parser.parse_args(argv)
+
+    run_benchmark(
+        args.out_dir,
+        resolutions=[int(r) for r in args.resolutions.split(',')],
+        bit_depths=[int(b) for b in args.bit_depths.split(',')],
+        codecs=args.codecs.split(','),
+        repeat=max(1, args.repeat),
+        profiles=args.profiles.split(',') if args.profiles else None,
+    )
+
+
 def main():
+    if '--benchmark' in sys.argv[1:]:
+        benchmark_main(sys.argv[1:])
+        return
+
     if len(sys.argv) != 2:
         print("Usage: python video_codec_test.py <video_file>")
+        print("       python video_codec_test.py --benchmark [--out-dir DIR]")
         sys.exit(1)
     
     video_path = sys.argv[1]
@@ -2,23 +2,561 @@
 """
 Video Preprocessor - Makes stubborn videos submit to OpenCV's desires! 🔥
 Automatically converts problematic codecs to OpenCV-friendly formats
+
+Usage:
+    python video_preprocessor.py <video_file>
+    python video_preprocessor.py --batch <file_or_dir>... [--workers N] [--ffmpeg-threads N]
+    python video_preprocessor.py <video_file> --profile throughput --target-resolution 768
 """
 
+import asyncio
 import cv2
 import subprocess
 import os
+import hashlib
+import json
+import re
+import sqlite3
 import tempfile
 import shutil
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
+from types import SimpleNamespace
+
+CACHE_DIR = os.environ.get(
+    'VIDEO_PREPROCESSOR_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'malris', 'video_preprocessor')
+)
+PROBE_CACHE_MAX_ENTRIES = int(os.environ.get('VIDEO_PROBE_CACHE_MAX_ENTRIES', 10000))
+CONVERTED_CACHE_MAX_BYTES = int(os.environ.get('VIDEO_CONVERTED_CACHE_MAX_BYTES', 20 * 1024 ** 3))  # 20GB
+HASH_BLOCK_SIZE = 1024 * 1024  # 1MB
+
+VIDEO_EXTENSIONS = {'.mp4', '.mkv', '.webm', '.mov', '.avi', '.m4v'}
+
+# Bump when the conversion command changes so stale outputs aren't reused
+CONVERSION_VERSION = 4
+
+# Conversion ladder, cheapest first; each step is validated with a decode check
+STRATEGY_REMUX = 'remux'             # stream copy into a fresh mp4
+STRATEGY_VIDEO_ONLY = 'video_only'   # re-encode video, copy audio through
+STRATEGY_TRANSCODE = 'transcode'     # re-encode video and audio
+CONVERSION_STRATEGIES = [STRATEGY_REMUX, STRATEGY_VIDEO_ONLY, STRATEGY_TRANSCODE]
+CONVERSION_TIMEOUTS = {STRATEGY_REMUX: 60, STRATEGY_VIDEO_ONLY: 300, STRATEGY_TRANSCODE: 300}
+
+# Encoder tuning for the re-encode steps. max_resolution caps the long edge
+# (never upscales) and max_fps caps the frame rate; None keeps the source's.
+CONVERSION_PROFILES = {
+    'throughput': {'preset': 'ultrafast', 'crf': 26, 'threads': 2, 'max_resolution': 1280, 'max_fps': 30},
+    'balanced': {'preset': 'fast', 'crf': 23, 'threads': 4, 'max_resolution': 1920, 'max_fps': 60},
+    'archival': {'preset': 'slow', 'crf': 18, 'threads': 8, 'max_resolution': None, 'max_fps': None},
+}
+DEFAULT_PROFILE = os.environ.get('VIDEO_CONVERSION_PROFILE', 'balanced')
+
+# Concurrent ffprobe calls in AsyncVideoPreprocessor (conversions default to CPUs / threads)
+ASYNC_PROBE_CONCURRENCY = int(os.environ.get('VIDEO_ASYNC_PROBE_CONCURRENCY', 32))
+
+# Long inputs are split at keyframes and their segments re-encoded in parallel
+SEGMENT_MIN_DURATION = float(os.environ.get('VIDEO_SEGMENT_MIN_DURATION', 120))  # seconds
+SEGMENT_MIN_BYTES = int(os.environ.get('VIDEO_SEGMENT_MIN_BYTES', 500 * 1024 * 1024))  # 500MB
+SEGMENT_SECONDS = float(os.environ.get('VIDEO_SEGMENT_SECONDS', 30))
+# Slowest stream-copy rate assumed when sizing split/concat timeouts to the input
+STREAM_COPY_MIN_RATE = 10 * 1024 * 1024  # bytes/s
+
+# Verdicts from the ffprobe fast path; AMBIGUOUS falls back to a cv2 decode
+COMPAT_OK = 'ok'
+COMPAT_CONVERT = 'convert'
+COMPAT_AMBIGUOUS = 'ambiguous'
+
+# Containers OpenCV's FFMPEG backend demuxes reliably (ffprobe format_name)
+OPENCV_CONTAINERS = {'mov,mp4,m4a,3gp,3g2,mj2', 'matroska,webm', 'avi'}
+
+# cv2 backends tried (once per codec signature) when the rules are ambiguous.
+# 'ANY' is cv2's default backend selection.
+CV2_BACKENDS = [
+    ('ANY', getattr(cv2, 'CAP_ANY', 0)),
+    ('FFMPEG', getattr(cv2, 'CAP_FFMPEG', None)),
+    ('GSTREAMER', getattr(cv2, 'CAP_GSTREAMER', None)),
+    ('V4L2', getattr(cv2, 'CAP_V4L2', None)),
+]
+
+# First matching rule wins: (reason, predicate(info, preprocessor), verdict)
+COMPATIBILITY_RULES = [
+    ('no video stream found', lambda info, pp: info['codec'] is None, COMPAT_AMBIGUOUS),
+    ('problematic codec', lambda info, pp: info['codec'] in pp.problematic_codecs, COMPAT_CONVERT),
+    ('high bit depth', lambda info, pp: (info['bit_depth'] or 8) > 8, COMPAT_CONVERT),
+    ('10-bit or 4:4:4 profile', lambda info, pp: bool(re.search(r'10|4:4:4|4:2:2', info['profile'] or '')), COMPAT_CONVERT),
+    ('unknown codec', lambda info, pp: info['codec'] not in pp.supported_by_opencv, COMPAT_AMBIGUOUS),
+    ('unusual container', lambda info, pp: info['container'] not in OPENCV_CONTAINERS, COMPAT_AMBIGUOUS),
+    ('unusual pixel format', lambda info, pp: info['pix_fmt'] not in ('yuv420p', 'yuvj420p', 'nv12'), COMPAT_AMBIGUOUS),
+    ('supported codec', lambda info, pp: True, COMPAT_OK),
+]
+
+
+def file_sha256(path):
+    """SHA256 hex digest of a file's contents, streamed in 1MB blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ConversionCancelled(Exception):
+    """Raised when a conversion is aborted through its cancel_event"""
+
+
+class FFmpegError(Exception):
+    """ffmpeg exited non-zero; carries the tail of its stderr"""
+
+    def __init__(self, returncode, stderr_tail):
+        super().__init__(f"ffmpeg exited with {returncode}: {stderr_tail}")
+        self.returncode = returncode
+        self.stderr_tail = stderr_tail
+
+
+class SegmentAborted(FFmpegError):
+    """A segment encode stopped because a sibling segment failed"""
+
+
+def _progress_update(fields, duration, started):
+    """Turn one -progress block into {frame, fps, speed, out_time, percent, eta, elapsed}"""
+    def number(key):
+        try:
+            return float(str(fields.get(key, '')).rstrip('x'))
+        except ValueError:
+            return None
+
+    out_time_us = number('out_time_us')
+    out_time = out_time_us / 1_000_000 if out_time_us and out_time_us > 0 else None
+    speed = number('speed')
+    update = {
+        'frame': int(number('frame') or 0),
+        'fps': number('fps'),
+        'speed': speed,
+        'out_time': out_time,
+        'percent': None,
+        'eta': None,
+        'elapsed': round(time.monotonic() - started, 3),
+        'done': fields.get('progress') == 'end',
+    }
+    if duration and out_time is not None:
+        update['percent'] = round(min(100.0, out_time / duration * 100), 1)
+        if speed:
+            update['eta'] = round(max(0.0, (duration - out_time) / speed), 1)
+    return update
+
+
+def run_ffmpeg(cmd, duration=None, timeout=None, cancel_event=None):
+    """
+    Run an ffmpeg command that includes `-progress pipe:1`, yielding a progress
+    dict per update instead of buffering its output. Only the last 50 stderr
+    lines are kept. Setting cancel_event (anything with is_set()) or passing
+    the timeout terminates ffmpeg; raises ConversionCancelled,
+    subprocess.TimeoutExpired or FFmpegError.
+    """
+    started = time.monotonic()
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, text=True, bufsize=1)
+    stderr_tail = deque(maxlen=50)
+    stop_reason = []
+
+    def drain_stderr():
+        for line in proc.stderr:
+            stderr_tail.append(line.rstrip())
+
+    def watchdog():
+        # Checks cancel/timeout even when ffmpeg goes quiet on stdout
+        while proc.poll() is None:
+            if cancel_event is not None and cancel_event.is_set():
+                stop_reason.append('cancelled')
+            elif timeout and time.monotonic() - started > timeout:
+                stop_reason.append('timeout')
+            if stop_reason:
+                proc.terminate()
+                try:
+                    proc.wait(5)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                return
+            time.sleep(0.2)
+
+    threads = [threading.Thread(target=drain_stderr, daemon=True),
+               threading.Thread(target=watchdog, daemon=True)]
+    for t in threads:
+        t.start()
+
+    try:
+        fields = {}
+        for line in proc.stdout:
+            key, sep, value = line.strip().partition('=')
+            if not sep:
+                continue
+            fields[key] = value
+            if key == 'progress':
+                yield _progress_update(fields, duration, started)
+                fields = {}
+        proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        for t in threads:
+            t.join(1)
+
+    if stop_reason and stop_reason[0] == 'cancelled':
+        raise ConversionCancelled(f"ffmpeg cancelled after {time.monotonic() - started:.1f}s")
+    if stop_reason:
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    if proc.returncode != 0:
+        raise FFmpegError(proc.returncode, '\n'.join(stderr_tail))
+
+
+async def run_ffmpeg_async(cmd, duration=None, timeout=None, progress_callback=None):
+    """
+    asyncio counterpart of run_ffmpeg: streams `-progress pipe:1` updates to
+    progress_callback while the event loop stays free. Cancelling the awaiting
+    task (or hitting the timeout) terminates ffmpeg before the
+    CancelledError/asyncio.TimeoutError propagates. Raises FFmpegError on failure.
+    """
+    started = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stderr_tail = deque(maxlen=50)
+
+    async def drain_stderr():
+        async for line in proc.stderr:
+            stderr_tail.append(line.decode(errors='replace').rstrip())
+
+    async def read_progress():
+        fields = {}
+        async for raw in proc.stdout:
+            key, sep, value = raw.decode(errors='replace').strip().partition('=')
+            if not sep:
+                continue
+            fields[key] = value
+            if key == 'progress':
+                if progress_callback:
+                    progress_callback(_progress_update(fields, duration, started))
+                fields = {}
+        return await proc.wait()
+
+    stderr_task = asyncio.ensure_future(drain_stderr())
+    try:
+        returncode = await asyncio.wait_for(read_progress(), timeout)
+    finally:
+        if proc.returncode is None:
+            proc.terminate()
+            try:
+                await asyncio.wait_for(proc.wait(), 5)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+        await asyncio.gather(stderr_task, return_exceptions=True)
+
+    if returncode != 0:
+        raise FFmpegError(returncode, '\n'.join(stderr_tail))
+
+
+def parse_frame_rate(rate):
+    """ffprobe rational frame rate ('30000/1001') as a float, or None"""
+    try:
+        num, _, den = str(rate).partition('/')
+        value = float(num) / float(den or 1)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return value or None
+
+
+def pix_fmt_bit_depth(pix_fmt):
+    """Bit depth implied by an ffmpeg pix_fmt name, e.g. yuv420p10le -> 10"""
+    if not pix_fmt:
+        return None
+    match = re.search(r'(\d+)(le|be)$', pix_fmt)
+    return int(match.group(1)) if match else 8
+
+
+class ProbeCache:
+    """
+    Persistent probe/compatibility results, keyed by file identity.
+    A file is identified by its absolute path plus size and mtime, so any
+    rewrite of the file invalidates its entry. Oldest-used entries are
+    evicted once the table grows past max_entries. One connection is shared
+    by every thread using the cache and serialised by a lock.
+    """
+
+    def __init__(self, db_path=None, max_entries=PROBE_CACHE_MAX_ENTRIES):
+        self.db_path = db_path or os.path.join(CACHE_DIR, 'probe_cache.sqlite3')
+        self.max_entries = max_entries
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS probes ('
+                ' path TEXT PRIMARY KEY,'
+                ' size INTEGER NOT NULL,'
+                ' mtime_ns INTEGER NOT NULL,'
+                ' result TEXT NOT NULL,'
+                ' last_used REAL NOT NULL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS probes_last_used ON probes (last_used)')
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def file_identity(video_path):
+        """(absolute path, size, mtime_ns) or None if the file is missing"""
+        try:
+            st = os.stat(video_path)
+        except OSError:
+            return None
+        return os.path.abspath(video_path), st.st_size, st.st_mtime_ns
+
+    def get(self, video_path):
+        """Return the cached probe dict for an unchanged file, else None"""
+        identity = self.file_identity(video_path)
+        if identity is None:
+            return None
+        path, size, mtime_ns = identity
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute(
+                    'SELECT result FROM probes WHERE path = ? AND size = ? AND mtime_ns = ?',
+                    (path, size, mtime_ns)
+                ).fetchone()
+                if row is None:
+                    return None
+                conn.execute('UPDATE probes SET last_used = ? WHERE path = ?', (time.time(), path))
+                conn.commit()
+            return json.loads(row[0])
+        except sqlite3.Error as e:
+            print(f"⚠️ Probe cache read failed: {e}")
+            return None
+
+    def put(self, video_path, result):
+        """Store a probe dict for the file's current identity"""
+        identity = self.file_identity(video_path)
+        if identity is None:
+            return
+        path, size, mtime_ns = identity
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    'INSERT OR REPLACE INTO probes (path, size, mtime_ns, result, last_used) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (path, size, mtime_ns, json.dumps(result), time.time())
+                )
+                self._evict(conn)
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"⚠️ Probe cache write failed: {e}")
+
+    def _evict(self, conn):
+        (count,) = conn.execute('SELECT COUNT(*) FROM probes').fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            conn.execute(
+                'DELETE FROM probes WHERE path IN '
+                '(SELECT path FROM probes ORDER BY last_used ASC LIMIT ?)',
+                (excess,)
+            )
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class BackendMatrix:
+    """
+    Which cv2 backend decodes each codec signature, learned once and persisted.
+    A signature is (codec, profile, pix_fmt, container); the stored backend is
+    the first of CV2_BACKENDS that decoded a frame, or None if none did (so
+    files with that signature go straight to conversion). Shared across
+    threads like ProbeCache.
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path or os.path.join(CACHE_DIR, 'backend_matrix.sqlite3')
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS backends ('
+                ' signature TEXT PRIMARY KEY,'
+                ' backend TEXT,'
+                ' learned_from TEXT,'
+                ' updated_at REAL NOT NULL)'
+            )
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def signature(info):
+        return json.dumps([info.get('codec'), info.get('profile'), info.get('pix_fmt'), info.get('container')])
+
+    def lookup(self, info):
+        """{'backend': name or None} for a known signature, else None"""
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    'SELECT backend FROM backends WHERE signature = ?', (self.signature(info),)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"⚠️ Backend matrix read failed: {e}")
+            return None
+        return {'backend': row[0]} if row else None
+
+    def record(self, info, backend, learned_from=None):
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    'INSERT OR REPLACE INTO backends (signature, backend, learned_from, updated_at) '
+                    'VALUES (?, ?, ?, ?)',
+                    (self.signature(info), backend, learned_from, time.time())
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"⚠️ Backend matrix write failed: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class ConvertedStore:
+    """
+    Content-addressed store of converted videos.
+    Outputs live at <root>/<key[:2]>/<key>.mp4, where the key hashes the
+    source content together with the conversion parameters. New outputs are
+    written under <root>/tmp and renamed into place, so readers never see a
+    partial file. Least-recently-used outputs (by mtime, bumped on every hit)
+    are evicted once the store grows past max_bytes.
+    """
+
+    def __init__(self, root=None, max_bytes=CONVERTED_CACHE_MAX_BYTES):
+        self.root = root or os.path.join(CACHE_DIR, 'converted')
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def make_key(source_sha256, params):
+        """Key for a source digest plus a string describing the conversion"""
+        return hashlib.sha256(f"{source_sha256}:{params}".encode()).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.mp4")
+
+    def get(self, key):
+        """Return the stored output path for key (marking it recently used), else None"""
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def temp_path(self, key):
+        """A private path on the store's filesystem to write a new output to"""
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix=f"{key[:16]}.", suffix='.mp4', dir=tmp_dir)
+        os.close(fd)
+        return path
+
+    def publish(self, key, temp_path):
+        """Atomically move a finished output into the store and return its path"""
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def discard(self, temp_path):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+    def evict(self, keep=None):
+        """Delete least-recently-used outputs until the store fits in max_bytes"""
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # tmp/ holds in-flight outputs and segment work dirs; never count or evict them
+            dirnames[:] = [d for d in dirnames if d != 'tmp']
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                print(f"🧹 Evicted cached conversion: {path}")
+            except OSError:
+                pass
+
 
 class VideoPreprocessor:
-    def __init__(self):
+    def __init__(self, probe_cache=None, converted_store=None, ffmpeg_threads=None,
+                 profile=None, target_resolution=None, progress_callback=None, cancel_event=None,
+                 segment_workers=None, backend_matrix=None):
         self.supported_by_opencv = [
             'h264', 'h265', 'vp8', 'vp9', 'mjpeg', 'mpeg4'
         ]
         self.problematic_codecs = [
             'av1', 'hevc'  # Add more as we discover them
         ]
+        # Pass ProbeCache(...) to share/relocate the cache, or False to disable
+        self.probe_cache = ProbeCache() if probe_cache is None else probe_cache
+        self.converted_store = ConvertedStore() if converted_store is None else converted_store
+        self.profile_name = profile or DEFAULT_PROFILE
+        if self.profile_name not in CONVERSION_PROFILES:
+            raise ValueError(f"Unknown conversion profile: {self.profile_name}")
+        self.profile = CONVERSION_PROFILES[self.profile_name]
+        # Overrides the profile's thread count (e.g. to fit a batch's budget)
+        self.ffmpeg_threads = ffmpeg_threads or self.profile['threads']
+        # Long edge the ComfyUI workflow actually consumes; downscale anything bigger
+        self.target_resolution = target_resolution
+        # progress_callback(update) gets every run_ffmpeg update; setting
+        # cancel_event (e.g. threading.Event) aborts the running conversion
+        self.progress_callback = progress_callback
+        self.cancel_event = cancel_event
+        # Parallel encoders for segmented conversions (None sizes to the host, 1 disables)
+        self.segment_workers = segment_workers
+        self.backend_matrix = BackendMatrix() if backend_matrix is None else backend_matrix
     
     def get_video_codec(self, video_path):
         """Get the codec of a video file"""
@@ -35,10 +573,59 @@ class VideoPreprocessor:
         except Exception:
             return None
     
-    def test_opencv_compatibility(self, video_path):
-        """Test if OpenCV can read the video"""
+    def get_video_info(self, video_path):
+        """
+        Read codec, profile, pix_fmt, bit depth and container in one ffprobe call
+        Returns None if ffprobe can't read the file
+        """
         try:
-            cap = cv2.VideoCapture(video_path)
+            result = subprocess.run(self.video_info_command(video_path), capture_output=True, text=True)
+            if result.returncode != 0:
+                return None
+            return self.parse_video_info(result.stdout)
+        except Exception:
+            return None
+
+    def video_info_command(self, video_path):
+        return [
+            'ffprobe', '-v', 'quiet', '-print_format', 'json',
+            '-show_format', '-show_streams', '-select_streams', 'v:0',
+            video_path
+        ]
+
+    @staticmethod
+    def parse_video_info(ffprobe_json):
+        """Pull the fields the compatibility rules need out of ffprobe's JSON"""
+        data = json.loads(ffprobe_json)
+        streams = data.get('streams') or [{}]
+        stream = streams[0]
+        pix_fmt = stream.get('pix_fmt')
+        bit_depth = stream.get('bits_per_raw_sample')
+        return {
+            'codec': stream.get('codec_name'),
+            'profile': stream.get('profile'),
+            'pix_fmt': pix_fmt,
+            'bit_depth': int(bit_depth) if bit_depth and str(bit_depth).isdigit() else pix_fmt_bit_depth(pix_fmt),
+            'container': data.get('format', {}).get('format_name'),
+            'width': stream.get('width'),
+            'height': stream.get('height'),
+            'fps': stream.get('r_frame_rate'),
+            'duration': float(data.get('format', {}).get('duration') or 0) or None,
+        }
+
+    def classify_compatibility(self, info):
+        """Apply COMPATIBILITY_RULES to ffprobe info. Returns (verdict, reason)"""
+        if info is None:
+            return COMPAT_AMBIGUOUS, 'ffprobe failed'
+        for reason, predicate, verdict in COMPATIBILITY_RULES:
+            if predicate(info, self):
+                return verdict, reason
+        return COMPAT_AMBIGUOUS, 'no rule matched'
+
+    def test_opencv_compatibility(self, video_path, backend=None):
+        """Test if OpenCV can read the video (optionally through a specific backend)"""
+        try:
+            cap = cv2.VideoCapture(video_path) if backend is None else cv2.VideoCapture(video_path, backend)
             if not cap.isOpened():
                 return False
             
@@ -48,66 +635,583 @@ class VideoPreprocessor:
         except Exception:
             return False
     
-    def convert_video(self, input_path, output_path, target_codec='libx264'):
-        """Convert video to OpenCV-compatible format"""
+    def probe_video(self, video_path):
+        """
+        Probe codec and OpenCV compatibility, consulting the probe cache first.
+        A single ffprobe JSON call is classified by COMPATIBILITY_RULES. When the
+        verdict is ambiguous the BackendMatrix answers for the codec signature;
+        cv2 is only opened the first time a signature is seen.
+        Returns: {'codec': str or None, 'opencv_ok': bool, 'verdict': str, 'reason': str, ...}
+        """
+        if self.probe_cache:
+            cached = self.probe_cache.get(video_path)
+            if cached is not None:
+                return cached
+
+        info = self.get_video_info(video_path)
+        verdict, reason = self.classify_compatibility(info)
+        if verdict == COMPAT_AMBIGUOUS:
+            learned = self.learned_backend(info)
+            if learned is None:
+                learned = {'backend': self.find_working_backend(video_path)}
+                self.remember_backend(info, learned['backend'], video_path)
+            result = self.probe_result(info, verdict, reason, backend=learned['backend'])
+        else:
+            result = self.probe_result(info, verdict, reason)
+
+        if self.probe_cache:
+            self.probe_cache.put(video_path, result)
+        return result
+
+    @staticmethod
+    def probe_result(info, verdict, reason, backend=None):
+        """
+        Combine ffprobe info, the rule verdict and (if ambiguous) the backend
+        that decodes it. 'backend' is a CV2_BACKENDS name, or None if no cv2
+        backend can read the file.
+        """
+        if verdict == COMPAT_AMBIGUOUS:
+            reason = f"{reason}; cv2 backend {backend}" if backend else f"{reason}; no cv2 backend decodes it"
+        else:
+            backend = 'ANY' if verdict == COMPAT_OK else None
+        return {**(info or {'codec': None}), 'opencv_ok': backend is not None, 'backend': backend,
+                'verdict': verdict, 'reason': reason}
+
+    def learned_backend(self, info):
+        """Matrix entry for this file's codec signature, or None if not learned yet"""
+        if not self.backend_matrix or not info:
+            return None
+        return self.backend_matrix.lookup(info)
+
+    def remember_backend(self, info, backend, video_path):
+        if self.backend_matrix and info:
+            self.backend_matrix.record(info, backend, learned_from=video_path)
+
+    def find_working_backend(self, video_path):
+        """Try CV2_BACKENDS in order; name of the first that decodes a frame, else None"""
+        for name, backend_id in CV2_BACKENDS:
+            if backend_id is None:
+                continue
+            if self.test_opencv_compatibility(video_path, None if name == 'ANY' else backend_id):
+                return name
+        return None
+
+    def content_digest(self, video_path):
+        """SHA256 of the file contents, remembered alongside the cached probe"""
+        probe = self.probe_video(video_path)
+        if probe.get('sha256'):
+            return probe['sha256']
+
+        digest = file_sha256(video_path)
+        if self.probe_cache:
+            self.probe_cache.put(video_path, {**probe, 'sha256': digest})
+        return digest
+
+    def conversion_params(self, strategies, target_codec='libx264'):
+        """String identifying the conversion settings, part of the store key"""
+        profile = self.profile
+        return (
+            f"v{CONVERSION_VERSION}:{target_codec}:{','.join(strategies)}:"
+            f"{profile['preset']}:crf{profile['crf']}:res{self.max_resolution()}:fps{profile['max_fps']}"
+        )
+
+    def max_resolution(self):
+        """Long-edge cap: the smaller of the profile cap and target_resolution"""
+        caps = [c for c in (self.profile['max_resolution'], self.target_resolution) if c]
+        return min(caps) if caps else None
+
+    def video_filters(self, probe):
+        """
+        Scale/fps filters needed to bring the source within the profile caps.
+        A filter is only added when the probe knows the value and it is over
+        the cap; an unknown size or frame rate is left as it is.
+        """
+        filters = []
+        max_res = self.max_resolution()
+        width, height = (probe or {}).get('width'), (probe or {}).get('height')
+        if max_res and width and height and max(width, height) > max_res:
+            filters.append(
+                f"scale='min(iw,{max_res})':'min(ih,{max_res})'"
+                f":force_original_aspect_ratio=decrease:force_divisible_by=2"
+            )
+        max_fps = self.profile['max_fps']
+        fps = parse_frame_rate((probe or {}).get('fps'))
+        if max_fps and fps and fps > max_fps:
+            filters.append(f"fps={max_fps}")
+        return filters
+
+    def build_ffmpeg_command(self, input_path, output_path, strategy=STRATEGY_TRANSCODE,
+                             target_codec='libx264', probe=None):
+        """ffmpeg argv for one step of the conversion ladder"""
+        cmd = ['ffmpeg', '-y', '-nostats', '-progress', 'pipe:1', '-i', input_path]
+        if strategy == STRATEGY_REMUX:
+            cmd += ['-c', 'copy']
+        else:
+            cmd += self.video_encoder_args(probe, target_codec)
+            cmd += ['-c:a', 'copy' if strategy == STRATEGY_VIDEO_ONLY else 'aac']
+        cmd.append(output_path)
+        return cmd
+
+    def video_encoder_args(self, probe, target_codec='libx264'):
+        """Video encoding options for the current profile"""
+        args = [
+            '-c:v', target_codec,
+            '-preset', self.profile['preset'],
+            '-crf', str(self.profile['crf']),
+            '-pix_fmt', 'yuv420p',  # Force 8-bit color
+            '-threads', str(self.ffmpeg_threads),
+        ]
+        filters = self.video_filters(probe)
+        if filters:
+            args += ['-vf', ','.join(filters)]
+        return args
+
+    def should_segment(self, input_path, probe):
+        """Long or large inputs are worth splitting across several encoders"""
+        if self.segment_workers == 1:
+            return False
+        duration = (probe or {}).get('duration') or 0
         try:
-            cmd = [
-                'ffmpeg', '-y', '-i', input_path,
-                '-c:v', target_codec,
-                '-c:a', 'aac',
-                '-preset', 'fast',
-                '-pix_fmt', 'yuv420p',  # Force 8-bit color
+            size = os.path.getsize(input_path)
+        except OSError:
+            size = 0
+        return duration >= SEGMENT_MIN_DURATION or size >= SEGMENT_MIN_BYTES
+
+    @staticmethod
+    def stream_copy_timeout(input_path, minimum):
+        """Timeout for a stream-copy pass over the whole input, at least `minimum`"""
+        try:
+            size = os.path.getsize(input_path)
+        except OSError:
+            size = 0
+        return max(minimum, size / STREAM_COPY_MIN_RATE)
+
+    def convert_video_segmented(self, input_path, output_path, strategy, target_codec='libx264',
+                                probe=None, workers=None, cancel_event=None):
+        """
+        Re-encode a long video in parallel: stream-copy split at keyframes,
+        encode each segment's video in its own ffmpeg (at most `workers` at
+        once), concat-demux the results with stream copy and mux the original
+        audio back in. cancel_event stops it alongside self.cancel_event.
+        Raises FFmpegError/ConversionCancelled like run_ffmpeg; a failed
+        segment is reported with its own error rather than a sibling's.
+        """
+        workers = workers or self.segment_workers or default_batch_workers(self.ffmpeg_threads)
+        work_dir = tempfile.mkdtemp(prefix='segments.', dir=os.path.dirname(os.path.abspath(output_path)))
+        cancel_events = [e for e in (self.cancel_event, cancel_event) if e is not None]
+        cancel = SimpleNamespace(is_set=lambda: any(e.is_set() for e in cancel_events)) if cancel_events else None
+        # Segments stop on the caller's cancel_event or when a sibling fails
+        abort = threading.Event()
+        stop_segments = SimpleNamespace(is_set=lambda: abort.is_set() or (cancel is not None and cancel.is_set()))
+
+        try:
+            split_cmd = [
+                'ffmpeg', '-y', '-nostats', '-progress', 'pipe:1', '-i', input_path,
+                '-map', '0:v:0', '-c', 'copy', '-f', 'segment',
+                '-segment_time', str(SEGMENT_SECONDS), '-reset_timestamps', '1',
+                os.path.join(work_dir, 'src_%05d.mkv')
+            ]
+            split_timeout = self.stream_copy_timeout(input_path, CONVERSION_TIMEOUTS[STRATEGY_REMUX])
+            for _ in run_ffmpeg(split_cmd, timeout=split_timeout, cancel_event=cancel):
+                pass
+            segments = sorted(f for f in os.listdir(work_dir) if f.startswith('src_'))
+            if not segments:
+                raise FFmpegError(0, 'segment split produced no output')
+            print(f"✂️ Split into {len(segments)} segments, encoding with {workers} workers...")
+
+            def encode(index, name):
+                src = os.path.join(work_dir, name)
+                dst = os.path.join(work_dir, f"enc_{index:05d}.mp4")
+                if abort.is_set():
+                    raise SegmentAborted(-1, f"segment {index} skipped after a sibling failed")
+                cmd = ['ffmpeg', '-y', '-nostats', '-progress', 'pipe:1', '-i', src]
+                cmd += self.video_encoder_args(probe, target_codec) + ['-an', dst]
+                try:
+                    for update in run_ffmpeg(cmd, timeout=CONVERSION_TIMEOUTS[strategy], cancel_event=stop_segments):
+                        if self.progress_callback:
+                            self.progress_callback({**update, 'strategy': strategy,
+                                                    'segment': index, 'segments': len(segments)})
+                except ConversionCancelled:
+                    if cancel is not None and cancel.is_set():
+                        raise
+                    raise SegmentAborted(-1, f"segment {index} stopped after a sibling failed")
+                except Exception:
+                    abort.set()
+                    raise
+                return dst
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(encode, index, name) for index, name in enumerate(segments)]
+            errors = [f.exception() for f in futures if f.exception() is not None]
+            if errors:
+                raise next((e for e in errors if not isinstance(e, SegmentAborted)), errors[0])
+            encoded = [f.result() for f in futures]
+
+            concat_list = os.path.join(work_dir, 'concat.txt')
+            with open(concat_list, 'w') as f:
+                for path in encoded:
+                    f.write(f"file '{path}'\n")
+
+            concat_cmd = [
+                'ffmpeg', '-y', '-nostats', '-progress', 'pipe:1',
+                '-f', 'concat', '-safe', '0', '-i', concat_list, '-i', input_path,
+                '-map', '0:v:0', '-map', '1:a:0?', '-c:v', 'copy',
+                '-c:a', 'copy' if strategy == STRATEGY_VIDEO_ONLY else 'aac',
                 output_path
             ]
+            concat_timeout = self.stream_copy_timeout(input_path, CONVERSION_TIMEOUTS[strategy])
+            for _ in run_ffmpeg(concat_cmd, timeout=concat_timeout, cancel_event=cancel):
+                pass
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def convert_video(self, input_path, output_path, target_codec='libx264', strategy=STRATEGY_TRANSCODE,
+                      probe=None):
+        """
+        Convert video to OpenCV-compatible format, reporting progress to
+        self.progress_callback. A failed segmented encode is retried as one
+        ffmpeg process. Raises ConversionCancelled if cancelled.
+        """
+        try:
+            segmented = strategy != STRATEGY_REMUX and self.should_segment(input_path, probe)
+            if segmented:
+                try:
+                    self.convert_video_segmented(input_path, output_path, strategy, target_codec, probe)
+                except (FFmpegError, subprocess.TimeoutExpired) as e:
+                    print(f"⚠️ Segmented {strategy} failed, encoding in one pass: {e}")
+                    segmented = False
+            if not segmented:
+                for update in self.iter_convert_video(input_path, output_path, target_codec, strategy, probe):
+                    if self.progress_callback:
+                        self.progress_callback({**update, 'strategy': strategy})
             
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-            
-            if result.returncode == 0 and os.path.exists(output_path):
+            if os.path.exists(output_path):
                 return True
             else:
-                print(f"Conversion failed: {result.stderr}")
+                print(f"Conversion failed: no output written")
                 return False
+        except ConversionCancelled:
+            raise
+        except FFmpegError as e:
+            print(f"Conversion failed: {e.stderr_tail}")
+            return False
         except Exception as e:
             print(f"Conversion error: {e}")
             return False
+
+    def iter_convert_video(self, input_path, output_path, target_codec='libx264', strategy=STRATEGY_TRANSCODE,
+                           probe=None):
+        """Run one conversion step as an iterator of progress updates (see run_ffmpeg)"""
+        cmd = self.build_ffmpeg_command(input_path, output_path, strategy, target_codec, probe)
+        return run_ffmpeg(cmd, duration=(probe or {}).get('duration'),
+                          timeout=CONVERSION_TIMEOUTS[strategy], cancel_event=self.cancel_event)
+
+    def conversion_ladder(self, probe, force_convert=False):
+        """
+        Strategies worth trying for this probe, cheapest first.
+        Remuxing can't help when the video stream itself is the problem
+        (codec, bit depth, profile) or has to be downscaled, and a forced
+        conversion always transcodes.
+        """
+        if force_convert:
+            return [STRATEGY_TRANSCODE]
+        if probe.get('verdict') == COMPAT_CONVERT or self.video_filters(probe):
+            return [STRATEGY_VIDEO_ONLY, STRATEGY_TRANSCODE]
+        return list(CONVERSION_STRATEGIES)
+
+    def convert_with_fallbacks(self, input_path, output_path, strategies, probe=None):
+        """
+        Walk the conversion ladder until a step produces a file OpenCV decodes
+        Returns the strategy that worked, or None
+        """
+        for strategy in strategies:
+            print(f"🔄 Trying {strategy} ({self.profile_name} profile)...")
+            if self.convert_video(input_path, output_path, strategy=strategy, probe=probe):
+                if self.test_opencv_compatibility(output_path):
+                    return strategy
+                print(f"⚠️ {strategy} output still not readable by OpenCV")
+            try:
+                os.remove(output_path)
+            except OSError:
+                pass
+        return None
     
     def preprocess_video(self, video_path, force_convert=False):
         """
         Preprocess video for OpenCV compatibility
         Returns: (processed_video_path, was_converted)
         """
+        # One probe (cached across calls) covers both codec and OpenCV checks
+        probe = self.probe_video(video_path)
+        codec = probe['codec']
+
         # First check if OpenCV can already handle it
-        if not force_convert and self.test_opencv_compatibility(video_path):
+        if not force_convert and probe['opencv_ok']:
             return video_path, False
         
-        # Get codec info
-        codec = self.get_video_codec(video_path)
         print(f"🎬 Video codec detected: {codec}")
         
         # If it's a problematic codec or OpenCV can't read it, convert
-        if codec in self.problematic_codecs or not self.test_opencv_compatibility(video_path):
+        if force_convert or codec in self.problematic_codecs or not probe['opencv_ok']:
+            strategies = self.conversion_ladder(probe, force_convert)
+            if not self.converted_store:
+                return self._convert_to_tempdir(video_path, codec, strategies, probe)
+
+            # Reuse an earlier conversion of the same content if we have one
+            try:
+                digest = self.content_digest(video_path)
+            except OSError as e:
+                print(f"⚠️ Can't hash input, converting without the cache: {e}")
+                return self._convert_to_tempdir(video_path, codec, strategies, probe)
+            key = self.converted_store.make_key(digest, self.conversion_params(strategies))
+            cached_output = self.converted_store.get(key)
+            if cached_output:
+                print(f"♻️ Using cached conversion: {cached_output}")
+                return cached_output, True
+
             print(f"🔄 Converting {codec} video for OpenCV compatibility...")
-            
-            # Create temp file for converted video
-            temp_dir = tempfile.mkdtemp()
-            temp_output = os.path.join(temp_dir, f"converted_{Path(video_path).stem}.mp4")
-            
-            if self.convert_video(video_path, temp_output):
-                print(f"✅ Successfully converted to H.264!")
-                return temp_output, True
+            temp_output = self.converted_store.temp_path(key)
+
+            try:
+                strategy = self.convert_with_fallbacks(video_path, temp_output, strategies, probe)
+            except ConversionCancelled:
+                self.converted_store.discard(temp_output)
+                print(f"🛑 Conversion cancelled")
+                raise
+            if strategy:
+                print(f"✅ Successfully converted ({strategy})!")
+                return self.converted_store.publish(key, temp_output), True
             else:
+                self.converted_store.discard(temp_output)
                 print(f"❌ Conversion failed!")
                 return video_path, False
-        
+
         return video_path, False
 
-def preprocess_for_comfyui(video_path):
+    def _convert_to_tempdir(self, video_path, codec, strategies, probe):
+        """Uncached conversion into a fresh temp dir (converted_store disabled)"""
+        print(f"🔄 Converting {codec} video for OpenCV compatibility...")
+        temp_dir = tempfile.mkdtemp()
+        temp_output = os.path.join(temp_dir, f"converted_{Path(video_path).stem}.mp4")
+
+        try:
+            strategy = self.convert_with_fallbacks(video_path, temp_output, strategies, probe)
+        except ConversionCancelled:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            print(f"🛑 Conversion cancelled")
+            raise
+        if strategy:
+            print(f"✅ Successfully converted ({strategy})!")
+            return temp_output, True
+        else:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            print(f"❌ Conversion failed!")
+            return video_path, False
+
+class AsyncVideoPreprocessor:
+    """
+    asyncio front end for VideoPreprocessor, built on create_subprocess_exec.
+    Probes and conversions are bounded by separate semaphores, so a worker can
+    probe dozens of inputs at once while capping the number of heavy encodes.
+    Rules, commands and caches are shared with the wrapped VideoPreprocessor;
+    the cv2 fallback, hashing and segmented encodes run in worker threads.
+    """
+
+    def __init__(self, preprocessor=None, probe_concurrency=ASYNC_PROBE_CONCURRENCY,
+                 conversion_concurrency=None, **preprocessor_kwargs):
+        self.sync = preprocessor or VideoPreprocessor(**preprocessor_kwargs)
+        self.probe_semaphore = asyncio.Semaphore(probe_concurrency)
+        self.conversion_semaphore = asyncio.Semaphore(
+            conversion_concurrency or default_batch_workers(self.sync.ffmpeg_threads)
+        )
+
+    async def get_video_info(self, video_path):
+        """Async get_video_info: one ffprobe JSON call, None if unreadable"""
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *self.sync.video_info_command(video_path),
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+            )
+            stdout, _ = await proc.communicate()
+            if proc.returncode != 0:
+                return None
+            return self.sync.parse_video_info(stdout.decode(errors='replace'))
+        except Exception:
+            return None
+
+    async def probe_video(self, video_path):
+        """Async probe_video, sharing the same probe cache"""
+        cache = self.sync.probe_cache
+        if cache:
+            cached = cache.get(video_path)
+            if cached is not None:
+                return cached
+
+        async with self.probe_semaphore:
+            info = await self.get_video_info(video_path)
+            verdict, reason = self.sync.classify_compatibility(info)
+            backend = None
+            if verdict == COMPAT_AMBIGUOUS:
+                learned = self.sync.learned_backend(info)
+                if learned is None:
+                    backend = await asyncio.to_thread(self.sync.find_working_backend, video_path)
+                    self.sync.remember_backend(info, backend, video_path)
+                else:
+                    backend = learned['backend']
+        result = self.sync.probe_result(info, verdict, reason, backend)
+
+        if cache:
+            cache.put(video_path, result)
+        return result
+
+    async def probe_many(self, paths):
+        """Probe every path concurrently (bounded by the probe semaphore)"""
+        return await asyncio.gather(*(self.probe_video(path) for path in paths))
+
+    async def content_digest(self, video_path):
+        probe = await self.probe_video(video_path)
+        if probe.get('sha256'):
+            return probe['sha256']
+        digest = await asyncio.to_thread(file_sha256, video_path)
+        if self.sync.probe_cache:
+            self.sync.probe_cache.put(video_path, {**probe, 'sha256': digest})
+        return digest
+
+    async def convert_video(self, input_path, output_path, target_codec='libx264',
+                            strategy=STRATEGY_TRANSCODE, probe=None):
+        """Async convert_video; holds a conversion slot for the duration of the encode"""
+        pp = self.sync
+        async with self.conversion_semaphore:
+            try:
+                segmented = strategy != STRATEGY_REMUX and pp.should_segment(input_path, probe)
+                if segmented:
+                    try:
+                        await self.convert_video_segmented(input_path, output_path, strategy, target_codec, probe)
+                    except (FFmpegError, subprocess.TimeoutExpired) as e:
+                        print(f"⚠️ Segmented {strategy} failed, encoding in one pass: {e}")
+                        segmented = False
+                if not segmented:
+                    def report(update):
+                        if pp.progress_callback:
+                            pp.progress_callback({**update, 'strategy': strategy})
+
+                    await run_ffmpeg_async(
+                        pp.build_ffmpeg_command(input_path, output_path, strategy, target_codec, probe),
+                        duration=(probe or {}).get('duration'),
+                        timeout=CONVERSION_TIMEOUTS[strategy],
+                        progress_callback=report
+                    )
+            except ConversionCancelled:
+                raise
+            except FFmpegError as e:
+                print(f"Conversion failed: {e.stderr_tail}")
+                return False
+            except asyncio.TimeoutError:
+                print(f"Conversion error: {strategy} timed out")
+                return False
+            except Exception as e:
+                print(f"Conversion error: {e}")
+                return False
+        return os.path.exists(output_path)
+
+    async def convert_video_segmented(self, input_path, output_path, strategy, target_codec, probe):
+        """
+        Run the segmented encode in a worker thread. Cancelling the task sets
+        the thread's cancel_event and waits for its ffmpeg processes to exit,
+        so the caller never cleans up output_path while it is being written.
+        """
+        stop = threading.Event()
+        thread = asyncio.ensure_future(asyncio.to_thread(
+            self.sync.convert_video_segmented, input_path, output_path, strategy, target_codec, probe,
+            cancel_event=stop
+        ))
+        try:
+            await asyncio.shield(thread)
+        except asyncio.CancelledError:
+            stop.set()
+            await asyncio.gather(thread, return_exceptions=True)
+            raise
+
+    async def convert_with_fallbacks(self, input_path, output_path, strategies, probe=None):
+        """Async convert_with_fallbacks: first ladder step whose output OpenCV decodes"""
+        for strategy in strategies:
+            print(f"🔄 Trying {strategy} ({self.sync.profile_name} profile)...")
+            if await self.convert_video(input_path, output_path, strategy=strategy, probe=probe):
+                if await asyncio.to_thread(self.sync.test_opencv_compatibility, output_path):
+                    return strategy
+                print(f"⚠️ {strategy} output still not readable by OpenCV")
+            try:
+                os.remove(output_path)
+            except OSError:
+                pass
+        return None
+
+    async def preprocess_video(self, video_path, force_convert=False):
+        """
+        Async preprocess_video
+        Returns: (processed_video_path, was_converted)
+        """
+        pp = self.sync
+        probe = await self.probe_video(video_path)
+        if not force_convert and probe['opencv_ok']:
+            return video_path, False
+
+        codec = probe['codec']
+        print(f"🎬 Video codec detected: {codec}")
+        strategies = pp.conversion_ladder(probe, force_convert)
+
+        store = pp.converted_store
+        if store:
+            try:
+                digest = await self.content_digest(video_path)
+            except OSError as e:
+                print(f"⚠️ Can't hash input, converting without the cache: {e}")
+                store = None
+        if store:
+            key = store.make_key(digest, pp.conversion_params(strategies))
+            cached_output = store.get(key)
+            if cached_output:
+                print(f"♻️ Using cached conversion: {cached_output}")
+                return cached_output, True
+            temp_output = store.temp_path(key)
+            cleanup = lambda: store.discard(temp_output)
+        else:
+            temp_dir = tempfile.mkdtemp()
+            temp_output = os.path.join(temp_dir, f"converted_{Path(video_path).stem}.mp4")
+            cleanup = lambda: shutil.rmtree(temp_dir, ignore_errors=True)
+
+        print(f"🔄 Converting {codec} video for OpenCV compatibility...")
+        try:
+            strategy = await self.convert_with_fallbacks(video_path, temp_output, strategies, probe)
+        except BaseException:
+            cleanup()
+            raise
+        if not strategy:
+            cleanup()
+            print(f"❌ Conversion failed!")
+            return video_path, False
+
+        print(f"✅ Successfully converted ({strategy})!")
+        if store:
+            return store.publish(key, temp_output), True
+        return temp_output, True
+
+    async def preprocess_many(self, paths, force_convert=False):
+        """Preprocess every path concurrently; returns (path, was_converted) per input, in order"""
+        return await asyncio.gather(*(self.preprocess_video(path, force_convert) for path in paths))
+
+
+def preprocess_for_comfyui(video_path, force_convert=False, profile=None, target_resolution=None,
+                           progress_callback=None, cancel_event=None):
     """
     Main function to preprocess videos for ComfyUI
     Returns the path to a video that OpenCV can definitely read
     """
-    preprocessor = VideoPreprocessor()
-    processed_path, was_converted = preprocessor.preprocess_video(video_path)
+    preprocessor = VideoPreprocessor(
+        profile=profile, target_resolution=target_resolution,
+        progress_callback=progress_callback, cancel_event=cancel_event
+    )
+    processed_path, was_converted = preprocessor.preprocess_video(video_path, force_convert=force_convert)
     
     if was_converted:
         print(f"🎉 Video preprocessed successfully: {processed_path}")
@@ -116,12 +1220,137 @@ def preprocess_for_comfyui(video_path):
     
     return processed_path, was_converted
 
+def print_progress(update):
+    """progress_callback that logs one line per ffmpeg progress update"""
+    percent = f"{update['percent']}%" if update['percent'] is not None else '?%'
+    eta = f"{update['eta']}s" if update['eta'] is not None else '?'
+    print(f"⏳ {update['strategy']}: {percent} frame={update['frame']} fps={update['fps']} "
+          f"speed={update['speed']}x eta={eta}", flush=True)
+
+
+def available_cpus():
+    """CPUs this process may run on (respects container/affinity limits)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def default_batch_workers(ffmpeg_threads):
+    """Enough workers to fill the host without oversubscribing ffmpeg threads"""
+    return max(1, available_cpus() // max(1, ffmpeg_threads))
+
+
+def expand_video_paths(paths):
+    """Expand directories (recursively) into the video files they contain"""
+    expanded = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for name in sorted(filenames):
+                    if Path(name).suffix.lower() in VIDEO_EXTENSIONS:
+                        expanded.append(os.path.join(dirpath, name))
+        else:
+            expanded.append(path)
+    return expanded
+
+
+_batch_preprocessor = None
+
+
+def _init_batch_worker(ffmpeg_threads, profile, target_resolution):
+    global _batch_preprocessor
+    # Keep worker chatter off stdout so the parent's JSON lines stay parseable
+    sys.stdout = sys.stderr
+    # The pool already fills the host, so don't fan segments out on top of it
+    _batch_preprocessor = VideoPreprocessor(
+        ffmpeg_threads=ffmpeg_threads, profile=profile, target_resolution=target_resolution,
+        segment_workers=1
+    )
+
+
+def _preprocess_one(video_path, force_convert):
+    started = time.monotonic()
+    result = {'input': video_path, 'output': None, 'converted': False, 'codec': None, 'error': None}
+    try:
+        if not os.path.exists(video_path):
+            raise FileNotFoundError(video_path)
+        output, was_converted = _batch_preprocessor.preprocess_video(video_path, force_convert=force_convert)
+        result['codec'] = _batch_preprocessor.probe_video(video_path)['codec']
+        result['output'] = output
+        result['converted'] = was_converted
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = round(time.monotonic() - started, 3)
+    return result
+
+
+def preprocess_many(paths, workers=None, ffmpeg_threads=None, force_convert=False,
+                    profile=None, target_resolution=None):
+    """
+    Preprocess many videos (directories are expanded) across a process pool.
+    Pool size defaults to available CPUs divided by the per-conversion ffmpeg
+    thread budget (the profile's thread count unless ffmpeg_threads is given).
+    Yields one result dict per file as it completes.
+    """
+    video_paths = expand_video_paths(paths)
+    if not video_paths:
+        return
+    ffmpeg_threads = ffmpeg_threads or CONVERSION_PROFILES[profile or DEFAULT_PROFILE]['threads']
+    workers = min(workers or default_batch_workers(ffmpeg_threads), len(video_paths))
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_batch_worker,
+        initargs=(ffmpeg_threads, profile, target_resolution),
+    ) as pool:
+        futures = [pool.submit(_preprocess_one, path, force_convert) for path in video_paths]
+        for fut in as_completed(futures):
+            yield fut.result()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Preprocess videos for OpenCV/ComfyUI compatibility")
+    parser.add_argument('paths', nargs='+', help="video files or directories")
+    parser.add_argument('--batch', action='store_true',
+                        help="process all paths in a process pool, one JSON line per file")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="batch pool size (default: CPUs / --ffmpeg-threads)")
+    parser.add_argument('--ffmpeg-threads', type=int, default=None,
+                        help="threads per ffmpeg conversion in batch mode (default: the profile's)")
+    parser.add_argument('--profile', choices=sorted(CONVERSION_PROFILES), default=DEFAULT_PROFILE,
+                        help=f"encoder tuning profile (default: {DEFAULT_PROFILE})")
+    parser.add_argument('--target-resolution', type=int, default=None,
+                        help="downscale so the long edge is at most this many pixels")
+    parser.add_argument('--force', action='store_true', help="convert even if OpenCV can read the file")
+    args = parser.parse_args()
+
+    if not args.batch and len(args.paths) == 1 and not os.path.isdir(args.paths[0]):
+        # SIGTERM from a supervising job processor stops ffmpeg cleanly
+        cancel_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: cancel_event.set())
+        try:
+            processed_path, was_converted = preprocess_for_comfyui(
+                args.paths[0], force_convert=args.force,
+                profile=args.profile, target_resolution=args.target_resolution,
+                progress_callback=print_progress, cancel_event=cancel_event
+            )
+        except ConversionCancelled:
+            sys.exit(130)
+        print(f"Result: {processed_path} (converted: {was_converted})")
+        return
+
+    failed = 0
+    for result in preprocess_many(args.paths, workers=args.workers,
+                                  ffmpeg_threads=args.ffmpeg_threads, force_convert=args.force,
+                                  profile=args.profile, target_resolution=args.target_resolution):
+        failed += result['error'] is not None
+        print(json.dumps(result), flush=True)
+    if failed:
+        sys.exit(2)
+
+
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) != 2:
-        print("Usage: python video_preprocessor.py <video_file>")
-        sys.exit(1)
-    
-    video_path = sys.argv[1]
-    processed_path, was_converted = preprocess_for_comfyui(video_path)
-    print(f"Result: {processed_path} (converted: {was_converted})")
\ No newline at end of file
+    main()